@@ -0,0 +1,263 @@
+"""
+Time the conversion pipeline stage by stage on synthetic documents, from a
+single page to a 500-page book:
+
+    python benchmarks/bench_pipeline.py [--sizes 1,10,100,500] [--stages ...]
+                                        [--threshold 0.25] [--update]
+
+Every stage is timed --repeat times, or for fast stages as many times as fit
+in half a second, keeping the best. As in timeit, the garbage collector is
+off while timing, since the pages built for the other stages would make its
+passes cost more at larger sizes. It is then run once more under
+tracemalloc for peak memory and the number of memory blocks its output holds.
+Results are compared with benchmarks/baselines.json, and the run fails if a
+stage got more than --threshold slower or hungrier. Time differences under
+5 ms or a fifth of the baseline are taken as noise. --update rewrites the
+baselines instead.
+Baselines depend on the machine, so refresh them when switching hardware.
+
+The PDF extraction stage runs on a generated PDF with the LLM backend replaced
+by a stub through utils.pdf_extraction.register_backend, so no API keys or
+network are needed. format_local times the offline cleanup
+(BRAILLE_FORMAT_MODE=local) on the text hard-wrapped like PDF text blocks.
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import textwrap
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import pdf_extraction
+from utils.braille_to_gcode import (
+    NUM_BRAILLE_PER_COL, NUM_BRAILLE_PER_ROW, PrintedDots, dot_pos_to_gcode, dot_pos_to_pdf,
+    get_dots_pos_and_page,
+)
+from utils.fast_layout import DotArrays
+from utils.pdf_preview import render_preview
+from utils.text_to_braille import contract_word, text_to_braille
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+SIZES = [1, 10, 100, 500]
+# Allowed growth over the baseline before a stage counts as regressed
+THRESHOLD = 0.25
+# Differences below these are noise, whatever the ratio
+MIN_SECONDS = 0.005
+# Slowdowns under this share of the baseline time are noise too
+NOISE_FRACTION = 0.2
+# Fast stages are timed again until this much time has passed, so a burst of
+# load on the machine does not cover every run
+MIN_TIMING_SECONDS = 0.5
+MIN_BYTES = 64 * 1024
+MIN_BLOCKS = 100
+# Print pages in the generated PDF per braille page of text
+PDF_PAGES_PER_BRAILLE_PAGE = 0.25
+
+WORDS = ("the and of to in that it with as for was on be by this which from his have they "
+         "braille reader paper dot cell letter page line word printer embossed tactile "
+         "knowledge children people through question character mother father world spirit "
+         "quick little great friend about after against always because before together "
+         "education system language communication independence literacy alphabet contraction").split()
+SYLLABLES = "ba con dis en ex for in ing ment ness ou pro sh st ter th tion un ver wh".split()
+
+
+def synthetic_text(braille_pages: int, seed: int = 0) -> str:
+    """Paragraphs of English-like text, about `braille_pages` pages once in Grade 2"""
+    rng = random.Random(seed)
+    # Contractions save roughly a fifth of the cells
+    target = int(braille_pages * NUM_BRAILLE_PER_ROW * NUM_BRAILLE_PER_COL * 1.2)
+    paragraphs = []
+    length = 0
+    while length < target:
+        sentences = []
+        for _ in range(rng.randint(2, 5)):
+            # Mostly common words, plus made-up ones so per-word caches don't see only repeats
+            words = [rng.choice(WORDS) if rng.random() < 0.8 else "".join(rng.choices(SYLLABLES, k=rng.randint(2, 4)))
+                     for _ in range(rng.randint(6, 16))]
+            sentences.append(" ".join(words).capitalize() + rng.choice(".,;!?."))
+        paragraph = " ".join(sentences)
+        paragraphs.append(paragraph)
+        length += len(paragraph) + 1
+    return "\n".join(paragraphs)
+
+
+def synthetic_pdf(text: str, pages: int) -> bytes:
+    """A PDF with the text spread over `pages` pages and a small image on every other page"""
+    import fitz  # PyMuPDF
+
+    doc = fitz.open()
+    lines = text.split("\n")
+    per_page = max(1, len(lines) // pages)
+    pixmap = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 32, 32), False)
+    pixmap.clear_with(200)
+    image = pixmap.tobytes("png")
+    for i in range(pages):
+        page = doc.new_page()
+        chunk = "\n".join(lines[i * per_page:(i + 1) * per_page]) if i < pages - 1 else "\n".join(lines[i * per_page:])
+        page.insert_textbox(fitz.Rect(50, 50, 560, 700), chunk, fontsize=9)
+        if i % 2 == 0:
+            page.insert_image(fitz.Rect(50, 710, 114, 774), stream=image)
+    return doc.tobytes()
+
+
+class StubChatClient:
+    """Answers chat completions instantly. Formatting requests get their input text back."""
+
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, **kwargs):
+        content = messages[-1]["content"]
+        if isinstance(content, list):
+            reply = "An image."
+        else:
+            reply = content
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=reply))])
+
+
+def measure(function, repeat: int) -> dict:
+    """Best wall time of `repeat` runs or more, then peak memory and output blocks under tracemalloc"""
+    seconds = float("inf")
+    runs = 0
+    gc.disable()
+    try:
+        deadline = time.perf_counter() + MIN_TIMING_SECONDS
+        while runs < repeat or time.perf_counter() < deadline:
+            start = time.perf_counter()
+            function()
+            seconds = min(seconds, time.perf_counter() - start)
+            runs += 1
+    finally:
+        gc.enable()
+
+    tracemalloc.start()
+    try:
+        result = function()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    blocks = sum(stat.count for stat in snapshot.statistics("filename"))
+    del result
+    return {"seconds": seconds, "peak_bytes": peak, "blocks": blocks}
+
+
+def run_size(size: int, stages, repeat: int) -> dict:
+    text = synthetic_text(size)
+    braille = text_to_braille(text)
+    pages = get_dots_pos_and_page(braille)
+    dots = [dot for page in pages for dot in page]
+
+    def gcode():
+        return [dot_pos_to_gcode(page, sink=PrintedDots()) for page in pages]
+
+    def pdf():
+        return dot_pos_to_pdf(dots).output(dest='S')
+
+    arrays = DotArrays.from_dot_positions(dots)
+
+    pdf_pages = max(1, round(size * PDF_PAGES_PER_BRAILLE_PAGE))
+
+    def extract():
+        return pdf_extraction.extract_text_from_pdf(pdf_bytes)
+
+    # Text blocks as PyMuPDF returns them: paragraphs wrapped at about 80 columns, some words hyphenated
+    wrapped = (textwrap.fill(paragraph, 80).replace("tion ", "-\ntion ", 1) for paragraph in text.split("\n"))
+    blocks = [("text", paragraph, (0, 0, 0, 0)) for paragraph in wrapped]
+
+    def translate():
+        contract_word.cache_clear()  # time a document the server has not seen words of
+        return text_to_braille(text)
+
+    functions = {
+        "text_to_braille": translate,
+        "get_dots_pos_and_page": lambda: get_dots_pos_and_page(braille),
+        "dot_pos_to_gcode": gcode,
+        "dot_pos_to_pdf": pdf,
+        "render_preview": lambda: render_preview(arrays),
+        "extract_text_from_pdf": extract,
+        "format_local": lambda: pdf_extraction.format_elements(blocks, mode="local"),
+    }
+    results = {}
+    for stage in stages:
+        if stage == "extract_text_from_pdf":
+            pdf_bytes = synthetic_pdf(text, pdf_pages)
+        results[stage] = measure(functions[stage], repeat)
+        print(f"{stage:<24} {size:>4} pages {results[stage]['seconds']:>9.3f} s "
+              f"{results[stage]['peak_bytes'] / 2**20:>9.1f} MiB {results[stage]['blocks']:>10} blocks",
+              flush=True)
+    return results
+
+
+def compare(results: dict, baselines: dict, threshold: float):
+    """Lines describing every stage that regressed beyond the threshold"""
+    regressions = []
+    for key, result in results.items():
+        baseline = baselines.get(key)
+        if baseline is None:
+            continue
+        slower = result["seconds"] - baseline["seconds"]
+        noise = max(MIN_SECONDS, baseline["seconds"] * NOISE_FRACTION)
+        if slower > noise and result["seconds"] > baseline["seconds"] * (1 + threshold):
+            regressions.append(f"{key}: {baseline['seconds']:.3f} s -> {result['seconds']:.3f} s")
+        if (result["peak_bytes"] - baseline["peak_bytes"] > MIN_BYTES
+                and result["peak_bytes"] > baseline["peak_bytes"] * (1 + threshold)):
+            regressions.append(f"{key}: peak {baseline['peak_bytes'] / 2**20:.1f} MiB -> "
+                               f"{result['peak_bytes'] / 2**20:.1f} MiB")
+        if (result["blocks"] - baseline["blocks"] > MIN_BLOCKS
+                and result["blocks"] > baseline["blocks"] * (1 + threshold)):
+            regressions.append(f"{key}: {baseline['blocks']} -> {result['blocks']} blocks")
+    return regressions
+
+
+def main():
+    stage_names = ["text_to_braille", "get_dots_pos_and_page", "dot_pos_to_gcode", "dot_pos_to_pdf",
+                   "render_preview", "extract_text_from_pdf", "format_local"]
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)), help="document sizes in braille pages")
+    parser.add_argument("--stages", default=",".join(stage_names))
+    parser.add_argument("--repeat", type=int, default=3, help="least timed runs per stage, the best counts")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    parser.add_argument("--baselines", default=BASELINES)
+    parser.add_argument("--update", action="store_true", help="store this run as the new baselines")
+    args = parser.parse_args()
+
+    pdf_extraction.register_backend("groq", StubChatClient)
+    pdf_extraction.register_backend("claude", StubChatClient)
+
+    stages = args.stages.split(",")
+    results = {}
+    for size in map(int, args.sizes.split(",")):
+        for stage, result in run_size(size, stages, args.repeat).items():
+            results[f"{stage}/{size}"] = result
+
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            baselines = json.load(f)
+
+    if args.update:
+        baselines.update(results)
+        with open(args.baselines, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baselines written to {args.baselines}")
+        return
+
+    regressions = compare(results, baselines, args.threshold)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%}:")
+        for line in regressions:
+            print("  " + line)
+        sys.exit(1)
+    print(f"\nNo regressions over {args.threshold:.0%}" if baselines else "\nNo baselines yet, run with --update")
+
+
+if __name__ == "__main__":
+    main()
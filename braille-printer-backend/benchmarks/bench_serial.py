@@ -0,0 +1,98 @@
+"""
+Measure the serial sender against a virtual Marlin (utils/virtual_printer.py)
+on a pseudo-terminal, so no printer is needed:
+
+    python benchmarks/bench_serial.py [--pages 1] [--baud 250000] [--move-time 0.002]
+                                      [--latency 0.001] [--error-rate 0.0] [--buffer 4] [--planner 16]
+                                      [--mode both|all|streaming|blocking|sd] [--advanced-ok]
+
+Reports punches per second, ok latency and resends for every mode, and checks
+that the virtual printer executed exactly the G-code that was sent, in order.
+"sd" uploads every page to the virtual SD card and prints it from there, its
+time includes the upload. "both" runs blocking and streaming, "all" adds sd.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.braille_to_gcode import PrintedDots, dot_pos_to_gcode, get_dots_pos_and_page
+from utils.printer import PrinterConnection, send_actions
+from utils.text_to_braille import text_to_braille
+from utils.virtual_printer import BUFFER_SIZE, LATENCY, MOVE_TIME, PLANNER_SIZE, PUNCH_TIME, VirtualPrinter
+
+SAMPLE_TEXT = ("Braille is a tactile writing system used by people who are visually impaired. "
+               "It is traditionally written with embossed paper. ") * 40
+
+
+def run(mode: str, pages, args) -> dict:
+    printer_kwargs = dict(baud_rate=args.baud, buffer_size=args.buffer, planner_size=args.planner,
+                          move_time=args.move_time, punch_time=args.punch_time, latency=args.latency,
+                          error_rate=args.error_rate, advanced_ok=args.advanced_ok,
+                          seed=args.seed, keep_log=True)
+    with VirtualPrinter(**printer_kwargs) as virtual:
+        printer = PrinterConnection(virtual.port, args.baud)
+        printer.connect()
+        printer.sd_card = mode == "sd"
+        try:
+            sent = []
+            start = time.perf_counter()
+            for page in pages:
+                actions = dot_pos_to_gcode(page, sink=PrintedDots())
+                sent += [action.command for action in actions]
+                send_actions(actions, printer, mode == "streaming")
+            # The last oks arrive when the planner takes the moves, wait for them to run
+            printer.send_command("M400")
+            elapsed = time.perf_counter() - start
+        finally:
+            printer.close()
+        executed = [command for command in virtual.log if command.startswith("G1 ")]
+        metrics = printer.metrics
+        return {
+            "seconds": elapsed,
+            "punches": metrics.punches,
+            "punches_per_second": metrics.punches / elapsed,
+            "latency_p50": metrics.latency.quantile(0.5),
+            "latency_p95": metrics.latency.quantile(0.95),
+            "latency_mean": metrics.latency.sum / max(metrics.latency.count, 1),
+            "resends": metrics.resends,
+            "correct": executed == sent,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=1)
+    parser.add_argument("--baud", type=int, default=250000)
+    parser.add_argument("--move-time", type=float, default=MOVE_TIME)
+    parser.add_argument("--punch-time", type=float, default=PUNCH_TIME)
+    parser.add_argument("--latency", type=float, default=LATENCY)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--buffer", type=int, default=BUFFER_SIZE)
+    parser.add_argument("--planner", type=int, default=PLANNER_SIZE)
+    parser.add_argument("--advanced-ok", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mode", choices=["both", "all", "streaming", "blocking", "sd"], default="both")
+    args = parser.parse_args()
+
+    pages = get_dots_pos_and_page(text_to_braille(SAMPLE_TEXT * args.pages))[:args.pages]
+    modes = {"both": ["blocking", "streaming"], "all": ["blocking", "streaming", "sd"]}.get(args.mode, [args.mode])
+    print(f"{len(pages)} page(s), {sum(dot.punch for page in pages for dot in page)} punches, "
+          f"{args.baud} baud, buffer {args.buffer}, planner {args.planner}, "
+          f"move {args.move_time * 1000:g} ms, punch {args.punch_time * 1000:g} ms, "
+          f"latency {args.latency * 1000:g} ms, errors {args.error_rate:g}")
+    print(f"{'mode':<10} {'seconds':>8} {'punch/s':>8} {'p50 ms':>7} {'p95 ms':>7} {'mean ms':>8} {'resends':>8}  correct")
+    failed = False
+    for mode in modes:
+        result = run(mode, pages, args)
+        failed |= not result["correct"]
+        print(f"{mode:<10} {result['seconds']:>8.2f} {result['punches_per_second']:>8.1f} "
+              f"{result['latency_p50'] * 1000:>7.2f} {result['latency_p95'] * 1000:>7.2f} "
+              f"{result['latency_mean'] * 1000:>8.2f} {result['resends']:>8}  {result['correct']}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Time how long `import app` takes in a fresh interpreter, and check that the
+heavy optional modules are not pulled in at import time.
+
+    python benchmarks/bench_startup.py [--runs 5] [--max-seconds 2.0] [--journals 20]
+
+The server runs against a journal directory holding --journals unfinished
+print jobs, as after a crash, and must not read them while importing.
+Exits non-zero if the median import time is over the limit, a heavy module
+was imported or the journals were read, so it can run as a startup
+regression check.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from utils.braille_to_gcode import get_dots_pos_and_page
+from utils.job_journal import JobJournal
+from utils.text_to_braille import text_to_braille
+
+# Loaded on first use only, importing the server must not bring these in
+HEAVY_MODULES = ["selenium", "anthropic", "groq", "fitz"]
+MAX_SECONDS = 2.0
+# Unfinished jobs left in the journal directory, and pages in each
+JOURNALS = 20
+JOURNAL_PAGES = 10
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import app
+elapsed = time.perf_counter() - start
+heavy = [name for name in {heavy!r} if name in sys.modules]
+pool = sys.modules["flask_server_ai"].printer_pool
+# Looked up without the jobs property, which would recover the journals itself
+journals_read = len(vars(pool).get("_jobs", vars(pool).get("jobs", {{}})))
+print(json.dumps({{"seconds": elapsed, "heavy": heavy, "journals_read": journals_read}}))
+"""
+
+
+def make_journals(directory: str, count: int = JOURNALS, num_pages: int = JOURNAL_PAGES):
+    """Leave `count` half printed jobs in `directory`, as a crash would"""
+    words = "the quick brown fox jumps over the lazy dog while the printer punches"
+    pages = get_dots_pos_and_page(text_to_braille(" ".join([words] * 40 * num_pages)))[:num_pages]
+    for job_id in range(1, count + 1):
+        journal = JobJournal(job_id, directory)
+        journal.start(pages)
+        journal.record_punch(0, 10)
+        journal.close()
+
+
+def time_import(heavy_modules=HEAVY_MODULES, journal_dir: str = None) -> dict:
+    """Import app in a new process and report the time, any heavy modules loaded and journals read"""
+    env = dict(os.environ)
+    if journal_dir is not None:
+        env["BRAILLE_JOURNAL_DIR"] = journal_dir
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE.format(heavy=heavy_modules)],
+        cwd=BACKEND_DIR, capture_output=True, text=True, check=True, env=env,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-seconds", type=float, default=MAX_SECONDS)
+    parser.add_argument("--journals", type=int, default=JOURNALS)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as journal_dir:
+        make_journals(journal_dir, args.journals)
+        # The first run warms the bytecode cache
+        time_import(journal_dir=journal_dir)
+        runs = [time_import(journal_dir=journal_dir) for _ in range(args.runs)]
+    seconds = [run["seconds"] for run in runs]
+    heavy = sorted({name for run in runs for name in run["heavy"]})
+    journals_read = max(run["journals_read"] for run in runs)
+    median = statistics.median(seconds)
+
+    print(f"import app: median {median * 1000:.0f} ms, min {min(seconds) * 1000:.0f} ms, "
+          f"max {max(seconds) * 1000:.0f} ms over {args.runs} runs, {args.journals} journals left")
+    failed = False
+    if journals_read:
+        print(f"FAIL: {journals_read} job journals were read at startup")
+        failed = True
+    if heavy:
+        print(f"FAIL: heavy modules imported at startup: {', '.join(heavy)}")
+        failed = True
+    if median > args.max_seconds:
+        print(f"FAIL: startup slower than {args.max_seconds:.2f} s")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,47 +1,253 @@
 from io import BytesIO
-from flask import Flask, request, jsonify, send_file
+import json
+import logging
+import os
+import time
+from flask import Flask, Response, request, jsonify, send_file
 from flask_cors import CORS
 from dotenv import load_dotenv
-import anthropic
 import atexit
 
-from utils.pdf_extraction import extract_text_from_pdf, extract_text_from_zoom
-from utils.text_to_braille import text_to_braille
-from utils.braille_to_gcode import DotPosition, dot_pos_to_pdf, get_dots_pos_and_page, dot_pos_to_gcode, printed_dots
-from utils.printer import PrinterConnection, PrintStatus, pause_print, print_gcode, resume_print, stop_print
+from utils.pdf_extraction import extract_text_from_zoom, iter_text_from_pdf
+from utils.text_to_braille import iter_text_to_braille
+from utils.braille_to_gcode import INTERPOINT, PUNCH_ORDER, DotPosition, PrintedDots, dot_pos_to_gcode, iter_dots_pos_pages, printed_dots
+from utils.printer import SD_CARD, PrinterConnection, PrintStatus, pause_print, print_gcode, print_pages, resume_print, stop_print
+from utils.metrics import render_prometheus
+from utils.fast_layout import DotArrays
+from utils.pdf_preview import parse_page_range, render_preview
+from utils.wire_format import DOTS_MIMETYPE, decode_dot_arrays, dot_arrays_to_list, encode_dot_arrays
+from utils.pipeline_cache import PipelineCache, content_key
+from utils.printer_pool import PrinterPool, SlotState
+from utils.print_time import JobEstimate, LiveEta, estimate_actions, estimate_pages
+from utils.conversion_jobs import ConversionQueue, ConversionStatus, QueueFull
+from utils.line_breaking import LINE_BREAKING, iter_break_lines
+from utils.line_breaking import MODES as LINE_BREAKING_MODES
+from utils.layout_profile import DEFAULT_PROFILE, PROFILES, get_profile
 
 DEBUG = False
+# Seconds between keep-alive comments on idle progress streams
+SSE_KEEPALIVE = 15
 
 load_dotenv()
-client = anthropic.Anthropic()
+# Set LOG_LEVEL=DEBUG to see every line sent to and received from the printer
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
 
 app = Flask(__name__)
-CORS(app)
+# Let browsers read the print time estimate sent with converted dots
+CORS(app, expose_headers=["X-Estimated-Seconds", "X-Estimated-Page-Seconds", "X-Pages-Before", "X-Pages-After"])
 
 printer = None
+# Time left in the print started by /print_dots or /print_stream
+print_eta = None
+# Stage outputs keyed by input content, so re-prints skip extraction and the LLM calls
+pipeline_cache = PipelineCache()
+# Every connected printer, fed from the /jobs queue
+printer_pool = PrinterPool()
+# Conversions from / and /conversions, off the request threads
+conversion_queue = ConversionQueue(pipeline_cache)
 
 # pdf to dot positions
 # right now it's pdf to ascii
 
 
-@app.route('/', methods=['POST'])
-def handle_input():
+def wants_binary_dots():
+    """Clients that accept DOTS_MIMETYPE get packed arrays instead of JSON"""
+    return request.accept_mimetypes.best_match(["application/json", DOTS_MIMETYPE]) == DOTS_MIMETYPE
+
+
+def read_dot_positions():
+    """Dot positions from either a binary DOTS_MIMETYPE body or JSON"""
+    if request.mimetype == DOTS_MIMETYPE:
+        return dot_arrays_to_list(decode_dot_arrays(request.get_data()))
+    data = request.get_json()
+    return [DotPosition(**dot_dict) for dot_dict in data["dotPositions"]]
+
+
+def read_dot_arrays():
+    """All dots as DotArrays, from a binary body or a flat or nested JSON list"""
+    if request.mimetype == DOTS_MIMETYPE:
+        return decode_dot_arrays(request.get_data())
+    return DotArrays.from_dot_positions([dot for page in read_dot_pages() for dot in page])
+
+
+def read_dot_pages():
+    """Dot positions grouped by page, from a binary body, nested JSON pages or a flat JSON list"""
+    if request.mimetype == DOTS_MIMETYPE:
+        return decode_dot_arrays(request.get_data()).to_dot_positions()
+    data = request.get_json()["dotPositions"]
+    if data and isinstance(data[0], list):
+        return [[DotPosition(**dot_dict) for dot_dict in page] for page in data]
+    pages = {}
+    for dot_dict in data:
+        dot = DotPosition(**dot_dict)
+        pages.setdefault(dot.page, []).append(dot)
+    # Pages without dots are kept, so page numbers (and sides of a sheet) stay the same
+    return [pages.get(page, []) for page in range(max(pages) + 1)] if pages else []
+
+
+def read_conversion_input():
+    """(source, data, cache key) of an uploaded PDF, a Zoom link or text, None if the form has neither"""
     if 'file' in request.files:
-        pdf_file = request.files['file']
-        pdf_bytes = pdf_file.read()
-        transcript = extract_text_from_pdf(pdf_bytes)
-    elif 'text' in request.form:
+        pdf_bytes = request.files['file'].read()
+        return "pdf", pdf_bytes, content_key("pdf", pdf_bytes)
+    if 'text' in request.form:
         text = request.form['text']
         if text.startswith('https://') and 'zoom.us' in text:
-            transcript = extract_text_from_zoom(text)
-        else:
-            transcript = text
-            
-    if DEBUG:
-        print("DEBUG: transcript", transcript)
-    braille = text_to_braille(transcript)
-    dots_pos = get_dots_pos_and_page(braille)
-    return jsonify(dots_pos), 200
+            return "zoom", text, content_key("zoom", text)
+        return "text", text, content_key("text", text)
+    return None
+
+
+def wants_interpoint(value=None):
+    """Interpoint layout asked for with ?interpoint=1 (or a form field), INTERPOINT if not said"""
+    value = request.args.get("interpoint") if value is None else value
+    return INTERPOINT if value is None else value == "1"
+
+
+def read_profile(value=None, default=DEFAULT_PROFILE):
+    """Layout profile asked for with ?profile=a4 (or a form field), `default` if not said"""
+    value = request.args.get("profile") if value is None else value
+    return default if value is None else get_profile(value)
+
+
+def read_line_breaking():
+    """Form field line_breaking, "none", "optimal" or "hyphenate" (see utils/line_breaking.py)"""
+    mode = request.form.get("line_breaking", LINE_BREAKING)
+    if mode not in LINE_BREAKING_MODES:
+        raise ValueError(f"line_breaking must be one of {', '.join(LINE_BREAKING_MODES)}")
+    return mode
+
+
+def dots_response(dots, estimate, line_breaks=None):
+    """Dots as binary or JSON, whichever the client accepts, with the print time estimate in headers"""
+    if wants_binary_dots():
+        if request.args.get("punched_only", "0") == "1":
+            dots = dots.punched()
+        response = Response(encode_dot_arrays(dots), mimetype=DOTS_MIMETYPE)
+    else:
+        response = jsonify(dots.to_dot_positions())
+    # Seconds the printer needs, in total (with paper changes) and per page
+    response.headers["X-Estimated-Seconds"] = f"{estimate.seconds:.1f}"
+    response.headers["X-Estimated-Page-Seconds"] = ",".join(f"{page.seconds:.1f}" for page in estimate.pages)
+    if line_breaks is not None:
+        # Pages with the layout wrapping anywhere, and with the chosen line breaking
+        response.headers["X-Pages-Before"] = str(line_breaks.pages_before)
+        response.headers["X-Pages-After"] = str(line_breaks.pages_after)
+    return response
+
+
+def conversion_rejected(e):
+    response = jsonify({"error": f"Server busy: {e}"})
+    response.headers["Retry-After"] = "5"
+    return response, 503
+
+
+@app.route('/', methods=['POST'])
+def handle_input():
+    """
+    Convert and wait for the result. Runs on the conversion queue like
+    /conversions, so it shares its admission control and process pool.
+    """
+    conversion_input = read_conversion_input()
+    if conversion_input is None:
+        return jsonify({"error": "No file or text provided"}), 400
+    try:
+        line_breaking = read_line_breaking()
+        profile = read_profile(request.form.get("profile"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        job = conversion_queue.submit(*conversion_input, line_breaking=line_breaking, profile=profile)
+    except QueueFull as e:
+        return conversion_rejected(e)
+    job.done.wait()
+    if job.status != ConversionStatus.COMPLETED:
+        return jsonify({"error": job.error or job.status.value}), 500
+    return dots_response(job.dots, job.estimate, job.line_breaks), 200
+
+
+@app.route('/conversions', methods=['POST'])
+def handle_submit_conversion():
+    """
+    Queue a conversion and return its id at once. Form field preview=1 also
+    renders the PDF preview, line_breaking picks the line breaking mode and
+    profile the paper (see GET /profiles).
+    """
+    conversion_input = read_conversion_input()
+    if conversion_input is None:
+        return jsonify({"error": "No file or text provided"}), 400
+    try:
+        line_breaking = read_line_breaking()
+        profile = read_profile(request.form.get("profile"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        job = conversion_queue.submit(*conversion_input, preview=request.form.get("preview") == "1",
+                                      line_breaking=line_breaking, profile=profile)
+    except QueueFull as e:
+        return conversion_rejected(e)
+    response = jsonify(job.to_dict())
+    response.headers["Location"] = f"/conversions/{job.id}"
+    return response, 202
+
+
+@app.route('/conversions', methods=['GET'])
+def handle_conversions_status():
+    return jsonify(conversion_queue.status()), 200
+
+
+@app.route('/conversions/<int:job_id>', methods=['GET'])
+def handle_get_conversion(job_id):
+    if job_id not in conversion_queue.jobs:
+        return jsonify({"error": "Unknown conversion"}), 404
+    return jsonify(conversion_queue.jobs[job_id].to_dict()), 200
+
+
+@app.route('/conversions/<int:job_id>', methods=['DELETE'])
+def handle_cancel_conversion(job_id):
+    if job_id not in conversion_queue.jobs:
+        return jsonify({"error": "Unknown conversion"}), 404
+    return jsonify(conversion_queue.cancel(job_id).to_dict()), 200
+
+
+def finished_conversion(job_id):
+    """The completed job, or the error response to send instead"""
+    job = conversion_queue.jobs.get(job_id)
+    if job is None:
+        return None, (jsonify({"error": "Unknown conversion"}), 404)
+    if job.status != ConversionStatus.COMPLETED:
+        return None, (jsonify(job.to_dict()), 409)
+    return job, None
+
+
+@app.route('/conversions/<int:job_id>/dots', methods=['GET'])
+def handle_conversion_dots(job_id):
+    job, error = finished_conversion(job_id)
+    if error:
+        return error
+    return dots_response(job.dots, job.estimate, job.line_breaks), 200
+
+
+@app.route('/conversions/<int:job_id>/preview', methods=['GET'])
+def handle_conversion_preview(job_id):
+    """
+    The preview PDF, rendered in the process pool unless it was made with the
+    job. Takes ?pages= and ?interpoint= like /dot_pos_to_pdf.
+    """
+    job, error = finished_conversion(job_id)
+    if error:
+        return error
+    try:
+        pages = parse_page_range(request.args.get("pages"), job.dots.num_pages)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    interpoint = wants_interpoint()
+    if pages is None and interpoint == INTERPOINT and job.pdf is not None:
+        pdf_bytes = job.pdf
+    else:
+        pdf_bytes = conversion_queue.run_cpu(render_preview, job.dots, pages, interpoint, job.profile)
+    return send_file(BytesIO(pdf_bytes), mimetype="application/pdf", as_attachment=True,
+                     download_name="braille.pdf")
 
 
 @app.route('/connect', methods=['POST'])
@@ -49,11 +255,23 @@ def handle_connect():
     global printer
     data = request.get_json()
     try:
-        printer = PrinterConnection(data["port"], data["baudRate"])
-        printer.connect()
+        profile = get_profile(data.get("profile"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    # The port can only be open once, so let go of the old connection to it first
+    if data["port"] in printer_pool.slots:
+        printer_pool.remove_printer(data["port"]).close()
+    if printer is not None and printer.port == data["port"]:
+        printer = None
+    connection = PrinterConnection(data["port"], data["baudRate"], profile)
+    connection.sd_card = data.get("sdCard", SD_CARD)
+    try:
+        connection.connect()
     except Exception as e:
-        printer.status = PrintStatus.ERROR
+        connection.close()
         return jsonify({"error": str(e)}), 500
+    printer_pool.add_printer(connection)
+    printer = connection
     return jsonify({"success": True}), 200
 
 
@@ -61,6 +279,8 @@ def handle_connect():
 def handle_disconnect():
     global printer
     if printer is not None:
+        if printer.port in printer_pool.slots:
+            printer_pool.remove_printer(printer.port)
         printer.close()
         printer = None
     return jsonify({"success": True}), 200
@@ -68,19 +288,20 @@ def handle_disconnect():
 
 @app.route('/dot_pos_to_pdf', methods=['POST'])
 def handle_dot_pos_to_pdf():
-    data = request.get_json()
-    # data["dotPositions"] can be either a list of DotPositions or list of list-of-DotPositions
-    # If you only sent the single page, it's a list of DotPositions
-    dot_positions = data["dotPositions"]
-    dot_positions = [DotPosition(**dot_dict) for dot_dict in dot_positions]
-
-    # If your 'dot_positions' is a nested list, you might need to flatten it:
-    # flatten_dot_positions = [dot for page in dot_positions for dot in page]
-    #
-    # If it's already a single list, skip flattening.
-
-    pdf = dot_pos_to_pdf(dot_positions)
-    pdf_bytes = pdf.output(dest='S').encode('latin1')
+    # data["dotPositions"] can be a list of DotPositions or a list of pages of them.
+    # ?pages=0-2,5 renders only those pages (0-based) for a quick preview.
+    # ?interpoint=1 shows each side with the punches of the other in grey.
+    # ?profile=a4 draws them on that profile's paper.
+    dots = read_dot_arrays()
+    try:
+        pages = parse_page_range(request.args.get("pages"), dots.num_pages)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        profile = read_profile()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    pdf_bytes = render_preview(dots, pages, wants_interpoint(), profile)
     return send_file(
         BytesIO(pdf_bytes),
         mimetype="application/pdf",
@@ -89,26 +310,151 @@ def handle_dot_pos_to_pdf():
     )
 
 
-@app.route('/printed_dots', methods=['POST'])
+def dots_progress(dots: PrintedDots):
+    """
+    All printed dots, or with ?since=<cursor> only the ones after it, as
+    {"cursor", "reset", "dots": [[x, y, page], ...]}. Pass the returned
+    cursor next time. "reset" means the dots were cleared and the client
+    should drop what it has.
+    """
+    if "since" not in request.args:
+        return jsonify(dots.dots)
+    events, cursor, reset = dots.since(request.args.get("since", 0, type=int))
+    return jsonify({"cursor": cursor, "reset": reset, "dots": events})
+
+
+def dots_stream(dots: PrintedDots):
+    """Server-sent events with the same payload as dots_progress, the cursor being the event id"""
+    cursor = request.headers.get("Last-Event-ID", request.args.get("since", 0, type=int), type=int)
+
+    def events(cursor):
+        while True:
+            dots.wait(cursor, SSE_KEEPALIVE)
+            new_dots, next_cursor, reset = dots.since(cursor)
+            if new_dots or reset:
+                yield f"id: {next_cursor}\ndata: {json.dumps({'reset': reset, 'dots': new_dots})}\n\n"
+            else:
+                yield ": keep-alive\n\n"
+            cursor = next_cursor
+
+    return Response(events(cursor), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.route('/printed_dots', methods=['GET', 'POST'])
 def handle_printed_dots():
-    return jsonify(printed_dots.dots), 200
+    return dots_progress(printed_dots), 200
+
+
+@app.route('/printed_dots/stream', methods=['GET'])
+def handle_printed_dots_stream():
+    return dots_stream(printed_dots)
 
 
 @app.route('/print_dots', methods=['POST'])
 def handle_print_dots():
-    data = request.get_json()
+    global print_eta
+    if printer is None:
+        return jsonify({"error": "Printer not connected"}), 400
+    slot = printer_pool.slots.get(printer.port)
+    if slot is not None and slot.state == SlotState.PRINTING:
+        return jsonify({"error": "Printer is busy with a pool job"}), 409
+    # ?interpoint=1 punches odd pages mirrored, for the back of the sheet, and
+    # pauses between pages like /print_stream, for a flip or a new sheet.
+    # ?profile= names the layout the dots were made with, the printer's if not said.
+    interpoint = wants_interpoint()
+    try:
+        profile = read_profile(default=printer.profile)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if interpoint:
+        pages = read_dot_pages()
+        print_eta = LiveEta(estimate_pages(pages, profile=profile), profile=profile)
+        print_pages(pages, printer, interpoint=True, profile=profile)
+        return jsonify({"success": True}), 200
+    key = content_key(request.mimetype, request.get_data(), PUNCH_ORDER, str(interpoint), repr(profile))
+    actions = pipeline_cache.get(key, "gcode")
+    if actions is None:
+        dot_positions = read_dot_positions()
+        actions = dot_pos_to_gcode(dot_positions, interpoint=interpoint, profile=profile)
+        pipeline_cache.put(key, "gcode", actions)
+    else:
+        printed_dots.clear()
+    print_eta = LiveEta(JobEstimate([estimate_actions(actions)]))
+    print_gcode(actions, printer)
+    return jsonify({"success": True}), 200
 
-    dot_positions = data["dotPositions"]
-    dot_positions = [DotPosition(**dot_dict) for dot_dict in dot_positions]
 
-    # convert from
-    actions = dot_pos_to_gcode(dot_positions)
-    print_gcode(actions, printer)
+@app.route('/print_stream', methods=['POST'])
+def handle_print_stream():
+    """
+    Convert and print in one go: page 1 is punched while later pages are
+    still being extracted and translated. Between pages the printer pauses
+    until /resume_print is called with a new sheet loaded. With form field
+    interpoint=1, odd pages go on the back and the pause is for a flip. Form
+    field profile picks the layout, the printer's own if not given.
+    """
+    global print_eta
+    if printer is None:
+        return jsonify({"error": "Printer not connected"}), 400
+    try:
+        line_breaking = read_line_breaking()
+        profile = read_profile(request.form.get("profile"), printer.profile)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if 'file' in request.files:
+        texts = iter_text_from_pdf(request.files['file'].read(), cache=pipeline_cache)
+    elif 'text' in request.form:
+        text = request.form['text']
+        if text.startswith('https://') and 'zoom.us' in text:
+            texts = (extract_text_from_zoom(url) for url in [text])
+        else:
+            texts = text.split('\n')
+    else:
+        return jsonify({"error": "No file or text provided"}), 400
+
+    # Pages are estimated as they are converted
+    print_eta = LiveEta(JobEstimate(), profile=profile)
+    pages = print_eta.track(iter_dots_pos_pages(iter_break_lines(iter_text_to_braille(texts), line_breaking, profile),
+                                                profile))
+    print_pages(pages, printer, interpoint=wants_interpoint(request.form.get("interpoint")), profile=profile)
     return jsonify({"success": True}), 200
 
 
+@app.route('/print_status', methods=['GET', 'POST'])
+def handle_print_status():
+    if printer is None:
+        return jsonify({"status": PrintStatus.IDLE.value}), 200
+    return jsonify({
+        "status": printer.get_status().value,
+        "pauseReason": printer.pause_reason,
+        "currentPage": printer.current_page,
+        "pagesConverted": printer.pages_converted,
+    }), 200
+
+
+@app.route('/eta', methods=['GET'])
+def handle_eta():
+    """Time left in the current print, corrected by how fast the printer acknowledges punches"""
+    if printer is None or print_eta is None:
+        return jsonify({"error": "Nothing is printing"}), 404
+    print_eta.update(printer.current_page or 0, len(printed_dots.dots))
+    eta = print_eta.to_dict()
+    eta["status"] = printer.get_status().value
+    if printer.get_status() in (PrintStatus.COMPLETED, PrintStatus.IDLE):
+        eta["etaSeconds"] = 0.0
+    return jsonify(eta), 200
+
+
 @app.route('/stop_print', methods=['POST'])
 def handle_stop_print():
+    if printer is None:
+        return jsonify({"error": "Printer not connected"}), 400
+    # A pool job streams from the pool's worker, not printer.print_thread, so
+    # it is stopped by the pool, which lifts the head once the page stops
+    job = printer_pool.cancel_on(printer.port)
+    if job is not None:
+        return jsonify({"success": True, "cancelledJob": job.id}), 200
     stop_print(printer)
     printed_dots.clear()
     return jsonify({"success": True}), 200
@@ -126,8 +472,177 @@ def handle_resume_print():
     return jsonify({"success": True}), 200
 
 
+@app.route('/metrics', methods=['GET'])
+def handle_metrics():
+    metrics = {port: slot.printer.metrics for port, slot in printer_pool.slots.items()}
+    if printer is not None:
+        metrics[printer.port] = printer.metrics
+    text = (render_prometheus(metrics) + "\n".join(pipeline_cache.render()) + "\n"
+            + "\n".join(conversion_queue.render()) + "\n")
+    return Response(text, mimetype="text/plain; version=0.0.4")
+
+
+def pool_port(port):
+    """Port as registered in the pool. URLs lose the leading '/' of device paths."""
+    for candidate in (port, "/" + port):
+        if candidate in printer_pool.slots:
+            return candidate
+    return None
+
+
+@app.route('/profiles', methods=['GET'])
+def handle_list_profiles():
+    """Layout profiles that requests and printers can pick by name"""
+    return jsonify({"default": DEFAULT_PROFILE.name,
+                    "profiles": [profile.to_dict() for profile in PROFILES.values()]}), 200
+
+
+@app.route('/printers', methods=['GET'])
+def handle_list_printers():
+    return jsonify(printer_pool.status()["printers"]), 200
+
+
+@app.route('/printers', methods=['POST'])
+def handle_add_printer():
+    data = request.get_json()
+    if data["port"] in printer_pool.slots:
+        return jsonify({"error": f"Printer {data['port']} is already in the pool"}), 409
+    try:
+        profile = get_profile(data.get("profile"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    pool_printer = PrinterConnection(data["port"], data["baudRate"], profile)
+    pool_printer.sd_card = data.get("sdCard", SD_CARD)
+    try:
+        pool_printer.connect()
+    except Exception as e:
+        pool_printer.close()
+        return jsonify({"error": str(e)}), 500
+    slot = printer_pool.add_printer(pool_printer, data.get("paperLoaded", True))
+    return jsonify(slot.to_dict()), 200
+
+
+@app.route('/printers/<path:port>', methods=['DELETE'])
+def handle_remove_printer(port):
+    global printer
+    port = pool_port(port)
+    if port is None:
+        return jsonify({"error": "Unknown printer"}), 404
+    printer_pool.remove_printer(port).close()
+    if printer is not None and printer.port == port:
+        printer = None
+    return jsonify({"success": True}), 200
+
+
+@app.route('/printers/<path:port>/paper', methods=['POST'])
+def handle_paper_loaded(port):
+    """Tell the pool a printer has a fresh sheet, or its sheet turned over, and can take the next page"""
+    port = pool_port(port)
+    if port is None:
+        return jsonify({"error": "Unknown printer"}), 404
+    printer_pool.paper_loaded(port)
+    return jsonify(printer_pool.slots[port].to_dict()), 200
+
+
+@app.route('/printers/<path:port>/pause', methods=['POST'])
+def handle_pause_printer(port):
+    port = pool_port(port)
+    if port is None:
+        return jsonify({"error": "Unknown printer"}), 404
+    pause_print(printer_pool.get_printer(port))
+    return jsonify({"success": True}), 200
+
+
+@app.route('/printers/<path:port>/resume', methods=['POST'])
+def handle_resume_printer(port):
+    port = pool_port(port)
+    if port is None:
+        return jsonify({"error": "Unknown printer"}), 404
+    resume_print(printer_pool.get_printer(port))
+    return jsonify({"success": True}), 200
+
+
+@app.route('/jobs', methods=['POST'])
+def handle_submit_job():
+    """
+    Queue dot positions on the printer pool. With ?split=pages every page can
+    go to a different printer, otherwise one printer prints the whole document.
+    ?profile= names the layout the dots were made with, only printers with
+    that profile take the job. With ?interpoint=1, odd pages go on the back:
+    the printer waits for the sheet to be flipped and prints both sides.
+    """
+    split_pages = request.args.get("split", "document") == "pages"
+    try:
+        profile = read_profile()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    job = printer_pool.submit(read_dot_pages(), split_pages, profile, interpoint=wants_interpoint())
+    return jsonify(job.to_dict()), 200
+
+
+@app.route('/jobs', methods=['GET'])
+def handle_list_jobs():
+    return jsonify([job.to_dict() for job in printer_pool.jobs.values()]), 200
+
+
+@app.route('/jobs/<int:job_id>', methods=['GET'])
+def handle_job_status(job_id):
+    if job_id not in printer_pool.jobs:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(printer_pool.jobs[job_id].to_dict()), 200
+
+
+@app.route('/jobs/<int:job_id>', methods=['DELETE'])
+def handle_cancel_job(job_id):
+    if job_id not in printer_pool.jobs:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(printer_pool.cancel(job_id).to_dict()), 200
+
+
+@app.route('/jobs/<int:job_id>/resume', methods=['POST'])
+def handle_resume_job(job_id):
+    """
+    Continue an interrupted or failed job from its last acknowledged punch.
+    Pass the port of the printer still holding a half punched sheet.
+    """
+    if job_id not in printer_pool.jobs:
+        return jsonify({"error": "Unknown job"}), 404
+    port = (request.get_json(silent=True) or {}).get("port")
+    try:
+        job = printer_pool.resume(job_id, port)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 409
+    return jsonify(job.to_dict()), 200
+
+
+@app.route('/jobs/<int:job_id>/printed_dots', methods=['GET', 'POST'])
+def handle_job_printed_dots(job_id):
+    if job_id not in printer_pool.jobs:
+        return jsonify({"error": "Unknown job"}), 404
+    return dots_progress(printer_pool.jobs[job_id].printed_dots), 200
+
+
+@app.route('/jobs/<int:job_id>/printed_dots/stream', methods=['GET'])
+def handle_job_printed_dots_stream(job_id):
+    if job_id not in printer_pool.jobs:
+        return jsonify({"error": "Unknown job"}), 404
+    return dots_stream(printer_pool.jobs[job_id].printed_dots)
+
+
+@app.route('/pool', methods=['GET'])
+def handle_pool_status():
+    return jsonify(printer_pool.status()), 200
+
+
 def cleanup():
     global printer
+    for port in list(printer_pool.slots):
+        try:
+            printer_pool.remove_printer(port).close()
+        except Exception as e:
+            print(f"Error disconnecting printer {port}: {e}")
+    printer_pool.close()
+    conversion_queue.close()
     if printer is not None:
         try:
             printer.close()
@@ -138,5 +653,69 @@ def cleanup():
 
 atexit.register(cleanup)
 
+
+def _wait_for_print(timeout: float = 60):
+    """Resume every pause for paper until the current print is over"""
+    deadline = time.monotonic() + timeout
+    while printer.print_thread.is_alive():
+        assert time.monotonic() < deadline, "Print did not finish"
+        if printer.pause_reason:
+            resume_print(printer)
+        time.sleep(0.01)
+
+
+def test_eta_after_print_stream():
+    """Test function to verify /eta of a /print_dots job does not use the page of an earlier /print_stream"""
+    from utils.virtual_printer import VirtualPrinter
+    client = app.test_client()
+    with VirtualPrinter(move_time=0, punch_time=0, latency=0) as virtual:
+        assert client.post('/connect', json={"port": virtual.port, "baudRate": virtual.baud_rate}).status_code == 200
+        try:
+            assert client.post('/print_stream', data={"text": "hello world " * 40}).status_code == 200
+            _wait_for_print()
+            assert printer.current_page > 0
+
+            # Slow enough to still be punching when /eta is asked
+            virtual.punch_time = 0.05
+            dots = [{"x": 10.0 + 2.5 * i, "y": 20.0, "punch": True, "page": 0} for i in range(20)]
+            assert client.post('/print_dots', json={"dotPositions": dots}).status_code == 200
+            eta = client.get('/eta').get_json()
+            assert eta["numPages"] == 1 and eta["page"] == 0
+            assert eta["etaSeconds"] > 0
+            stop_print(printer)
+        finally:
+            client.post('/disconnect')
+
+
+def test_stop_print_cancels_pool_job():
+    """Test function to verify /stop_print stops a pool job through the pool, not under its worker"""
+    from utils.printer_pool import JobStatus
+    from utils.virtual_printer import VirtualPrinter
+    client = app.test_client()
+    with VirtualPrinter(move_time=0, punch_time=0.02, latency=0, keep_log=True) as virtual:
+        assert client.post('/connect', json={"port": virtual.port, "baudRate": virtual.baud_rate}).status_code == 200
+        try:
+            dots = [{"x": 10.0 + 2.5 * i, "y": 20.0, "punch": True, "page": 0} for i in range(200)]
+            job = printer_pool.jobs[client.post('/jobs', json={"dotPositions": dots}).get_json()["id"]]
+            slot = printer_pool.slots[virtual.port]
+            deadline = time.monotonic() + 10
+            while not job.printed_dots.dots:
+                assert time.monotonic() < deadline, "Pool job did not start"
+                time.sleep(0.01)
+            reply = client.post('/stop_print').get_json()
+            assert reply["cancelledJob"] == job.id
+            while slot.job is not None:
+                assert time.monotonic() < deadline, "Pool worker did not stop"
+                time.sleep(0.01)
+            assert job.status == JobStatus.CANCELLED
+            assert len(job.printed_dots.dots) < len(dots)
+            assert not printer._stop_event.is_set()
+            # The head was lifted once, by the worker after its last punch
+            assert virtual.log[-3:] == ["G1 Z10 F800", "G28 X0 Y0", "G1 Z10 F800"]
+        finally:
+            client.post('/disconnect')
+
+
 if __name__ == '__main__':
     app.run(port=6969, debug=True)
+
@@ -1,53 +1,119 @@
+from collections import deque
 from dataclasses import dataclass
-from typing import List, Tuple
+from typing import Iterable, Iterator, List, Tuple
+import threading
 import fpdf
 
 from utils.text_to_braille import text_to_braille
+from utils.path_planning import STRATEGIES, plan_punch_order
+from utils.layout_profile import DEFAULT_PROFILE, LayoutProfile
 
-# Constants
-MM_PER_UNIT = 1.5 # change for font
+# Page geometry comes from a LayoutProfile (utils/layout_profile.py), so
+# printers with different paper can share a server. These are the default
+# profile's values, for code that does not take a profile.
+MM_PER_UNIT = DEFAULT_PROFILE.mm_per_unit
 # Diameter of one dot is 1 unit
-DIST_DIAM_DOT = 1
-DIST_BETWEEN_DOTS = 1
+DIST_DIAM_DOT = DEFAULT_PROFILE.dist_diam_dot
+DIST_BETWEEN_DOTS = DEFAULT_PROFILE.dist_between_dots
 
-CHAR_HEIGHT = 3 * DIST_DIAM_DOT + 2 * DIST_BETWEEN_DOTS
-CHAR_WIDTH = 2 * DIST_DIAM_DOT + DIST_BETWEEN_DOTS
+CHAR_HEIGHT = DEFAULT_PROFILE.char_height
+CHAR_WIDTH = DEFAULT_PROFILE.char_width
 PUNCH_AMOUNT = 2
 
-COLUMN_WIDTH = 3
-ROW_HEIGHT = 4
+COLUMN_WIDTH = DEFAULT_PROFILE.column_width
+ROW_HEIGHT = DEFAULT_PROFILE.row_height
 
-PAPER_WIDTH = 215.9 / MM_PER_UNIT
-PAPER_HEIGHT = 279.4 / MM_PER_UNIT
+PAPER_WIDTH = DEFAULT_PROFILE.paper_width
+PAPER_HEIGHT = DEFAULT_PROFILE.paper_height
 
-LEFT_MARGIN_WIDTH = 25 / MM_PER_UNIT
-RIGHT_MARGIN_WIDTH = 25 / MM_PER_UNIT
-TOP_MARGIN_HEIGHT = 25 / MM_PER_UNIT
-BOTTOM_MARGIN_HEIGHT = 25 / MM_PER_UNIT
+LEFT_MARGIN_WIDTH = DEFAULT_PROFILE.left_margin_width
+RIGHT_MARGIN_WIDTH = DEFAULT_PROFILE.right_margin_width
+TOP_MARGIN_HEIGHT = DEFAULT_PROFILE.top_margin_height
+BOTTOM_MARGIN_HEIGHT = DEFAULT_PROFILE.bottom_margin_height
 
 # Offset of the page's origin relative to the printer's origin
-LEFT_OFFSET = 23
-TOP_OFFSET = 30
+LEFT_OFFSET = DEFAULT_PROFILE.left_offset
+TOP_OFFSET = DEFAULT_PROFILE.top_offset
 
 SPEED_LATERAL = 4000 # 4000
 SPEED_PUNCH = 800
 
-NUM_BRAILLE_PER_ROW = int((PAPER_WIDTH - LEFT_MARGIN_WIDTH - RIGHT_MARGIN_WIDTH - CHAR_WIDTH) / (CHAR_WIDTH + COLUMN_WIDTH)) + 1
-NUM_BRAILLE_PER_COL = int((PAPER_HEIGHT - TOP_MARGIN_HEIGHT - BOTTOM_MARGIN_HEIGHT - CHAR_HEIGHT) / (CHAR_HEIGHT + ROW_HEIGHT)) + 1
-ACTUAL_COL_WIDTH = (PAPER_WIDTH - LEFT_MARGIN_WIDTH - RIGHT_MARGIN_WIDTH - CHAR_WIDTH * NUM_BRAILLE_PER_ROW) / (NUM_BRAILLE_PER_ROW -1)
-ACTUAL_ROW_HEIGHT = (PAPER_HEIGHT - TOP_MARGIN_HEIGHT - BOTTOM_MARGIN_HEIGHT - CHAR_HEIGHT * NUM_BRAILLE_PER_COL) / (NUM_BRAILLE_PER_COL -1)
+# Order punches are sent in, see utils/path_planning.py
+PUNCH_ORDER = "serpentine"
+
+# Interpoint: odd pages go on the back of the sheet before them. The back is
+# punched with the sheet flipped, so its layout is mirrored, and shifted by
+# half the dot pitch (LayoutProfile.interpoint_offset) so its dots fall
+# between the front's.
+INTERPOINT = False
+INTERPOINT_OFFSET = DEFAULT_PROFILE.interpoint_offset
+# Grey level (0-255) of dots from the other side in interpoint previews
+GHOST_GREY = 190
+
+NUM_BRAILLE_PER_ROW = DEFAULT_PROFILE.num_braille_per_row
+NUM_BRAILLE_PER_COL = DEFAULT_PROFILE.num_braille_per_col
+ACTUAL_COL_WIDTH = DEFAULT_PROFILE.actual_col_width
+ACTUAL_ROW_HEIGHT = DEFAULT_PROFILE.actual_row_height
+
+# Progress events kept for clients following printed dots with a cursor
+PROGRESS_RING_SIZE = 4096
 
 DEBUG = False
 
 class PrintedDots:
-    def __init__(self):
+    """
+    Punched dots in the order the printer acknowledged them. Every append is
+    also numbered and kept as a compact (x, y, page) event in a ring buffer,
+    so clients can ask for the dots after a cursor instead of all of them.
+    """
+    def __init__(self, ring_size: int = PROGRESS_RING_SIZE):
         self.dots = []
+        self.events = deque(maxlen=ring_size)  # (sequence, x, y, page)
+        self.sequence = 0  # number the next dot gets
+        self.cleared_at = 0  # sequence of the first dot since the last clear()
+        self._changed = threading.Condition()
 
     def clear(self):
-        self.dots = []
+        with self._changed:
+            self.dots = []
+            # Skip a number, so every cursor from before the clear is out of date
+            self.sequence += 1
+            self.cleared_at = self.sequence
+            self._changed.notify_all()
 
     def append(self, dot):
-        self.dots.append(dot)
+        with self._changed:
+            self.dots.append(dot)
+            self.events.append((self.sequence, dot.x, dot.y, dot.page))
+            self.sequence += 1
+            self._changed.notify_all()
+
+    def since(self, cursor: int) -> Tuple[List[Tuple[float, float, int]], int, bool]:
+        """
+        Dots acknowledged after `cursor` (0 or the cursor returned last time)
+        as (x, y, page), the next cursor, and whether the client has to start
+        over because the dots were cleared since.
+        """
+        with self._changed:
+            reset = not self.cleared_at <= cursor <= self.sequence
+            if reset:
+                cursor = self.cleared_at
+            if self.events and self.events[0][0] > cursor:
+                # Fell behind the ring, read the full list
+                return [(dot.x, dot.y, dot.page) for dot in self.dots[cursor - self.cleared_at:]], self.sequence, reset
+            # Newest events are at the end, and numbers skip at clears
+            events = []
+            for event in reversed(self.events):
+                if event[0] < cursor:
+                    break
+                events.append(event[1:])
+            events.reverse()
+            return events, self.sequence, reset
+
+    def wait(self, cursor: int, timeout: float) -> bool:
+        """Block until there is something after `cursor`, False on timeout"""
+        with self._changed:
+            return self._changed.wait_for(lambda: self.sequence != cursor, timeout)
 
 printed_dots = PrintedDots()
 
@@ -64,6 +130,32 @@ class DotPosition:
     def copy(self):
         return DotPosition(self.x, self.y, self.punch, self.page)
 
+
+def is_back(page):
+    """Whether an interpoint page goes on the back of its sheet"""
+    return page % 2 == 1
+
+
+def mirror_x(x, profile: LayoutProfile = DEFAULT_PROFILE):
+    """x of a dot seen from the other side of the sheet, shifted by the interpoint offset"""
+    return (profile.paper_width - profile.dist_diam_dot + profile.interpoint_offset) * profile.mm_per_unit - x
+
+
+def sheet_position(dot: DotPosition, profile: LayoutProfile = DEFAULT_PROFILE) -> DotPosition:
+    """Where an interpoint dot is punched: as laid out on the front, mirrored and shifted on the back"""
+    if not is_back(dot.page):
+        return dot
+    return DotPosition(mirror_x(dot.x, profile), dot.y + profile.interpoint_offset * profile.mm_per_unit,
+                       dot.punch, dot.page)
+
+
+def ghost_position(x, y, page, profile: LayoutProfile = DEFAULT_PROFILE):
+    """
+    Where a dot of `page` shows through on the other side of its sheet, in
+    that side's layout coordinates. Works on floats and on arrays.
+    """
+    return mirror_x(x, profile), y + profile.interpoint_offset * profile.mm_per_unit * (2 * (page % 2) - 1)
+
 @dataclass 
 class DotRelativeLocation:
     """
@@ -99,57 +191,76 @@ class BrailleChar:
         return locations
 
 class GcodeAction:
-    def __init__(self, command: str, dot: DotPosition = None) -> None:
+    def __init__(self, command: str, dot: DotPosition = None, sink: PrintedDots = None) -> None:
         self.command = command
-        self.dot = dot.copy() if dot else None
+        self.dot = dot  # shared with the layout, not copied
+        self.sink = sink  # where punched dots are recorded, printed_dots if None
 
     def callback(self):
         if self.dot:
-            printed_dots.append(self.dot)
+            (self.sink or printed_dots).append(self.dot)
 
     def __str__(self) -> str:
         return self.command
 
-def get_dots_pos_and_page(braille_str: str) -> List[List[DotPosition]]:
-    """Get dot positions for each page"""
-    pages = [[]]
-    x = LEFT_MARGIN_WIDTH * MM_PER_UNIT
-    y = TOP_MARGIN_HEIGHT * MM_PER_UNIT
+def iter_dots_pos_pages(braille_chunks: Iterable[str], profile: LayoutProfile = DEFAULT_PROFILE) -> Iterator[List[DotPosition]]:
+    """
+    Get dot positions for each page, yielding every page as soon as it is full.
+    The chunks are laid out as if they were one string, so pages can be printed
+    while later chunks are still being converted.
+    """
+    mm = profile.mm_per_unit
+    patterns = profile.pattern_dots
+    left = profile.left_margin_width * mm
+    top = profile.top_margin_height * mm
+    line_end = (profile.paper_width - profile.right_margin_width) * mm
+    page_end = (profile.paper_height - profile.bottom_margin_height) * mm
+    char_width = profile.char_width * mm
+    char_height = profile.char_height * mm
+
+    page = []
+    x = left
+    y = top
     current_page = 0
     
     def new_line(x: float, y: float) -> Tuple[float, float]:
-        x = LEFT_MARGIN_WIDTH * MM_PER_UNIT
-        y += (CHAR_HEIGHT + ACTUAL_ROW_HEIGHT) * MM_PER_UNIT
+        x = left
+        y += (profile.char_height + profile.actual_row_height) * mm
         return x, y
 
-    for char in braille_str:
-        if char == '\n':
-            x, y = new_line(x, y)
-            continue
-            
-        char = BrailleChar(char)
-        locations = char.get_dot_rel_loc()
-
-        if x + CHAR_WIDTH * MM_PER_UNIT - DIST_DIAM_DOT > (PAPER_WIDTH - RIGHT_MARGIN_WIDTH) * MM_PER_UNIT:
-            x, y = new_line(x, y)
-        if y + CHAR_HEIGHT * MM_PER_UNIT - DIST_DIAM_DOT > (PAPER_HEIGHT - BOTTOM_MARGIN_HEIGHT) * MM_PER_UNIT:
-            current_page += 1
-            pages.append([])
-            x = LEFT_MARGIN_WIDTH * MM_PER_UNIT
-            y = TOP_MARGIN_HEIGHT * MM_PER_UNIT
-        
-        for loc in locations:
-            abs_x = x + loc.x * MM_PER_UNIT
-            abs_y = y + loc.y * MM_PER_UNIT
-            pages[current_page].append(DotPosition(abs_x, abs_y, loc.punch, current_page))
-            
-        x += (CHAR_WIDTH + ACTUAL_COL_WIDTH) * MM_PER_UNIT
-                      
-    return pages
+    for braille_str in braille_chunks:
+        for char in braille_str:
+            if char == '\n':
+                x, y = new_line(x, y)
+                continue
+
+            if x + char_width - profile.dist_diam_dot > line_end:
+                x, y = new_line(x, y)
+            if y + char_height - profile.dist_diam_dot > page_end:
+                yield page
+                current_page += 1
+                page = []
+                x = left
+                y = top
+
+            for dx, dy, punch in patterns[(ord(char) - 0x2800) & 0x3F]:
+                page.append(DotPosition(x + dx, y + dy, punch, current_page))
+
+            x += (profile.char_width + profile.actual_col_width) * mm
 
-def dot_pos_to_pdf(dot_positions: List[DotPosition]) -> fpdf.FPDF:
-    """Convert dot positions to PDF"""
-    pdf = fpdf.FPDF('P', 'mm', 'Letter')
+    yield page
+
+def get_dots_pos_and_page(braille_str: str, profile: LayoutProfile = DEFAULT_PROFILE) -> List[List[DotPosition]]:
+    """Get dot positions for each page"""
+    return list(iter_dots_pos_pages([braille_str], profile))
+
+def dot_pos_to_pdf(dot_positions: List[DotPosition], interpoint: bool = INTERPOINT,
+                   profile: LayoutProfile = DEFAULT_PROFILE) -> fpdf.FPDF:
+    """Convert dot positions to PDF. With interpoint, each side shows the other side's punches in grey."""
+    if interpoint:
+        return _interpoint_pdf(dot_positions, profile)
+    pdf = fpdf.FPDF('P', 'mm', profile.page_format)
+    size = profile.dist_diam_dot * profile.mm_per_unit
     
     current_page = -1
     for dot in dot_positions:
@@ -158,31 +269,87 @@ def dot_pos_to_pdf(dot_positions: List[DotPosition]) -> fpdf.FPDF:
             current_page = dot.page
             
         if dot.punch:
-            pdf.ellipse(dot.x, dot.y,
-                       DIST_DIAM_DOT * MM_PER_UNIT, 
-                       DIST_DIAM_DOT * MM_PER_UNIT, 'F')
+            pdf.ellipse(dot.x, dot.y, size, size, 'F')
         else:
-            pdf.ellipse(dot.x, dot.y,
-                       DIST_DIAM_DOT * MM_PER_UNIT,
-                       DIST_DIAM_DOT * MM_PER_UNIT, 'D')
+            pdf.ellipse(dot.x, dot.y, size, size, 'D')
     return pdf
 
 
-def dot_pos_to_gcode(dot_positions: List[DotPosition]) -> List[GcodeAction]:
-    """Convert dot positions to GCODE commands"""
-    actions = []
-    printed_dots.clear()
+def _interpoint_pdf(dot_positions: List[DotPosition], profile: LayoutProfile = DEFAULT_PROFILE) -> fpdf.FPDF:
+    pdf = fpdf.FPDF('P', 'mm', profile.page_format)
+    pages = {}
     for dot in dot_positions:
-        if dot.punch:
-            actions.append(GcodeAction("G1 X{} Y{} F{}".format(
-                dot.x + LEFT_OFFSET,
-                dot.y + TOP_OFFSET,
-                SPEED_LATERAL
-            )))
-            actions.append(GcodeAction("G1 E{} F{}".format(PUNCH_AMOUNT, SPEED_PUNCH), dot))
+        pages.setdefault(dot.page, []).append(dot)
+
+    size = profile.dist_diam_dot * profile.mm_per_unit
+    for page in sorted(pages):
+        pdf.add_page()
+        pdf.set_draw_color(GHOST_GREY)
+        for dot in pages.get(page ^ 1, []):
+            if dot.punch:
+                x, y = ghost_position(dot.x, dot.y, dot.page, profile)
+                pdf.ellipse(x, y, size, size, 'D')
+        pdf.set_draw_color(0)
+        for dot in pages[page]:
+            pdf.ellipse(dot.x, dot.y, size, size, 'F' if dot.punch else 'D')
+    return pdf
+
+
+def dot_pos_to_gcode(dot_positions: List[DotPosition], punch_order: str = PUNCH_ORDER,
+                     sink: PrintedDots = None, interpoint: bool = INTERPOINT,
+                     profile: LayoutProfile = DEFAULT_PROFILE) -> List[GcodeAction]:
+    """
+    Convert dot positions to GCODE commands, punching in the given order.
+    Punched dots are recorded in `sink`, or the shared printed_dots if None.
+    With interpoint, dots of back pages are punched at their sheet_position
+    but recorded as laid out. The profile gives the page's offset on the printer.
+    """
+    actions = []
+    if sink is None:
+        printed_dots.clear()
+    punched = [dot for dot in dot_positions if dot.punch]
+    if interpoint:
+        sheet_dots = [sheet_position(dot, profile) for dot in punched]
+        laid_out = {id(sheet_dot): dot for sheet_dot, dot in zip(sheet_dots, punched)}
+        punched = sheet_dots
+    # Plan each page on its own, in page order, so dots of different sheets
+    # are never mixed. The first page starts from the home position (after
+    # G28), later ones from where the page before ended, in page coordinates.
+    pages = {}
+    for dot in punched:
+        pages.setdefault(dot.page, []).append(dot)
+    punched = []
+    start = (-profile.left_offset, -profile.top_offset)
+    for page in sorted(pages):
+        ordered, report = plan_punch_order(pages[page], punch_order, start=start)
+        if DEBUG:
+            print(f"DEBUG: page {page} punch order {report}")
+        punched += ordered
+        start = (ordered[-1].x, ordered[-1].y)
+    for dot in punched:
+        actions.append(GcodeAction("G1 X{} Y{} F{}".format(
+            dot.x + profile.left_offset,
+            dot.y + profile.top_offset,
+            SPEED_LATERAL
+        )))
+        actions.append(GcodeAction("G1 E{} F{}".format(PUNCH_AMOUNT, SPEED_PUNCH),
+                                   laid_out[id(dot)] if interpoint else dot, sink))
     return actions
 
 
+def test_dot_pos_to_gcode_page_order():
+    """Test function to verify multi-page input is punched page by page"""
+    pages = get_dots_pos_and_page(text_to_braille("hello world " * 200))
+    assert len(pages) > 1
+    actions = dot_pos_to_gcode([dot for page in pages for dot in page], sink=PrintedDots())
+    punched_pages = [action.dot.page for action in actions if action.dot]
+    assert punched_pages == sorted(punched_pages), "Pages are mixed in the punch sequence"
+    assert punched_pages == [dot.page for page in pages for dot in page if dot.punch]
+    # The first page starts from home, like a page sent on its own
+    first = [str(action) for action in dot_pos_to_gcode(pages[0], sink=PrintedDots())]
+    assert [str(action) for action in actions[:len(first)]] == first
+
+
 if __name__ == "__main__":
     hello_braille = text_to_braille("Wishing you a day filled with inspiration, creativity, and success!\nWhatever you're working on, know that your ideas have the power to make a difference. Keep pushing forward, stay curious, and never stop innovating.")
     dot_positions = get_dots_pos_and_page(hello_braille)
@@ -191,6 +358,12 @@ if __name__ == "__main__":
     pdf = dot_pos_to_pdf([dot for page in dot_positions for dot in page])
     pdf.output("test_output.pdf")
     
+    # Compare punch orders
+    for strategy in STRATEGIES:
+        for page in dot_positions:
+            _, report = plan_punch_order([dot for dot in page if dot.punch], strategy, start=(-LEFT_OFFSET, -TOP_OFFSET))
+            print(report)
+
     # Generate GCODE
     for page in dot_positions:
         for action in dot_pos_to_gcode(page):
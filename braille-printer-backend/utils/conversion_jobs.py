@@ -0,0 +1,364 @@
+from collections import deque
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Callable, Dict, List, Optional, Union
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+from utils import pdf_extraction
+from utils.braille_to_gcode import INTERPOINT, PUNCH_ORDER
+from utils.fast_layout import DotArrays, get_dots_arrays
+from utils.layout_profile import DEFAULT_PROFILE, LayoutProfile
+from utils.line_breaking import LINE_BREAKING, MODES, LineBreakStats, optimize_line_breaks
+from utils.pdf_preview import render_preview
+from utils.pipeline_cache import PipelineCache, content_key
+from utils.print_time import JobEstimate, estimate_pages
+from utils.text_to_braille import text_to_braille
+
+logger = logging.getLogger(__name__)
+
+DEBUG = False
+
+# Threads for the I/O-bound stages: PDF extraction with its LLM calls, Zoom scraping
+IO_WORKERS = int(os.getenv("BRAILLE_IO_WORKERS", "4"))
+# Processes for the CPU-bound stages: translation, layout, estimate, preview
+CPU_WORKERS = int(os.getenv("BRAILLE_CPU_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Jobs allowed to wait for a thread before new ones are turned away
+MAX_QUEUED = 16
+# Finished jobs kept for polling, the oldest are dropped first
+MAX_FINISHED = 100
+# Seconds between checks for cancellation while a stage runs in a process
+CANCEL_POLL = 0.1
+
+
+class ConversionStatus(Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+class QueueFull(Exception):
+    """Raised by ConversionQueue.submit when MAX_QUEUED jobs are already waiting"""
+
+
+class Cancelled(Exception):
+    pass
+
+
+@dataclass
+class ConversionJob:
+    """A document being turned into dots: text, a PDF or a Zoom recording"""
+    id: int
+    source: str  # "text", "pdf" or "zoom"
+    data: Union[str, bytes] = field(repr=False)  # the text, PDF bytes or Zoom URL
+    key: str  # pipeline cache key of the input
+    preview: bool = False  # also render the preview PDF
+    line_breaking: str = LINE_BREAKING  # see utils/line_breaking.py
+    profile: LayoutProfile = DEFAULT_PROFILE  # paper the dots are laid out for
+    status: ConversionStatus = ConversionStatus.QUEUED
+    stage: Optional[str] = None
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    dots: Optional[DotArrays] = field(default=None, repr=False)
+    estimate: Optional[JobEstimate] = field(default=None, repr=False)
+    pdf: Optional[bytes] = field(default=None, repr=False)
+    line_breaks: Optional[LineBreakStats] = None
+    cancelled: threading.Event = field(default_factory=threading.Event, repr=False)
+    done: threading.Event = field(default_factory=threading.Event, repr=False)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "source": self.source,
+            "status": self.status.value,
+            "stage": self.stage,
+            "numPages": self.dots.num_pages if self.dots is not None else None,
+            "estimatedSeconds": self.estimate.seconds if self.estimate else None,
+            "preview": self.pdf is not None,
+            "lineBreaks": self.line_breaks.to_dict() if self.line_breaks else None,
+            "profile": self.profile.name,
+            "error": self.error,
+            "createdAt": self.created_at,
+            "startedAt": self.started_at,
+            "finishedAt": self.finished_at,
+        }
+
+
+def extract_transcript(source: str, data: Union[str, bytes], cache: Optional[PipelineCache] = None) -> str:
+    if source == "pdf":
+        return pdf_extraction.extract_text_from_pdf(data, cache=cache)
+    if source == "zoom":
+        return pdf_extraction.extract_text_from_zoom(data)
+    return data
+
+
+def layout_transcript(transcript: str, line_breaking: str = LINE_BREAKING, profile: LayoutProfile = DEFAULT_PROFILE,
+                      braille: Optional[str] = None):
+    """
+    Translation, line breaking, layout and estimate in one go, so the dots
+    cross the process boundary once. The translation is skipped if `braille`
+    is given.
+    """
+    if braille is None:
+        braille = text_to_braille(transcript)
+    broken, line_breaks = optimize_line_breaks(braille, line_breaking, profile)
+    dots = get_dots_arrays(broken, profile=profile)
+    return braille, line_breaks, dots, estimate_pages(dots.to_dot_positions(), profile=profile)
+
+
+def estimate_dots(dots: DotArrays, profile: LayoutProfile = DEFAULT_PROFILE) -> JobEstimate:
+    return estimate_pages(dots.to_dot_positions(), profile=profile)
+
+
+def layout_key(key: str, line_breaking: str = "none", profile: LayoutProfile = DEFAULT_PROFILE) -> str:
+    """Pipeline cache key of the layout of input `key`. The braille is the same for every layout."""
+    if line_breaking != "none":
+        key = content_key(key, line_breaking)
+    if profile != DEFAULT_PROFILE:
+        key = content_key(key, repr(profile))
+    return key
+
+
+class ConversionQueue:
+    """
+    Runs conversions off the request thread. `io_workers` threads take
+    queued jobs and run the I/O-bound transcript stage themselves, then hand
+    translation, layout and rendering to a pool of `cpu_workers` processes.
+    At most `max_queued` jobs wait, submit() raises QueueFull beyond that.
+    Stage outputs go through the pipeline cache under the same keys as the
+    synchronous endpoint, so both share work.
+    """
+
+    def __init__(self, cache: PipelineCache, io_workers: int = IO_WORKERS, cpu_workers: int = CPU_WORKERS,
+                 max_queued: int = MAX_QUEUED, max_finished: int = MAX_FINISHED):
+        self.cache = cache
+        self.io_workers = io_workers
+        self.cpu_workers = cpu_workers
+        self.max_queued = max_queued
+        self.max_finished = max_finished
+        self.jobs: Dict[int, ConversionJob] = {}
+        self.rejected = 0
+        self.finished = {status: 0 for status in ConversionStatus}
+        self._queued = deque()
+        self._finished_ids = deque()
+        self._running = 0
+        self._ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self._closed = False
+        self._threads: List[threading.Thread] = []
+        self._processes = None
+        self._processes_lock = threading.Lock()
+
+    def submit(self, source: str, data: Union[str, bytes], key: str, preview: bool = False,
+               line_breaking: str = LINE_BREAKING, profile: LayoutProfile = DEFAULT_PROFILE) -> ConversionJob:
+        if line_breaking not in MODES:
+            raise ValueError(f"Invalid line breaking mode: {line_breaking}")
+        with self._cond:
+            if len(self._queued) >= self.max_queued:
+                self.rejected += 1
+                raise QueueFull(f"{len(self._queued)} conversions are already waiting")
+            job = ConversionJob(next(self._ids), source, data, key, preview, line_breaking, profile)
+            self.jobs[job.id] = job
+            self._queued.append(job)
+            self._start_threads()
+            self._cond.notify()
+        return job
+
+    def cancel(self, job_id: int) -> ConversionJob:
+        """Stop a job. A running stage in a thread finishes first, but its result is dropped."""
+        with self._cond:
+            job = self.jobs[job_id]
+            if job.status in (ConversionStatus.QUEUED, ConversionStatus.RUNNING):
+                job.cancelled.set()
+                self._queued = deque(queued for queued in self._queued if queued is not job)
+                self._finish(job, ConversionStatus.CANCELLED)
+        return job
+
+    def run_cpu(self, function: Callable, *args):
+        """Run `function` in the process pool and wait for it"""
+        return self._pool().submit(function, *args).result()
+
+    def status(self) -> dict:
+        with self._cond:
+            return {
+                "queued": len(self._queued),
+                "running": self._running,
+                "maxQueued": self.max_queued,
+                "ioWorkers": self.io_workers,
+                "cpuWorkers": self.cpu_workers,
+                "rejected": self.rejected,
+                "finished": {status.value: count for status, count in self.finished.items()
+                             if status not in (ConversionStatus.QUEUED, ConversionStatus.RUNNING)},
+            }
+
+    def render(self, name: str = "braille_conversions") -> List[str]:
+        """Queue depth and outcomes in the Prometheus text format"""
+        status = self.status()
+        lines = [f"# TYPE {name}_queue_depth gauge", f"{name}_queue_depth {status['queued']}",
+                 f"# TYPE {name}_running gauge", f"{name}_running {status['running']}",
+                 f"# TYPE {name}_rejected_total counter", f"{name}_rejected_total {status['rejected']}",
+                 f"# TYPE {name}_total counter"]
+        lines += [f'{name}_total{{status="{status}"}} {count}' for status, count in status["finished"].items()]
+        return lines
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            for job in list(self.jobs.values()):
+                if job.status in (ConversionStatus.QUEUED, ConversionStatus.RUNNING):
+                    job.cancelled.set()
+                    self._finish(job, ConversionStatus.CANCELLED)
+            self._queued.clear()
+            self._cond.notify_all()
+        with self._processes_lock:
+            if self._processes is not None:
+                self._processes.shutdown(wait=False, cancel_futures=True)
+                self._processes = None
+
+    # Workers
+
+    def _start_threads(self):
+        while len(self._threads) < self.io_workers:
+            thread = threading.Thread(target=self._worker, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _pool(self) -> ProcessPoolExecutor:
+        # Spawned rather than forked: the server has threads, and a fork could copy held locks
+        with self._processes_lock:
+            if self._processes is None:
+                self._processes = ProcessPoolExecutor(self.cpu_workers, multiprocessing.get_context("spawn"))
+            return self._processes
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._queued and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                job = self._queued.popleft()
+                job.status = ConversionStatus.RUNNING
+                job.started_at = time.time()
+                self._running += 1
+            try:
+                self._run(job)
+                with self._cond:
+                    self._finish(job, ConversionStatus.COMPLETED)
+            except Cancelled:
+                pass
+            except Exception as e:
+                logger.exception("Conversion %s failed: %s", job.id, e)
+                with self._cond:
+                    self._finish(job, ConversionStatus.FAILED, str(e))
+            finally:
+                with self._cond:
+                    self._running -= 1
+
+    def _stage(self, job: ConversionJob, stage: str):
+        if job.cancelled.is_set():
+            raise Cancelled()
+        job.stage = stage
+        if DEBUG:
+            print(f"DEBUG: conversion {job.id} {stage}")
+
+    def _in_process(self, job: ConversionJob, function: Callable, *args):
+        """Run a CPU-bound stage in the process pool, giving up on it if the job is cancelled"""
+        future = self._pool().submit(function, *args)
+        while True:
+            if job.cancelled.is_set():
+                future.cancel()
+                raise Cancelled()
+            try:
+                return future.result(timeout=CANCEL_POLL)
+            except FutureTimeout:
+                continue
+            except CancelledError:
+                raise Cancelled()  # the pool was shut down
+            except BrokenProcessPool:
+                # A worker died, e.g. out of memory. Start a new pool for later jobs.
+                with self._processes_lock:
+                    self._processes = None
+                raise
+
+    def _run(self, job: ConversionJob):
+        data = job.data  # dropped from the job once it finishes, even if cancelled mid-stage
+        self._stage(job, "transcript")
+        if job.source == "text":
+            transcript = data
+        else:
+            transcript = self.cache.get_or_compute(job.key, "transcript", lambda: extract_transcript(job.source, data, self.cache))
+
+        self._stage(job, "layout")
+        # Line breaking and the profile change the layout, the braille stays the same
+        dots_key = layout_key(job.key, job.line_breaking, job.profile)
+        estimate_key = content_key(dots_key, PUNCH_ORDER)
+        dots = self.cache.get(dots_key, "layout")
+        if dots is None:
+            # Another line breaking or profile of the same input only redoes the layout
+            cached_braille = self.cache.get(job.key, "braille")
+            braille, line_breaks, dots, estimate = self._in_process(job, layout_transcript, transcript,
+                                                                    job.line_breaking, job.profile, cached_braille)
+            if cached_braille is None:
+                self.cache.put(job.key, "braille", braille)
+            self.cache.put(dots_key, "line_breaks", line_breaks)
+            self.cache.put(dots_key, "layout", dots)
+            self.cache.put(estimate_key, "estimate", estimate)
+        else:
+            line_breaks = self.cache.get(dots_key, "line_breaks")
+            estimate = self.cache.get(estimate_key, "estimate")
+            if estimate is None:
+                self._stage(job, "estimate")
+                estimate = self._in_process(job, estimate_dots, dots, job.profile)
+                self.cache.put(estimate_key, "estimate", estimate)
+        job.dots, job.estimate, job.line_breaks = dots, estimate, line_breaks
+
+        if job.preview:
+            self._stage(job, "preview")
+            job.pdf = self._in_process(job, render_preview, dots, None, INTERPOINT, job.profile)
+        job.stage = None
+
+    def _finish(self, job: ConversionJob, status: ConversionStatus, error: str = None):
+        if job.done.is_set():
+            return  # cancelled while its last stage ran
+        job.status = status
+        job.error = error
+        job.finished_at = time.time()
+        job.data = None  # inputs can be large PDFs
+        job.done.set()
+        self.finished[status] += 1
+        self._finished_ids.append(job.id)
+        while len(self._finished_ids) > self.max_finished:
+            self.jobs.pop(self._finished_ids.popleft(), None)
+
+
+def test_conversion_reuses_braille():
+    """Test function to verify a second layout of the same input reads the cached braille instead of translating again"""
+    cache = PipelineCache(None)
+    queue = ConversionQueue(cache, io_workers=1, cpu_workers=1)
+    try:
+        text = "the child and a b\ncan't stop"
+        key = content_key("text", text)
+        first = queue.submit("text", text, key)
+        first.done.wait(60)
+        assert first.status == ConversionStatus.COMPLETED, first.error
+        assert (cache.hits["braille"], cache.misses["braille"]) == (0, 1)
+
+        second = queue.submit("text", text, key, line_breaking="optimal")
+        second.done.wait(60)
+        assert second.status == ConversionStatus.COMPLETED, second.error
+        assert cache.hits["braille"] == 1
+        assert second.dots.num_pages == first.dots.num_pages
+    finally:
+        queue.close()
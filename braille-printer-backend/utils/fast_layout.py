@@ -0,0 +1,154 @@
+from dataclasses import dataclass
+from typing import Iterable, Iterator, List
+
+import numpy as np
+
+from utils.braille_to_gcode import DotPosition
+from utils.layout_profile import DEFAULT_PROFILE, LayoutProfile
+
+# Tables of the default profile, see LayoutProfile for other paper.
+# Offset of dots 1-6 from the character top, in units (same order as BrailleChar.get_dot_rel_loc)
+DOT_OFFSETS = DEFAULT_PROFILE.dot_offsets
+# Which of the 6 dots each of the 64 cell patterns punches
+PATTERN_PUNCH = DEFAULT_PROFILE.pattern_punch
+# Offsets (mm) of every dot of every pattern, shape (64, 6, 2)
+PATTERN_OFFSETS = DEFAULT_PROFILE.pattern_offsets
+# Character positions within a line and line positions within a page (mm)
+COLUMN_X = DEFAULT_PROFILE.column_x
+ROW_Y = DEFAULT_PROFILE.row_y
+
+
+@dataclass
+class CellArrays:
+    """One entry per braille cell, in reading order"""
+    pattern: np.ndarray  # uint8, bit k set means dot k+1 is punched
+    x: np.ndarray  # mm, character top left
+    y: np.ndarray
+    page: np.ndarray
+    num_pages: int
+
+    def __len__(self) -> int:
+        return len(self.pattern)
+
+
+@dataclass
+class DotArrays:
+    """Struct-of-arrays version of List[List[DotPosition]], ordered by page"""
+    x: np.ndarray
+    y: np.ndarray
+    page: np.ndarray
+    punch: np.ndarray
+    num_pages: int
+
+    def __len__(self) -> int:
+        return len(self.x)
+
+    @classmethod
+    def from_dot_positions(cls, dots: List[DotPosition]) -> "DotArrays":
+        """Pack a flat list of DotPosition, sorting it by page"""
+        page = np.fromiter((dot.page for dot in dots), dtype=np.int64, count=len(dots))
+        order = np.argsort(page, kind="stable")
+        x = np.fromiter((dot.x for dot in dots), dtype=np.float64, count=len(dots))
+        y = np.fromiter((dot.y for dot in dots), dtype=np.float64, count=len(dots))
+        punch = np.fromiter((dot.punch for dot in dots), dtype=bool, count=len(dots))
+        return cls(x[order], y[order], page[order], punch[order], int(page.max()) + 1 if len(dots) else 0)
+
+    @property
+    def nbytes(self) -> int:
+        return self.x.nbytes + self.y.nbytes + self.page.nbytes + self.punch.nbytes
+
+    def page_slice(self, page: int) -> "DotArrays":
+        start, end = np.searchsorted(self.page, [page, page + 1])
+        return DotArrays(self.x[start:end], self.y[start:end], self.page[start:end],
+                         self.punch[start:end], 1)
+
+    def punched(self) -> "DotArrays":
+        """Only the dots that get punched"""
+        return DotArrays(self.x[self.punch], self.y[self.punch], self.page[self.punch],
+                         self.punch[self.punch], self.num_pages)
+
+    def select_pages(self, pages: Iterable[int]) -> "DotArrays":
+        """Only the dots on the given pages"""
+        keep = np.isin(self.page, list(pages))
+        return DotArrays(self.x[keep], self.y[keep], self.page[keep], self.punch[keep], self.num_pages)
+
+    def pages(self) -> Iterator["DotArrays"]:
+        for page in range(self.num_pages):
+            yield self.page_slice(page)
+
+    def to_dot_positions(self) -> List[List[DotPosition]]:
+        """Convert to the nested list get_dots_pos_and_page returns"""
+        pages = [[] for _ in range(self.num_pages)]
+        for x, y, punch, page in zip(self.x.tolist(), self.y.tolist(),
+                                     self.punch.tolist(), self.page.tolist()):
+            pages[page].append(DotPosition(x, y, punch, page))
+        return pages
+
+
+def layout_cells(braille_str: str, profile: LayoutProfile = DEFAULT_PROFILE) -> CellArrays:
+    """
+    Place every braille cell, with the same line wrapping and page breaks as
+    get_dots_pos_and_page, using array operations instead of per-cell objects.
+    """
+    column_x, row_y = profile.column_x, profile.row_y
+    codes = np.frombuffer(braille_str.encode("utf-32-le"), dtype=np.uint32).astype(np.int64)
+    is_newline = codes == ord("\n")
+    newlines = np.flatnonzero(is_newline)
+
+    # Logical lines are separated by '\n'
+    line_starts = np.concatenate(([0], newlines + 1))
+    line_ends = np.concatenate((newlines, [len(codes)]))
+    line_lengths = line_ends - line_starts
+
+    # Long lines wrap every K cells, an empty line still takes one row
+    K = len(column_x)
+    rows_per_line = 1 + np.maximum(line_lengths - 1, 0) // K
+    first_row = np.concatenate(([0], np.cumsum(rows_per_line)[:-1]))
+
+    chars = np.flatnonzero(~is_newline)
+    line = np.searchsorted(newlines, chars)
+    index_in_line = chars - line_starts[line]
+    row = first_row[line] + index_in_line // K
+    col = index_in_line % K
+
+    # A new page starts at the first character that no longer fits. Blank rows
+    # at the bottom of a page are dropped, so this walks the occupied rows.
+    P = len(row_y)
+    occupied = np.unique(row)
+    row_page = np.empty(len(occupied), dtype=np.int64)
+    row_in_page = np.empty(len(occupied), dtype=np.int64)
+    page = 0
+    page_start = 0
+    for i, r in enumerate(occupied.tolist()):
+        if r - page_start >= P:
+            page += 1
+            page_start = r
+        row_page[i] = page
+        row_in_page[i] = r - page_start
+    slot = np.searchsorted(occupied, row)
+
+    return CellArrays(
+        pattern=((codes[chars] - 0x2800) & 0x3F).astype(np.uint8),
+        x=column_x[col],
+        y=row_y[row_in_page[slot]],
+        page=row_page[slot],
+        num_pages=page + 1,
+    )
+
+
+def cells_to_dots(cells: CellArrays, punched_only: bool = False,
+                  profile: LayoutProfile = DEFAULT_PROFILE) -> DotArrays:
+    """Expand cells into their six dots using the profile's pattern table"""
+    offsets = profile.pattern_offsets[cells.pattern]
+    x = (cells.x[:, None] + offsets[:, :, 0]).ravel()
+    y = (cells.y[:, None] + offsets[:, :, 1]).ravel()
+    page = np.repeat(cells.page, 6)
+    punch = profile.pattern_punch[cells.pattern].ravel()
+    dots = DotArrays(x, y, page, punch, cells.num_pages)
+    return dots.punched() if punched_only else dots
+
+
+def get_dots_arrays(braille_str: str, punched_only: bool = False,
+                    profile: LayoutProfile = DEFAULT_PROFILE) -> DotArrays:
+    """Array-backed get_dots_pos_and_page. Set punched_only to drop the hollow dots."""
+    return cells_to_dots(layout_cells(braille_str, profile), punched_only, profile)
@@ -0,0 +1,95 @@
+"""
+Contraction table for Grade 2 (contracted) English braille.
+
+Each rule is (print letters, braille in North American ASCII braille, context).
+Contexts:
+    word      the whole word only (wordsigns and short forms)
+    begin     at the start of a word, followed by at least two more letters
+    middle    neither the first nor the last letters of a word
+    not_begin anywhere except the start of a word
+    any       anywhere in a word
+"""
+
+WORD = "word"
+BEGIN = "begin"
+MIDDLE = "middle"
+NOT_BEGIN = "not_begin"
+ANY = "any"
+
+RULES = [
+    # Alphabetic wordsigns
+    ("but", "B", WORD), ("can", "C", WORD), ("do", "D", WORD), ("every", "E", WORD),
+    ("from", "F", WORD), ("go", "G", WORD), ("have", "H", WORD), ("just", "J", WORD),
+    ("knowledge", "K", WORD), ("like", "L", WORD), ("more", "M", WORD), ("not", "N", WORD),
+    ("people", "P", WORD), ("quite", "Q", WORD), ("rather", "R", WORD), ("so", "S", WORD),
+    ("that", "T", WORD), ("us", "U", WORD), ("very", "V", WORD), ("will", "W", WORD),
+    ("it", "X", WORD), ("you", "Y", WORD), ("as", "Z", WORD),
+
+    # Strong wordsigns
+    ("child", "*", WORD), ("shall", "%", WORD), ("this", "?", WORD), ("which", ":", WORD),
+    ("out", "\\", WORD), ("still", "/", WORD),
+
+    # Lower wordsigns
+    ("be", "2", WORD), ("enough", "5", WORD), ("were", "7", WORD), ("his", "8", WORD),
+    ("was", "0", WORD),
+
+    # Strong contractions
+    ("and", "&", ANY), ("for", "=", ANY), ("of", "(", ANY), ("the", "!", ANY), ("with", ")", ANY),
+
+    # Strong groupsigns
+    ("ch", "*", ANY), ("gh", "<", ANY), ("sh", "%", ANY), ("th", "?", ANY), ("wh", ":", ANY),
+    ("ed", "$", ANY), ("er", "]", ANY), ("ou", "\\", ANY), ("ow", "[", ANY), ("st", "/", ANY),
+    ("ar", ">", ANY), ("ing", "+", NOT_BEGIN),
+
+    # Lower groupsigns
+    ("ea", "1", MIDDLE), ("bb", "2", MIDDLE), ("cc", "3", MIDDLE), ("dd", "4", MIDDLE),
+    ("ff", "6", MIDDLE), ("gg", "7", MIDDLE), ("en", "5", ANY), ("in", "9", ANY),
+    ("be", "2", BEGIN), ("con", "3", BEGIN), ("dis", "4", BEGIN), ("com", "-", BEGIN),
+
+    # Initial-letter contractions
+    ("day", "\"D", ANY), ("ever", "\"E", ANY), ("father", "\"F", ANY), ("here", "\"H", ANY),
+    ("know", "\"K", ANY), ("lord", "\"L", ANY), ("mother", "\"M", ANY), ("name", "\"N", ANY),
+    ("one", "\"O", ANY), ("part", "\"P", ANY), ("question", "\"Q", ANY), ("right", "\"R", ANY),
+    ("some", "\"S", ANY), ("time", "\"T", ANY), ("under", "\"U", ANY), ("work", "\"W", ANY),
+    ("young", "\"Y", ANY), ("there", "\"!", ANY), ("character", "\"*", ANY),
+    ("through", "\"?", ANY), ("where", "\":", ANY), ("ought", "\"\\", ANY),
+    ("upon", "^U", ANY), ("word", "^W", ANY), ("these", "^!", ANY), ("those", "^?", ANY),
+    ("whose", "^:", ANY),
+    ("cannot", "_C", ANY), ("had", "_H", ANY), ("many", "_M", ANY), ("spirit", "_S", ANY),
+    ("their", "_!", ANY), ("world", "_W", ANY),
+
+    # Final-letter contractions
+    ("ance", ".E", NOT_BEGIN), ("ence", ";E", NOT_BEGIN), ("ful", ";L", NOT_BEGIN),
+    ("ity", ";Y", NOT_BEGIN), ("ment", ";T", NOT_BEGIN), ("ness", ";S", NOT_BEGIN),
+    ("sion", ".N", NOT_BEGIN), ("tion", ";N", NOT_BEGIN), ("ong", ";G", NOT_BEGIN),
+    ("ound", ".D", NOT_BEGIN), ("ount", ".T", NOT_BEGIN), ("less", ".S", NOT_BEGIN),
+
+    # Short forms
+    ("about", "AB", WORD), ("above", "ABV", WORD), ("according", "AC", WORD),
+    ("across", "ACR", WORD), ("after", "AF", WORD), ("afternoon", "AFN", WORD),
+    ("afterward", "AFW", WORD), ("again", "AG", WORD), ("against", "AG/", WORD),
+    ("almost", "ALM", WORD), ("already", "ALR", WORD), ("also", "AL", WORD),
+    ("although", "AL?", WORD), ("altogether", "ALT", WORD), ("always", "ALW", WORD),
+    ("because", "2C", WORD), ("before", "2F", WORD), ("behind", "2H", WORD),
+    ("below", "2L", WORD), ("beneath", "2N", WORD), ("beside", "2S", WORD),
+    ("between", "2T", WORD), ("beyond", "2Y", WORD), ("blind", "BL", WORD),
+    ("braille", "BRL", WORD), ("children", "*N", WORD), ("conceive", "3CV", WORD),
+    ("could", "CD", WORD), ("deceive", "DCV", WORD), ("declare", "DCL", WORD),
+    ("either", "EI", WORD), ("first", "F/", WORD), ("friend", "FR", WORD),
+    ("good", "GD", WORD), ("great", "GRT", WORD), ("herself", "H]F", WORD),
+    ("him", "HM", WORD), ("himself", "HMF", WORD), ("immediate", "IMM", WORD),
+    ("its", "XS", WORD), ("itself", "XF", WORD), ("letter", "LR", WORD),
+    ("little", "LL", WORD), ("much", "M*", WORD), ("must", "M/", WORD),
+    ("myself", "MYF", WORD), ("necessary", "NEC", WORD), ("neither", "NEI", WORD),
+    ("paid", "PD", WORD), ("perceive", "P]CV", WORD), ("perhaps", "P]H", WORD),
+    ("quick", "QK", WORD), ("receive", "RCV", WORD), ("rejoice", "RJC", WORD),
+    ("said", "SD", WORD), ("should", "%D", WORD), ("such", "S*", WORD),
+    ("themselves", "!MVS", WORD), ("thyself", "?YF", WORD), ("today", "TD", WORD),
+    ("together", "TGR", WORD), ("tomorrow", "TM", WORD), ("tonight", "TN", WORD),
+    ("would", "WD", WORD), ("your", "YR", WORD), ("yourself", "YRF", WORD),
+    ("yourselves", "YRVS", WORD),
+]
+
+# Letters that stand for a whole word need the letter sign when written alone
+LETTER_SIGN = ";"
+LETTERS_WITHOUT_SIGN = "aio"
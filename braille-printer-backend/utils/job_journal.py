@@ -0,0 +1,225 @@
+import os
+import pickle
+import shutil
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from utils.braille_to_gcode import INTERPOINT, PUNCH_ORDER, DotPosition, GcodeAction, PrintedDots, dot_pos_to_gcode
+from utils.layout_profile import DEFAULT_PROFILE, LayoutProfile
+
+JOURNAL_DIR = os.getenv("BRAILLE_JOURNAL_DIR", os.path.join(os.path.expanduser("~"), ".cache", "braille-printer", "jobs"))
+# Acknowledged punches buffered before the journal is fsync'd
+FSYNC_EVERY = 64
+# Longest a punch stays unsynced (s), so a slow page still gets checkpointed
+FSYNC_INTERVAL = 1.0
+
+JOB_FILE = "job.pkl"
+PROGRESS_FILE = "progress.log"
+
+
+@dataclass
+class JournalState:
+    """What a journal says about a job: its pages and how far printing got"""
+    job_id: int
+    pages: List[List[DotPosition]]
+    punch_order: str
+    split_pages: bool
+    created_at: float
+    punches_done: Dict[int, int] = field(default_factory=dict)  # page -> acknowledged punches
+    pages_done: List[int] = field(default_factory=list)
+    profile: LayoutProfile = DEFAULT_PROFILE  # the pages were laid out for it, journals from before have the default
+    interpoint: bool = INTERPOINT  # odd pages punched mirrored on the back, journals from before followed INTERPOINT
+
+    def printed_dots(self) -> PrintedDots:
+        """Rebuild the punched dots from the acknowledged punch counts"""
+        dots = PrintedDots()
+        for page, count in sorted(self.punches_done.items()):
+            planned = [action.dot for action in dot_pos_to_gcode(self.pages[page], self.punch_order, dots,
+                                                                   self.interpoint, self.profile) if action.dot]
+            for dot in planned[:count]:
+                dots.append(dot)
+        return dots
+
+
+class JobJournal:
+    """
+    Append-only record of a print job on disk, so a job can be resumed after
+    the server or the serial link dies.
+
+    The pages are written once when the job starts. After that every
+    acknowledged punch appends "p <page> <punches>" to the progress log, and
+    a finished page appends "d <page>". Lines are buffered and fsync'd every
+    FSYNC_EVERY punches or FSYNC_INTERVAL seconds, and at every page end. A
+    crash loses at most the last unsynced batch, which is then re-punched on
+    dots that are already there instead of skipped.
+    """
+
+    def __init__(self, job_id: int, directory: str = JOURNAL_DIR,
+                 fsync_every: int = FSYNC_EVERY, fsync_interval: float = FSYNC_INTERVAL):
+        self.job_id = job_id
+        self.path = os.path.join(directory, str(job_id))
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._buffer = []
+        self._last_sync = time.monotonic()
+        self._file = None
+        self._lock = threading.Lock()
+
+    def start(self, pages: List[List[DotPosition]], punch_order: str = PUNCH_ORDER,
+              split_pages: bool = False, created_at: float = None, profile: LayoutProfile = DEFAULT_PROFILE,
+              interpoint: bool = INTERPOINT):
+        """Write the job itself, before anything is sent to a printer"""
+        os.makedirs(self.path, exist_ok=True)
+        job_path = os.path.join(self.path, JOB_FILE)
+        if not os.path.exists(job_path):
+            state = JournalState(self.job_id, pages, punch_order, split_pages, created_at or time.time(),
+                                 profile=profile, interpoint=interpoint)
+            tmp_path = job_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, job_path)
+        self._file = open(os.path.join(self.path, PROGRESS_FILE), "a")
+
+    def record_punch(self, page: int, punches: int):
+        """Called from the ack callback, so it only syncs once per batch"""
+        with self._lock:
+            self._buffer.append(f"p {page} {punches}\n")
+            if len(self._buffer) >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync()
+
+    def page_done(self, page: int):
+        with self._lock:
+            self._buffer.append(f"d {page}\n")
+            self._sync()
+
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        if self._file is None:
+            return
+        if self._buffer:
+            self._file.write("".join(self._buffer))
+            self._buffer.clear()
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def remove(self):
+        """The job is over, nothing left to resume"""
+        self.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def load_journal(job_id: int, directory: str = JOURNAL_DIR) -> JournalState:
+    path = os.path.join(directory, str(job_id))
+    with open(os.path.join(path, JOB_FILE), "rb") as f:
+        state = pickle.load(f)
+    try:
+        with open(os.path.join(path, PROGRESS_FILE)) as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        lines = []
+    for line in lines:
+        parts = line.split()
+        # A torn last line from a crash mid-write is ignored
+        if len(parts) == 3 and parts[0] == "p" and parts[1].isdigit() and parts[2].isdigit():
+            page, punches = int(parts[1]), int(parts[2])
+            state.punches_done[page] = max(state.punches_done.get(page, 0), punches)
+        elif len(parts) == 2 and parts[0] == "d" and parts[1].isdigit():
+            if int(parts[1]) not in state.pages_done:
+                state.pages_done.append(int(parts[1]))
+    return state
+
+
+def list_journals(directory: str = JOURNAL_DIR) -> List[int]:
+    """Ids of the jobs that were not finished, oldest first"""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(int(name) for name in os.listdir(directory)
+                  if name.isdigit() and os.path.exists(os.path.join(directory, name, JOB_FILE)))
+
+
+class JournalSink(PrintedDots):
+    """
+    Ack callback target for one page. Counts acknowledged punches, records
+    them in the job's printed dots and journals the count.
+    """
+
+    def __init__(self, printed_dots: PrintedDots, page: int, journal: Optional[JobJournal] = None,
+                 punches: int = 0):
+        super().__init__()
+        self.printed_dots = printed_dots
+        self.page = page
+        self.journal = journal
+        self.punches = punches
+
+    def append(self, dot):
+        self.printed_dots.append(dot)
+        self.punches += 1
+        if self.journal is not None:
+            self.journal.record_punch(self.page, self.punches)
+
+
+def skip_punches(actions: List[GcodeAction], punches: int) -> List[GcodeAction]:
+    """
+    Actions left after the first `punches` punches were acknowledged. The move
+    to the next dot is kept, since resuming re-homes the head first.
+    """
+    if punches <= 0:
+        return actions
+    seen = 0
+    for i, action in enumerate(actions):
+        if action.dot:
+            seen += 1
+            if seen == punches:
+                return actions[i + 1:]
+    return []
+
+
+def test_skip_punches():
+    """Test function to verify resuming skips exactly the acknowledged punches and keeps the move to the next dot"""
+    page = [DotPosition(x, 10.0, True) for x in (10.0, 12.5, 15.0)]
+    actions = dot_pos_to_gcode(page)
+    punches = [action for action in actions if action.dot]
+    assert skip_punches(actions, 0) == actions
+    rest = skip_punches(actions, 1)
+    assert [action for action in rest if action.dot] == punches[1:]
+    assert not rest[0].dot, "The move to the next dot should be kept"
+    assert skip_punches(actions, len(punches)) == []
+
+
+def test_load_journal():
+    """Test function to verify progress is read back from the journal and a torn last line is ignored"""
+    import tempfile
+
+    directory = tempfile.mkdtemp()
+    pages = [[DotPosition(10.0, 10.0, True, page)] for page in range(2)]
+    journal = JobJournal(7, directory, fsync_every=1)
+    journal.start(pages, "layout", split_pages=True)
+    journal.record_punch(0, 1)
+    journal.page_done(0)
+    journal.record_punch(1, 1)
+    journal.close()
+    with open(os.path.join(directory, "7", PROGRESS_FILE), "a") as f:
+        f.write("p 1 ")
+    state = load_journal(7, directory)
+    assert (state.punch_order, state.split_pages) == ("layout", True)
+    assert state.pages_done == [0]
+    assert state.punches_done == {0: 1, 1: 1}
+    assert len(state.printed_dots().dots) == 2
+    assert list_journals(directory) == [7]
+    journal.remove()
+    assert list_journals(directory) == []
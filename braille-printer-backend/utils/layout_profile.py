@@ -0,0 +1,198 @@
+import os
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+
+def _positions(start: float, step: float, width: float, limit: float, mm_per_unit: float,
+               dist_diam_dot: float) -> np.ndarray:
+    """
+    Positions of the characters that fit before `limit`, accumulated the same
+    way get_dots_pos_and_page steps through them so the floats match exactly.
+    """
+    positions = []
+    pos = start
+    while not pos + width * mm_per_unit - dist_diam_dot > limit:
+        positions.append(pos)
+        pos += step
+    return np.array(positions)
+
+
+@dataclass(frozen=True)
+class LayoutProfile:
+    """
+    Page geometry of one kind of paper and embosser. Fields ending in _mm are
+    millimetres, the other lengths are layout units of mm_per_unit. Derived
+    metrics and the cell pattern tables are computed on first use and kept on
+    the profile, which is immutable, so every layout with it shares them.
+    """
+    name: str
+    paper_width_mm: float = 215.9
+    paper_height_mm: float = 279.4
+    left_margin_mm: float = 25
+    right_margin_mm: float = 25
+    top_margin_mm: float = 25
+    bottom_margin_mm: float = 25
+    mm_per_unit: float = 1.5
+    # Diameter of one dot and the gap between dots of a cell
+    dist_diam_dot: float = 1
+    dist_between_dots: float = 1
+    # Least gap between cells of a line and between lines
+    column_width: float = 3
+    row_height: float = 4
+    # Offset of the page's origin relative to the printer's origin (mm)
+    left_offset: float = 23
+    top_offset: float = 30
+    # fpdf page format, the paper size if None
+    pdf_format: Optional[str] = None
+
+    # Derived metrics, in units like the module globals of braille_to_gcode
+
+    @cached_property
+    def paper_width(self) -> float:
+        return self.paper_width_mm / self.mm_per_unit
+
+    @cached_property
+    def paper_height(self) -> float:
+        return self.paper_height_mm / self.mm_per_unit
+
+    @cached_property
+    def left_margin_width(self) -> float:
+        return self.left_margin_mm / self.mm_per_unit
+
+    @cached_property
+    def right_margin_width(self) -> float:
+        return self.right_margin_mm / self.mm_per_unit
+
+    @cached_property
+    def top_margin_height(self) -> float:
+        return self.top_margin_mm / self.mm_per_unit
+
+    @cached_property
+    def bottom_margin_height(self) -> float:
+        return self.bottom_margin_mm / self.mm_per_unit
+
+    @cached_property
+    def char_height(self) -> float:
+        return 3 * self.dist_diam_dot + 2 * self.dist_between_dots
+
+    @cached_property
+    def char_width(self) -> float:
+        return 2 * self.dist_diam_dot + self.dist_between_dots
+
+    @cached_property
+    def num_braille_per_row(self) -> int:
+        return int((self.paper_width - self.left_margin_width - self.right_margin_width - self.char_width)
+                   / (self.char_width + self.column_width)) + 1
+
+    @cached_property
+    def num_braille_per_col(self) -> int:
+        return int((self.paper_height - self.top_margin_height - self.bottom_margin_height - self.char_height)
+                   / (self.char_height + self.row_height)) + 1
+
+    @cached_property
+    def actual_col_width(self) -> float:
+        return ((self.paper_width - self.left_margin_width - self.right_margin_width
+                 - self.char_width * self.num_braille_per_row) / (self.num_braille_per_row - 1))
+
+    @cached_property
+    def actual_row_height(self) -> float:
+        return ((self.paper_height - self.top_margin_height - self.bottom_margin_height
+                 - self.char_height * self.num_braille_per_col) / (self.num_braille_per_col - 1))
+
+    @cached_property
+    def interpoint_offset(self) -> float:
+        """How far the back of an interpoint sheet is shifted against the front, half the dot pitch"""
+        return (self.dist_diam_dot + self.dist_between_dots) / 2
+
+    @cached_property
+    def column_step(self) -> float:
+        """Distance between the starts of neighbouring cells of a line (mm)"""
+        return (self.char_width + self.actual_col_width) * self.mm_per_unit
+
+    @cached_property
+    def row_step(self) -> float:
+        """Distance between the tops of neighbouring lines (mm)"""
+        return (self.char_height + self.actual_row_height) * self.mm_per_unit
+
+    @cached_property
+    def column_x(self) -> np.ndarray:
+        """Character positions within a line (mm)"""
+        return _positions(self.left_margin_width * self.mm_per_unit, self.column_step, self.char_width,
+                          (self.paper_width - self.right_margin_width) * self.mm_per_unit,
+                          self.mm_per_unit, self.dist_diam_dot)
+
+    @cached_property
+    def row_y(self) -> np.ndarray:
+        """Line positions within a page (mm)"""
+        return _positions(self.top_margin_height * self.mm_per_unit, self.row_step, self.char_height,
+                          (self.paper_height - self.bottom_margin_height) * self.mm_per_unit,
+                          self.mm_per_unit, self.dist_diam_dot)
+
+    # Cell pattern tables
+
+    @cached_property
+    def dot_offsets(self) -> np.ndarray:
+        """Offset of dots 1-6 from the character top, in units"""
+        step = self.dist_diam_dot + self.dist_between_dots
+        return np.array([[0, 0], [0, step], [0, step * 2], [step, 0], [step, step], [step, step * 2]])
+
+    @cached_property
+    def pattern_punch(self) -> np.ndarray:
+        """Which of the 6 dots each of the 64 cell patterns punches"""
+        return ((np.arange(64)[:, None] >> np.arange(6)) & 1).astype(bool)
+
+    @cached_property
+    def pattern_offsets(self) -> np.ndarray:
+        """Offsets (mm) of every dot of every pattern, shape (64, 6, 2)"""
+        return np.broadcast_to(self.dot_offsets * self.mm_per_unit, (64, 6, 2))
+
+    @cached_property
+    def pattern_dots(self) -> Tuple[Tuple[Tuple[float, float, bool], ...], ...]:
+        """The same as (dx, dy, punch) tuples of floats, for laying out one cell at a time"""
+        offsets = [(x * self.mm_per_unit, y * self.mm_per_unit) for x, y in self.dot_offsets.tolist()]
+        return tuple(tuple((dx, dy, bool(pattern >> k & 1)) for k, (dx, dy) in enumerate(offsets))
+                     for pattern in range(64))
+
+    @cached_property
+    def page_format(self):
+        return self.pdf_format or (self.paper_width_mm, self.paper_height_mm)
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "paperWidthMm": self.paper_width_mm,
+            "paperHeightMm": self.paper_height_mm,
+            "mmPerUnit": self.mm_per_unit,
+            "cellsPerLine": len(self.column_x),
+            "linesPerPage": len(self.row_y),
+            "leftOffset": self.left_offset,
+            "topOffset": self.top_offset,
+        }
+
+
+LETTER = LayoutProfile("letter", pdf_format="Letter")
+A4 = LayoutProfile("a4", paper_width_mm=210, paper_height_mm=297, pdf_format="A4")
+
+# Profiles by name, for requests and printers to pick from
+PROFILES: Dict[str, LayoutProfile] = {profile.name: profile for profile in (LETTER, A4)}
+
+
+def register_profile(profile: LayoutProfile) -> LayoutProfile:
+    """Add or replace a profile, e.g. for an embosser with its own cell spacing"""
+    PROFILES[profile.name] = profile
+    return profile
+
+
+def get_profile(name: Optional[str] = None) -> LayoutProfile:
+    """A registered profile by name, DEFAULT_PROFILE for None"""
+    if name is None:
+        return DEFAULT_PROFILE
+    if name not in PROFILES:
+        raise ValueError(f"Unknown layout profile: {name}")
+    return PROFILES[name]
+
+
+DEFAULT_PROFILE = get_profile(os.getenv("BRAILLE_LAYOUT_PROFILE", "letter"))
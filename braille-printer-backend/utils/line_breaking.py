@@ -0,0 +1,292 @@
+import os
+from dataclasses import dataclass
+from typing import Iterable, Iterator, List, Tuple
+
+from utils.fast_layout import COLUMN_X, layout_cells
+from utils.layout_profile import DEFAULT_PROFILE, LayoutProfile
+from utils.text_to_braille import text_to_braille_grade1
+
+# "none" wraps wherever a cell hits the margin, like get_dots_pos_and_page.
+# "optimal" breaks between words, "hyphenate" may also break inside them.
+LINE_BREAKING = os.getenv("BRAILLE_LINE_BREAKING", "none")
+MODES = ("none", "optimal", "hyphenate")
+
+# Cells per line of the default profile's layout
+LINE_CELLS = len(COLUMN_X)
+BRAILLE_SPACE = "⠀"
+BRAILLE_HYPHEN = "⠤"
+# Blank lines kept in a row, longer runs are cut down to this
+MAX_BLANK_LINES = 1
+# Shortest piece of a word left on either side of an inserted hyphen
+MIN_FRAGMENT = 3
+# Raggedness a hyphen costs, as much as about 7 empty cells at the end of a line
+HYPHEN_PENALTY = 50
+# Cells that modify the cell after them (capital, number, letter and
+# contraction prefixes), a word is never hyphenated right after one
+PREFIX_CELLS = set("⠠⠼⠰⠐⠘⠸⠨")
+NUMBER_SIGN = "⠼"
+LETTER_CELLS = set(text_to_braille_grade1("abcdefghijklmnopqrstuvwxyz"))
+VOWEL_CELLS = set(text_to_braille_grade1("aeiouy"))
+
+# What follows a piece of a paragraph, and so what breaking the line after it costs
+SPACE = "space"  # a blank cell, dropped if the line breaks here
+HYPHEN = "hyphen"  # nothing, a hyphen is added if the line breaks here
+DASH = "dash"  # nothing, the piece already ends in a hyphen
+SPLIT = "split"  # nothing, an overlong word is cut here
+
+
+@dataclass
+class LineBreakStats:
+    mode: str
+    pages_before: int
+    pages_after: int
+    hyphens: int
+
+    @property
+    def pages_saved(self) -> int:
+        return self.pages_before - self.pages_after
+
+    def to_dict(self) -> dict:
+        return {
+            "mode": self.mode,
+            "pagesBefore": self.pages_before,
+            "pagesAfter": self.pages_after,
+            "pagesSaved": self.pages_saved,
+            "hyphens": self.hyphens,
+        }
+
+
+def _is_nucleus(cell: str) -> bool:
+    """A vowel, or a contraction cell, which nearly always carries one"""
+    return cell in VOWEL_CELLS or (cell not in LETTER_CELLS and cell not in PREFIX_CELLS and cell != BRAILLE_HYPHEN)
+
+
+def _syllable_break(word: str, k: int) -> bool:
+    """
+    Whether a hyphen may go between word[k - 1] and word[k]. The braille no
+    longer has the print spelling, so syllables are guessed from the cells:
+    a break goes next to a contraction cell, or before a single consonant
+    that starts a new vowel group (informa-tion, bet-ter). Never right after a
+    prefix cell, which belongs to the cell after it.
+    """
+    before, after = word[k - 1], word[k]
+    if before in PREFIX_CELLS or BRAILLE_HYPHEN in (before, after):
+        return False
+    if before not in LETTER_CELLS or after not in LETTER_CELLS:
+        return True
+    return (after not in VOWEL_CELLS and k + 1 < len(word) and _is_nucleus(word[k + 1])
+            and any(_is_nucleus(cell) for cell in word[:k]))
+
+
+def _word_pieces(word: str, hyphenate: bool, width: int) -> List[Tuple[str, str]]:
+    """
+    A word as pieces the line may break between, each with what follows it.
+    With hyphenate, a word may break after a hyphen it has, or with an added
+    hyphen at a guessed syllable boundary (see _syllable_break) that leaves
+    at least MIN_FRAGMENT cells on each side. A piece still wider than the
+    line is cut at the margin, as a forced split. Numbers are never broken:
+    one wider than the line is left whole for the layout to wrap.
+    """
+    if NUMBER_SIGN in word:
+        return [(word, HYPHEN)]
+    if hyphenate:
+        # A first ⠤ is the "com" contraction, not a hyphen
+        breaks = [k for k in range(2, len(word)) if word[k - 1] == BRAILLE_HYPHEN]
+        breaks += [k for k in range(MIN_FRAGMENT, len(word) - MIN_FRAGMENT + 1) if _syllable_break(word, k)]
+        breaks = sorted(set(breaks))
+    else:
+        breaks = []
+    pieces = []
+    start = 0
+    for k in breaks + [len(word)]:
+        pieces.append((word[start:k], DASH if word[k - 1] == BRAILLE_HYPHEN and 1 < k < len(word) else HYPHEN))
+        start = k
+
+    # Pieces wider than a line are cut, leaving room for the hyphen if one is added
+    step = width - 1 if hyphenate else width
+    fitted = []
+    for text, follow in pieces:
+        while len(text) > width:
+            fitted.append((text[:step], SPLIT))
+            text = text[step:]
+        fitted.append((text, follow))
+    return fitted
+
+
+def _break_paragraph(line: str, width: int, hyphenate: bool) -> Tuple[List[str], int]:
+    """
+    Lines of one paragraph with the fewest lines, and among those the least
+    raggedness: the sum over all but the last line of the squared empty
+    cells, plus HYPHEN_PENALTY per hyphen. Returns the lines and hyphens added.
+    """
+    items = []
+    for word in line.split(BRAILLE_SPACE):
+        if word:
+            items.extend(_word_pieces(word, hyphenate, width))
+            items[-1] = (items[-1][0], SPACE)
+    if not items:
+        return [""], 0
+
+    # pos[i] is where item i would start if everything were on one line
+    pos = [0]
+    for text, follow in items:
+        pos.append(pos[-1] + len(text) + (follow == SPACE))
+
+    def line_length(i: int, j: int) -> int:
+        """Cells of a line with items i..j-1, breaking after item j-1"""
+        follow = items[j - 1][1]
+        return pos[j] - pos[i] - (follow == SPACE) + (follow == HYPHEN or (follow == SPLIT and hyphenate))
+
+    # best[j] is (lines, raggedness) of the best breaking of items[:j]
+    n = len(items)
+    best = [(0, 0)] + [None] * n
+    previous = [0] * (n + 1)
+    for j in range(1, n + 1):
+        last = j == n
+        for i in range(j - 1, -1, -1):
+            length = line_length(i, j) if not last else pos[j] - pos[i] - 1
+            if length > width and i < j - 1:
+                break  # a single piece wider than the line, an unbreakable number, still gets a line
+            if best[i] is None:
+                continue
+            follow = items[j - 1][1]
+            cost = 0 if last else (width - length) ** 2 + HYPHEN_PENALTY * (follow in (HYPHEN, SPLIT))
+            candidate = (best[i][0] + 1, best[i][1] + cost)
+            if best[j] is None or candidate < best[j]:
+                best[j] = candidate
+                previous[j] = i
+
+    lines = []
+    hyphens = 0
+    j = n
+    while j > 0:
+        i = previous[j]
+        parts = []
+        for k in range(i, j):
+            text, follow = items[k]
+            parts.append(text)
+            if k < j - 1 and follow == SPACE:
+                parts.append(BRAILLE_SPACE)
+        follow = items[j - 1][1]
+        if j < n and (follow == HYPHEN or (follow == SPLIT and hyphenate)):
+            parts.append(BRAILLE_HYPHEN)
+            hyphens += 1
+        lines.append("".join(parts))
+        j = i
+    return lines[::-1], hyphens
+
+
+def break_lines(braille: str, width: int = LINE_CELLS, hyphenate: bool = False,
+                max_blank_lines: int = MAX_BLANK_LINES) -> Tuple[str, int]:
+    """
+    Re-break every line of `braille` at word boundaries, so the layout never
+    has to wrap one, unless a number is wider than the line. Runs of more
+    than `max_blank_lines` blank lines are cut down. Returns the braille and
+    the number of hyphens added.
+    """
+    out = []
+    hyphens = 0
+    blank_run = 0
+    for line in braille.split("\n"):
+        if not line.strip(BRAILLE_SPACE):
+            blank_run += 1
+            if blank_run <= max_blank_lines:
+                out.append("")
+            continue
+        blank_run = 0
+        lines, added = _break_paragraph(line, width, hyphenate)
+        out.extend(lines)
+        hyphens += added
+    return "\n".join(out), hyphens
+
+
+def iter_break_lines(braille_chunks: Iterable[str], mode: str = LINE_BREAKING,
+                     profile: LayoutProfile = DEFAULT_PROFILE) -> Iterator[str]:
+    """break_lines on chunks from iter_text_to_braille, which each end their own line"""
+    width = len(profile.column_x)
+    for chunk in braille_chunks:
+        yield chunk if mode == "none" else break_lines(chunk, width, hyphenate=mode == "hyphenate")[0]
+
+
+def count_pages(braille: str, profile: LayoutProfile = DEFAULT_PROFILE) -> int:
+    return layout_cells(braille, profile).num_pages
+
+
+def optimize_line_breaks(braille: str, mode: str = LINE_BREAKING,
+                         profile: LayoutProfile = DEFAULT_PROFILE) -> Tuple[str, LineBreakStats]:
+    """Braille re-broken for `mode` and the profile's line width, and the page counts before and after"""
+    if mode not in MODES:
+        raise ValueError(f"Invalid line breaking mode: {mode}")
+    pages_before = count_pages(braille, profile)
+    if mode == "none":
+        return braille, LineBreakStats(mode, pages_before, pages_before, 0)
+    broken, hyphens = break_lines(braille, len(profile.column_x), hyphenate=mode == "hyphenate")
+    return broken, LineBreakStats(mode, pages_before, count_pages(broken, profile), hyphens)
+
+
+def test_break_lines():
+    """Test function to verify lines fit, words stay whole unless hyphenated, and hyphens are counted"""
+    from utils.text_to_braille import text_to_braille
+    text = "information about the remarkable understanding between the printers and their operators"
+    braille = text_to_braille(text, grade=1)
+
+    broken, hyphens = break_lines(braille, width=14)
+    assert hyphens == 0
+    assert all(len(line) <= 14 for line in broken.split("\n"))
+    assert broken.replace("\n", BRAILLE_SPACE) == braille
+
+    broken, hyphens = break_lines(braille, width=14, hyphenate=True)
+    lines = broken.split("\n")
+    assert all(len(line) <= 14 for line in lines)
+    assert hyphens == sum(line.endswith(BRAILLE_HYPHEN) for line in lines) > 0
+    assert len(lines) <= len(break_lines(braille, width=14)[0].split("\n"))
+    # Dropping the added hyphens gives the words back
+    assert "".join(line[:-1] if line.endswith(BRAILLE_HYPHEN) else line + BRAILLE_SPACE
+                   for line in lines).rstrip(BRAILLE_SPACE) == braille
+    # No fragment shorter than MIN_FRAGMENT, and no break between two consonants in a row like "nd"
+    for line, next_line in zip(lines, lines[1:]):
+        if line.endswith(BRAILLE_HYPHEN):
+            assert len(line.split(BRAILLE_SPACE)[-1]) > MIN_FRAGMENT
+            assert len(next_line.split(BRAILLE_SPACE)[0]) >= MIN_FRAGMENT
+            assert _syllable_break(line.split(BRAILLE_SPACE)[-1][:-1] + next_line.split(BRAILLE_SPACE)[0],
+                                   len(line.split(BRAILLE_SPACE)[-1]) - 1)
+
+    # A word's own hyphen is a free break, "com" at the start of a word is not one
+    assert break_lines(text_to_braille("e-mail"), width=5, hyphenate=True) == ("⠑⠤\n⠍⠁⠊⠇", 0)
+    assert _word_pieces(text_to_braille("computer"), True, LINE_CELLS)[0][0] != BRAILLE_HYPHEN
+
+    # A word wider than the line is cut, with a hyphen only when hyphenating
+    assert break_lines("⠁" * 7, width=4) == ("⠁⠁⠁⠁\n⠁⠁⠁", 0)
+    assert break_lines("⠁" * 7, width=4, hyphenate=True) == ("⠁⠁⠁⠤\n⠁⠁⠁⠁", 1)
+    assert break_lines("⠁\n\n\n\n⠃") == ("⠁\n\n⠃", 0)
+
+    # Numbers move to the next line whole, or stay whole when wider than it
+    number = text_to_braille("5551234567")
+    for hyphenate in (False, True):
+        assert break_lines(number, width=9, hyphenate=hyphenate) == (number, 0)
+        broken, hyphens = break_lines(text_to_braille("call 5551234567 now"), width=12, hyphenate=hyphenate)
+        assert hyphens == 0 and number in broken.split("\n")
+
+
+def test_optimize_line_breaks():
+    """Test function to verify the page counts reported before and after re-breaking"""
+    from utils.text_to_braille import text_to_braille
+    paragraphs = [text_to_braille(f"paragraph {i} of the remarkable document") for i in range(40)]
+    braille = "\n\n\n\n".join(paragraphs)
+
+    same, stats = optimize_line_breaks(braille, "none")
+    assert same == braille and stats.pages_before == stats.pages_after == count_pages(braille)
+
+    broken, stats = optimize_line_breaks(braille, "optimal")
+    assert stats.pages_before == count_pages(braille)
+    assert stats.pages_after == count_pages(broken) == count_pages("\n\n".join(paragraphs))
+    assert stats.pages_saved > 0 and stats.hyphens == 0
+
+    _, hyphenated = optimize_line_breaks(braille, "hyphenate")
+    assert hyphenated.pages_after <= stats.pages_after
+    try:
+        optimize_line_breaks(braille, "greedy")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Unknown modes should be rejected")
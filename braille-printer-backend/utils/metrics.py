@@ -0,0 +1,166 @@
+import bisect
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Sequence
+
+# Upper bounds (seconds) of the round-trip latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Punches per second is measured over this many seconds
+RATE_WINDOW = 10.0
+
+
+class Histogram:
+    """Cumulative histogram in the Prometheus style"""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Estimate the q-quantile by interpolating within its bucket, like histogram_quantile"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def render(self, name: str, labels: str) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+class SerialMetrics:
+    """Counters for one printer's serial link. Safe to update from the print thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.commands = 0
+        self.bytes_sent = 0
+        self.resends = 0
+        self.checksum_errors = 0
+        self.line_errors = 0
+        self.busy = 0
+        self.punches = 0
+        self._punch_times = deque()
+
+    def record_sent(self, num_bytes: int):
+        with self._lock:
+            self.bytes_sent += num_bytes
+
+    def record_ack(self, latency: float):
+        with self._lock:
+            self.commands += 1
+            self.latency.observe(latency)
+
+    def record_reply(self, text: str):
+        """Count resends, errors and busy replies"""
+        lower = text.lower()
+        with self._lock:
+            if "resend:" in lower:
+                self.resends += 1
+            elif "checksum mismatch" in lower:
+                self.checksum_errors += 1
+            elif "line number is not" in lower:
+                self.line_errors += 1
+            elif "busy:" in lower:
+                self.busy += 1
+
+    def record_punch(self):
+        now = time.monotonic()
+        with self._lock:
+            self.punches += 1
+            self._punch_times.append(now)
+            self._trim(now)
+
+    def _trim(self, now: float):
+        while self._punch_times and now - self._punch_times[0] > RATE_WINDOW:
+            self._punch_times.popleft()
+
+    def punches_per_second(self) -> float:
+        with self._lock:
+            self._trim(time.monotonic())
+            return len(self._punch_times) / RATE_WINDOW
+
+    def render(self, labels: str) -> Dict[str, List[str]]:
+        """Samples by metric family, so families of several printers can be written together"""
+        rate = self.punches_per_second()
+        with self._lock:
+            return {
+                "braille_serial_command_latency_seconds":
+                    self.latency.render("braille_serial_command_latency_seconds", labels),
+                "braille_serial_commands_total": [f"braille_serial_commands_total{{{labels}}} {self.commands}"],
+                "braille_serial_bytes_sent_total": [f"braille_serial_bytes_sent_total{{{labels}}} {self.bytes_sent}"],
+                "braille_serial_resends_total": [f"braille_serial_resends_total{{{labels}}} {self.resends}"],
+                "braille_serial_checksum_errors_total":
+                    [f"braille_serial_checksum_errors_total{{{labels}}} {self.checksum_errors}"],
+                "braille_serial_line_errors_total": [f"braille_serial_line_errors_total{{{labels}}} {self.line_errors}"],
+                "braille_serial_busy_total": [f"braille_serial_busy_total{{{labels}}} {self.busy}"],
+                "braille_punches_total": [f"braille_punches_total{{{labels}}} {self.punches}"],
+                "braille_punches_per_second": [f"braille_punches_per_second{{{labels}}} {rate}"],
+            }
+
+
+# Name, type and help of every family SerialMetrics.render returns, in output order
+METRIC_FAMILIES = [
+    ("braille_serial_command_latency_seconds", "histogram", "Time from writing a line to its ok"),
+    ("braille_serial_commands_total", "counter", "Lines acknowledged by the printer"),
+    ("braille_serial_bytes_sent_total", "counter", "Bytes written to the serial port"),
+    ("braille_serial_resends_total", "counter", "Resend requests from the printer"),
+    ("braille_serial_checksum_errors_total", "counter", "Lines the printer rejected for a bad checksum"),
+    ("braille_serial_line_errors_total", "counter", "Lines the printer rejected for a wrong line number"),
+    ("braille_serial_busy_total", "counter", "Busy replies from the printer"),
+    ("braille_punches_total", "counter", "Punches acknowledged"),
+    ("braille_punches_per_second", "gauge", f"Punches acknowledged per second over the last {RATE_WINDOW:g}s"),
+]
+
+
+def render_prometheus(metrics_by_port: Dict[str, SerialMetrics]) -> str:
+    """Render every printer's metrics in the Prometheus text format, one block per family"""
+    samples = [metrics.render(f'port="{port}"') for port, metrics in metrics_by_port.items()]
+    lines = []
+    for name, kind, help_text in METRIC_FAMILIES:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        for port_samples in samples:
+            lines += port_samples[name]
+    return "\n".join(lines) + "\n"
+
+
+def test_render_prometheus_groups_families():
+    """Test function to verify each family is written once, followed by all of its samples"""
+    first, second = SerialMetrics(), SerialMetrics()
+    first.record_ack(0.003)
+    second.record_punch()
+    lines = render_prometheus({"/dev/a": first, "/dev/b": second}).splitlines()
+    families = [line.split()[2] for line in lines if line.startswith("# TYPE")]
+    assert families == [name for name, _, _ in METRIC_FAMILIES]
+    current = None
+    for line in lines:
+        if line.startswith("# TYPE"):
+            current = line.split()[2]
+        elif not line.startswith("#"):
+            assert line.startswith(current), f"{line} is outside the {current} block"
+    assert 'braille_punches_total{port="/dev/a"} 0' in lines
+    assert 'braille_punches_total{port="/dev/b"} 1' in lines
@@ -0,0 +1,232 @@
+import math
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict, List, Sequence, Tuple
+
+# Dots whose y coordinates differ by less than this (mm) are treated as one row
+ROW_TOLERANCE = 0.01
+# Bucket size (mm) for the nearest neighbour search, roughly one dot pitch
+GRID_CELL = 3.0
+# 2-opt only tries reversing segments up to this many dots long
+TWO_OPT_WINDOW = 32
+TWO_OPT_MAX_PASSES = 4
+
+
+@dataclass
+class TravelReport:
+    """Head travel (mm) of a page before and after reordering the punches"""
+    strategy: str
+    num_dots: int
+    before: float
+    after: float
+
+    @property
+    def saved(self) -> float:
+        return self.before - self.after
+
+    def __str__(self) -> str:
+        percent = 100 * self.saved / self.before if self.before else 0.0
+        return (f"{self.strategy}: {self.num_dots} punches, travel "
+                f"{self.before:.1f}mm -> {self.after:.1f}mm ({percent:.1f}% saved)")
+
+
+def travel_distance(dots: Sequence, start: Tuple[float, float] = (0.0, 0.0)) -> float:
+    """Total length of the path from start through every dot, in order"""
+    total = 0.0
+    x, y = start
+    for dot in dots:
+        total += math.hypot(dot.x - x, dot.y - y)
+        x, y = dot.x, dot.y
+    return total
+
+
+def order_layout(dots: Sequence, start: Tuple[float, float] = (0.0, 0.0)) -> list:
+    """Keep the order the layout produced (cell by cell)"""
+    return list(dots)
+
+
+def group_rows(dots: Sequence) -> List[list]:
+    """Group dots into rows of equal y, top to bottom"""
+    rows = []
+    last_y = None
+    for dot in sorted(dots, key=lambda d: (d.y, d.x)):
+        if last_y is None or dot.y - last_y > ROW_TOLERANCE:
+            rows.append([])
+        rows[-1].append(dot)
+        last_y = dot.y
+    return rows
+
+
+def group_lines(dots: Sequence) -> List[list]:
+    """
+    Group dot rows into braille lines. The smallest gap between rows is the
+    dot pitch, and a line spans at most two pitches (dots 1 to 3).
+    """
+    rows = group_rows(dots)
+    if len(rows) < 2:
+        return rows
+    pitch = min(b[0].y - a[0].y for a, b in zip(rows, rows[1:]))
+    lines = []
+    top = None
+    for row in rows:
+        if top is None or row[0].y - top > 2 * pitch + ROW_TOLERANCE:
+            lines.append([])
+            top = row[0].y
+        lines[-1].extend(row)
+    return lines
+
+
+def order_serpentine(dots: Sequence, start: Tuple[float, float] = (0.0, 0.0)) -> list:
+    """
+    Sweep each braille line in alternating directions (boustrophedon), so the
+    head never flies back to the left margin. Within a line the dots are taken
+    column by column, zig-zagging up and down.
+
+    Sweeping every dot row separately would cross the page three times per
+    line, which is worse than the layout order, so rows are swept as a band.
+    """
+    ordered = []
+    x, y = start
+    for line in group_lines(dots):
+        columns = group_rows([_Transposed(dot) for dot in line])
+        # Begin each sweep from whichever end is closer to where the head is
+        if abs(columns[-1][0].y - x) < abs(columns[0][0].y - x):
+            columns.reverse()
+        for column in columns:
+            column = [t.dot for t in column]
+            if abs(column[-1].y - y) < abs(column[0].y - y):
+                column.reverse()
+            ordered.extend(column)
+            x, y = column[-1].x, column[-1].y
+    return ordered
+
+
+class _Transposed:
+    """Swaps x and y so group_rows can group a line into columns"""
+    __slots__ = ("dot", "x", "y")
+
+    def __init__(self, dot):
+        self.dot = dot
+        self.x = dot.y
+        self.y = dot.x
+
+
+def order_nearest_neighbor(dots: Sequence, start: Tuple[float, float] = (0.0, 0.0)) -> list:
+    """Greedily punch the closest remaining dot next, using a bucket grid for lookups"""
+    if not dots:
+        return []
+
+    buckets: Dict[Tuple[int, int], List[int]] = defaultdict(list)
+    for i, dot in enumerate(dots):
+        buckets[(int(dot.x // GRID_CELL), int(dot.y // GRID_CELL))].append(i)
+
+    keys = list(buckets.keys())
+    min_cx = min(k[0] for k in keys)
+    max_cx = max(k[0] for k in keys)
+    min_cy = min(k[1] for k in keys)
+    max_cy = max(k[1] for k in keys)
+
+    ordered = []
+    x, y = start
+    while buckets:
+        cx, cy = int(x // GRID_CELL), int(y // GRID_CELL)
+        max_ring = max(abs(cx - min_cx), abs(cx - max_cx), abs(cy - min_cy), abs(cy - max_cy))
+        best, best_key, best_d2 = None, None, math.inf
+        for ring in range(max_ring + 1):
+            for key in _ring_cells(cx, cy, ring):
+                for i in buckets.get(key, ()):
+                    d2 = (dots[i].x - x) ** 2 + (dots[i].y - y) ** 2
+                    if d2 < best_d2:
+                        best, best_key, best_d2 = i, key, d2
+            # Anything in the next ring is at least ring * GRID_CELL away
+            if best is not None and best_d2 <= (ring * GRID_CELL) ** 2:
+                break
+
+        bucket = buckets[best_key]
+        bucket.remove(best)
+        if not bucket:
+            del buckets[best_key]
+        ordered.append(dots[best])
+        x, y = dots[best].x, dots[best].y
+    return ordered
+
+
+def _ring_cells(cx: int, cy: int, ring: int):
+    if ring == 0:
+        yield (cx, cy)
+        return
+    for dx in range(-ring, ring + 1):
+        yield (cx + dx, cy - ring)
+        yield (cx + dx, cy + ring)
+    for dy in range(-ring + 1, ring):
+        yield (cx - ring, cy + dy)
+        yield (cx + ring, cy + dy)
+
+
+def improve_two_opt(dots: Sequence, start: Tuple[float, float] = (0.0, 0.0),
+                    window: int = TWO_OPT_WINDOW, max_passes: int = TWO_OPT_MAX_PASSES) -> list:
+    """
+    Windowed 2-opt: reverse any segment of at most `window` dots that shortens
+    the path. The path is open, so the last dot has no outgoing edge.
+    """
+    path = list(dots)
+    n = len(path)
+    if n < 3:
+        return path
+
+    xs = [start[0]] + [d.x for d in path]
+    ys = [start[1]] + [d.y for d in path]
+
+    def dist(a, b):
+        return math.hypot(xs[a] - xs[b], ys[a] - ys[b])
+
+    # Index 0 is the fixed start point, path dots are 1..n
+    for _ in range(max_passes):
+        improved = False
+        for i in range(0, n - 1):
+            d_ab = dist(i, i + 1)
+            for j in range(i + 2, min(n, i + window) + 1):
+                if j < n:
+                    delta = dist(i, j) + dist(i + 1, j + 1) - d_ab - dist(j, j + 1)
+                else:
+                    delta = dist(i, j) - d_ab
+                if delta < -1e-9:
+                    xs[i + 1:j + 1] = xs[i + 1:j + 1][::-1]
+                    ys[i + 1:j + 1] = ys[i + 1:j + 1][::-1]
+                    path[i:j] = path[i:j][::-1]
+                    d_ab = dist(i, i + 1)
+                    improved = True
+        if not improved:
+            break
+    return path
+
+
+def order_two_opt(dots: Sequence, start: Tuple[float, float] = (0.0, 0.0)) -> list:
+    """Nearest neighbour tour refined with windowed 2-opt"""
+    return improve_two_opt(order_nearest_neighbor(dots, start), start)
+
+
+STRATEGIES = {
+    "layout": order_layout,
+    "serpentine": order_serpentine,
+    "nearest_neighbor": order_nearest_neighbor,
+    "two_opt": order_two_opt,
+}
+
+
+def plan_punch_order(dots: Sequence, strategy: str = "serpentine",
+                     start: Tuple[float, float] = (0.0, 0.0)) -> Tuple[list, TravelReport]:
+    """
+    Order punched dots for minimal head travel.
+
+    :param dots: Dots to punch, anything with x and y attributes
+    :param strategy: One of STRATEGIES
+    :param start: Head position before the first punch, in the same coordinates as the dots
+    :return: (reordered dots, travel report)
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Invalid punch order strategy: {strategy}")
+    ordered = STRATEGIES[strategy](dots, start)
+    report = TravelReport(strategy, len(ordered),
+                          travel_distance(dots, start), travel_distance(ordered, start))
+    return ordered, report
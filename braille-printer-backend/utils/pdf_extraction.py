@@ -1,18 +1,59 @@
-import fitz  # PyMuPDF
 import os
 from dotenv import load_dotenv
-import anthropic
 import base64
-from groq import Groq
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+import multiprocessing
+import re
+import tempfile
+import threading
 import time
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
+
+from utils.pipeline_cache import content_key
+
+# PyMuPDF, the model SDKs and selenium are imported on first use, so importing
+# this module (and starting the server) stays cheap and has no side effects.
 
 load_dotenv()
-claude_client = anthropic.Anthropic()
-groq_client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+
+
+def _make_claude_client():
+    import anthropic
+    return anthropic.Anthropic()
+
+
+def _make_groq_client():
+    from groq import Groq
+    return Groq(api_key=os.getenv("GROQ_API_KEY"))
+
+
+# Model backends by name. Clients are only created when first asked for.
+CLIENT_FACTORIES = {
+    "claude": _make_claude_client,
+    "groq": _make_groq_client,
+}
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def register_backend(name, factory):
+    """Add or replace a backend, e.g. with a stub client for benchmarks"""
+    with _clients_lock:
+        CLIENT_FACTORIES[name] = factory
+        _clients.pop(name, None)
+
+
+def get_client(name):
+    """Client for a registered backend, created on first use"""
+    with _clients_lock:
+        if name not in _clients:
+            if name not in CLIENT_FACTORIES:
+                raise ValueError(f"Unknown model backend: {name}")
+            _clients[name] = CLIENT_FACTORIES[name]()
+        return _clients[name]
+
 
 claude_model = "claude-3-haiku-20240307"
 groq_model = "llama-3.2-11b-vision-preview"
@@ -20,19 +61,177 @@ groq_model = "llama-3.2-11b-vision-preview"
 groq_text_model = "llama3-8b-8192"
 groq_fast_model = "llama-3.2-1b-preview"
 
+# Image descriptions run concurrently, at most this many requests at once
+IMAGE_CONCURRENCY = int(os.getenv("IMAGE_CONCURRENCY", "8"))
+# Seconds before a single image description request is given up on
+IMAGE_TIMEOUT = float(os.getenv("IMAGE_TIMEOUT", "30"))
+IMAGE_FALLBACK = "Image (no description available)"
+# Images smaller than this many pixels, or drawn smaller than this many points,
+# on either side are taken as bullets, rules and other decoration and skipped
+MIN_IMAGE_PIXELS = int(os.getenv("MIN_IMAGE_PIXELS", "16"))
+MIN_IMAGE_POINTS = float(os.getenv("MIN_IMAGE_POINTS", "12"))
+# Pipeline cache stage holding image descriptions, keyed by image hash and model
+DESCRIPTION_STAGE = "image_description"
+
+# Processes extracting pages of one document in parallel
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Documents shorter than this are extracted in process, workers would cost more than they save
+PARALLEL_MIN_PAGES = 16
+# Pages a worker extracts per task, and tasks per worker submitted ahead of the reader
+PAGES_PER_TASK = 4
+TASKS_PER_WORKER = 2
+
+# How format_elements cleans up text: "llm" asks groq_text_model, "local" runs
+# local_cleanup without any network, "auto" uses local for pages without images
+FORMAT_MODE = os.getenv("BRAILLE_FORMAT_MODE", "llm")
+# Characters per formatting request, well within the model's context with room for the answer
+FORMAT_CHUNK_CHARS = int(os.getenv("FORMAT_CHUNK_CHARS", "8000"))
+# Formatting requests run concurrently, at most this many at once
+FORMAT_CONCURRENCY = int(os.getenv("FORMAT_CONCURRENCY", "8"))
+
+
+class GroqImageDescriber:
+    """Describes one image query with a Groq vision model"""
+    def __init__(self, client, model=groq_model):
+        self.client = client
+        self.model = model
+
+    def __call__(self, query, timeout):
+        response = self.client.chat.completions.create(
+            model=self.model,
+            messages=query['groq_payload']["messages"],
+            max_tokens=1000,
+            timeout=timeout,
+        )
+        return response.choices[0].message.content
+
+
+class ClaudeImageDescriber:
+    """Describes one image query with a Claude model"""
+    def __init__(self, client, model=claude_model):
+        self.client = client
+        self.model = model
+
+    def __call__(self, query, timeout):
+        response = self.client.messages.create(
+            model=self.model,
+            max_tokens=1000,
+            messages=[{"role": "user", "content": query['claude_payload']}],
+            timeout=timeout,
+        )
+        return response.content[0].text
+
+
+class StubImageDescriber:
+    """Stands in for a model with a fixed latency, for benchmarks and offline runs"""
+    def __init__(self, latency=0.5, description="An image."):
+        self.latency = latency
+        self.description = description
+
+    def __call__(self, query, timeout):
+        time.sleep(min(self.latency, timeout))
+        if self.latency > timeout:
+            raise TimeoutError(f"Stub took longer than {timeout}s")
+        return self.description
+
+
+def get_image_describer(model):
+    if 'claude' in model:
+        return ClaudeImageDescriber(get_client("claude"), model)
+    return GroqImageDescriber(get_client("groq"), model)
+
+
+def describe_images(image_queries, describer, max_workers=IMAGE_CONCURRENCY, timeout=IMAGE_TIMEOUT):
+    """
+    Describe images concurrently with at most max_workers requests in flight.
+    Returns descriptions in the same order as image_queries. A request that
+    fails or times out gets IMAGE_FALLBACK instead of failing the document.
+    """
+    if not image_queries:
+        return []
+
+    def describe(query):
+        try:
+            return describer(query, timeout)
+        except Exception as e:
+            print(f"Image description failed: {e}")
+            return IMAGE_FALLBACK
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(image_queries)))) as pool:
+        return list(pool.map(describe, image_queries))
 
-def extract_text_from_pdf(pdf_input, input_type="data"):
+
+def describer_name(describer):
+    """What a describer's descriptions are cached under"""
+    return getattr(describer, "model", type(describer).__name__)
+
+
+def describe_unique_images(image_queries, describer, cache=None, known=None, max_workers=IMAGE_CONCURRENCY):
+    """
+    Like describe_images, but queries with the same image 'hash' share one
+    description. Descriptions are looked up in `known` (hash -> description,
+    filled in as a side effect so it can be carried across pages) and then in
+    the pipeline cache, so only images never seen with this describer reach
+    the model. Fallbacks for failed requests are not cached.
+    """
+    known = {} if known is None else known
+    name = describer_name(describer)
+    missing = {}
+    for query in image_queries:
+        digest = query['hash']
+        if digest in known or digest in missing:
+            continue
+        description = cache.get(content_key(digest, name), DESCRIPTION_STAGE) if cache is not None else None
+        if description is not None:
+            known[digest] = description
+        else:
+            missing[digest] = query
+
+    for digest, description in zip(missing, describe_images(list(missing.values()), describer, max_workers)):
+        known[digest] = description
+        if cache is not None and description != IMAGE_FALLBACK:
+            cache.put(content_key(digest, name), DESCRIPTION_STAGE, description)
+    return [known[query['hash']] for query in image_queries]
+
+
+def open_pdf(pdf_input, input_type="data"):
+    import fitz  # PyMuPDF
     if input_type == "path":
-        pdf_doc = fitz.open(pdf_input)  # Open PDF
+        return fitz.open(pdf_input)  # Open PDF
     elif input_type == "data":
-        pdf_doc = fitz.open(stream=pdf_input, filetype="pdf")  # Open PDF from bytes
+        return fitz.open(stream=pdf_input, filetype="pdf")  # Open PDF from bytes
     else:
         raise ValueError("Invalid input type")
-    elements = extract_elements_with_positions(pdf_doc)
+
+
+def extract_text_from_pdf(pdf_input, input_type="data", cache=None):
+    pdf_doc = open_pdf(pdf_input, input_type)
+    elements = extract_elements_with_positions(pdf_doc, cache=cache)
     return format_elements(elements)
 
 
+def iter_text_from_pdf(pdf_input, input_type="data", model=groq_model, describer=None, cache=None):
+    """
+    Like extract_text_from_pdf, but yields the formatted text of each page as
+    soon as it is ready, so later stages can start on page 1 right away.
+    """
+    pdf_doc = open_pdf(pdf_input, input_type)
+    describer = describer or get_image_describer(model)
+    known = {}
+    for elements, image_queries in iter_page_elements(pdf_doc):
+        descriptions = describe_unique_images(image_queries, describer, cache, known)
+        for description, query in zip(descriptions, image_queries):
+            elements.append(("image", description, query['position']))
+        if elements:
+            yield format_elements(sort_page_elements(elements))
+
+
 def get_full_transcript(zoom_url):
+    from selenium import webdriver
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+
     # Set up headless Chrome driver
     options = webdriver.ChromeOptions()
     options.add_argument('--headless')
@@ -116,7 +315,7 @@ Focus on:
 
     # Submit all chunks in parallel
     responses = [
-        groq_client.chat.completions.create(
+        get_client("groq").chat.completions.create(
             model=groq_fast_model,
             **prompt
         ) for prompt in prompts
@@ -137,7 +336,7 @@ Focus on:
 
 Make it clear and well-structured."""
     print("final prompt", len(final_prompt))
-    final_response = groq_client.chat.completions.create(
+    final_response = get_client("groq").chat.completions.create(
         model=groq_text_model,
         messages=[
             {"role": "user", "content": final_prompt}
@@ -148,21 +347,84 @@ Make it clear and well-structured."""
     return final_response.choices[0].message.content.strip()
 
 
-def format_elements(elements):
-    """
-    Formats the elements list by adding newlines between text elements and brackets around image descriptions.
-
-    :param elements: List of tuples (type, content, position) from extract_elements_with_positions
-    :return: Formatted string with the elements properly separated
-    """
-    formatted_text = ""
+def element_paragraphs(elements):
+    """Text of each element, with image descriptions in brackets"""
+    paragraphs = []
     for element_type, content, _ in elements:
         if element_type == "text":
-            formatted_text += content + "\n"
+            paragraphs.append(content)
         elif element_type == "image":
-            formatted_text += f"[{content}]\n"
+            paragraphs.append(f"[{content}]")
         else:
             raise ValueError(f"Invalid element type: {element_type}")
+    return paragraphs
+
+
+def chunk_paragraphs(paragraphs, max_chars=FORMAT_CHUNK_CHARS):
+    """
+    Group paragraphs into chunks of at most max_chars, never splitting a
+    paragraph unless it is longer than a chunk on its own. Those are split
+    at line breaks, or at spaces for a single overlong line.
+    """
+    pieces = []
+    for paragraph in paragraphs:
+        while len(paragraph) > max_chars:
+            cut = paragraph.rfind("\n", 0, max_chars)
+            if cut <= 0:
+                cut = paragraph.rfind(" ", 0, max_chars)
+            if cut <= 0:
+                cut = max_chars
+            pieces.append(paragraph[:cut])
+            paragraph = paragraph[cut:].lstrip()
+        pieces.append(paragraph)
+
+    chunks, chunk, length = [], [], 0
+    for piece in pieces:
+        if chunk and length + len(piece) + 1 > max_chars:
+            chunks.append(chunk)
+            chunk, length = [], 0
+        chunk.append(piece)
+        length += len(piece) + 1
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+# A line that starts a list item, so reflow keeps it on its own line
+_LIST_ITEM = re.compile(r"^([-*\u2022\u25cf\u25aa]|\(?\d+[.)]|\(?[a-z][.)])\s")
+# A word broken at the end of a line: "infor-\nmation"
+_LINE_HYPHEN = re.compile(r"(\w)-\n\s*([a-z])")
+
+
+def local_cleanup(text):
+    """
+    Deterministic stand-in for the LLM cleanup: joins words hyphenated across
+    line breaks, reflows the hard-wrapped lines of a paragraph into one,
+    keeps list items and bracketed image descriptions on their own lines,
+    and leaves exactly one blank line between paragraphs.
+    """
+    text = text.replace("\r\n", "\n").replace("\t", " ")
+    text = _LINE_HYPHEN.sub(r"\1\2", text)
+    paragraphs = []
+    for block in re.split(r"\n\s*\n", text):
+        lines = []
+        for line in block.split("\n"):
+            line = " ".join(line.split())
+            if not line:
+                continue
+            starts_own_line = _LIST_ITEM.match(line) or line.startswith("[")
+            if lines and not starts_own_line and not lines[-1].endswith("]"):
+                lines[-1] += " " + line
+            else:
+                lines.append(line)
+        if lines:
+            paragraphs.append("\n".join(lines))
+    return "\n\n".join(paragraphs)
+
+
+def format_chunk(paragraphs):
+    """One LLM cleanup request. Falls back to local_cleanup if the request fails."""
+    formatted_text = "\n".join(paragraphs) + "\n"
 
     # Use Groq to format and clean up the text
     groq_prompt = f"""Format and clean up this text to be more readable while preserving all information:
@@ -175,110 +437,260 @@ Make sure to:
 3. Remove any redundant newlines
 4. Ensure consistent formatting"""
 
-    response = groq_client.chat.completions.create(
-        model=groq_text_model,
-        messages=[
-            {"role": "user", "content": groq_prompt}
+    try:
+        response = get_client("groq").chat.completions.create(
+            model=groq_text_model,
+            messages=[
+                {"role": "user", "content": groq_prompt}
+            ],
+            temperature=0.1,
+        )
+        return response.choices[0].message.content.strip()
+    except Exception as e:
+        print(f"Formatting failed, cleaning up locally: {e}")
+        return local_cleanup("\n\n".join(paragraphs))
+
+
+def format_elements(elements, mode=None, max_workers=FORMAT_CONCURRENCY):
+    """
+    Formats the elements list by adding newlines between text elements and brackets around image descriptions.
+
+    :param elements: List of tuples (type, content, position) from extract_elements_with_positions
+    :param mode: "llm", "local" or "auto", FORMAT_MODE if not given
+    :param max_workers: Number of formatting requests sent at once in "llm" mode
+    :return: Formatted string with the elements properly separated
+    """
+    mode = mode or FORMAT_MODE
+    paragraphs = element_paragraphs(elements)
+    if mode == "auto":
+        mode = "llm" if any(element_type == "image" for element_type, _, _ in elements) else "local"
+    if mode == "local":
+        return local_cleanup("\n\n".join(paragraphs))
+    if mode != "llm":
+        raise ValueError(f"Invalid format mode: {mode}")
+
+    # Paragraph-aligned chunks are cleaned up concurrently and stitched back in order
+    chunks = chunk_paragraphs(paragraphs)
+    if not chunks:
+        return ""
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks)))) as pool:
+        formatted = list(pool.map(format_chunk, chunks))
+    return "\n\n".join(text for text in formatted if text)
+
+
+def image_query(image_bytes, img_ext):
+    """Description query for one image, in the payload formats of both model backends"""
+    # Convert image bytes to base64 for Claude
+    image_b64 = base64.b64encode(image_bytes).decode('utf-8')
+
+    # Store query info for both models
+    return {
+        'hash': content_key(image_bytes),
+        'claude_payload': [
+            {
+                "type": "image",
+                "source": {
+                    "type": "base64",
+                    "media_type": f"image/{img_ext}",
+                    "data": image_b64,
+                },
+            },
+            {
+                "type": "text",
+                "text": "Please describe this image in less than 3 sentences."
+            }
         ],
-        temperature=0.1,
-    )
-    formatted_text = response.choices[0].message.content
-    return formatted_text.strip()
+        'groq_payload': {
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": f"data:image/{img_ext};base64,{image_b64}"
+                            }
+                        },
+                        {
+                            "type": "text",
+                            "text": "Briefly describe this image in less than 3 sentences."
+                        }
+                    ]
+                }
+            ]
+        },
+    }
 
 
-def extract_elements_with_positions(pdf_doc, model=groq_model):
+def extract_page_elements(pdf_doc, page_num, images=None):
     """
-    Extracts text and images from a PDF while preserving their order and positions.
-    Uses both Claude and Groq models for image analysis.
+    Text blocks and image description queries of one page. Images below
+    MIN_IMAGE_PIXELS or drawn below MIN_IMAGE_POINTS are left out.
 
-    :param pdf_path: Path to the PDF file.
-    :param output_folder: Folder to save extracted images.
-    :return: List of elements in order with positions [(type, content, (x, y, width, height))].
-    """  # Ensure output directory exists
+    :param images: xref -> query of images already extracted from this
+        document, filled in as a side effect. A logo on every page is then
+        decoded and encoded once, and its queries share the payload.
+    :return: ([("text", content, (x, y, width, height))], [image query])
+    """
     elements = []
     image_queries = []
+    images = {} if images is None else images
+    page = pdf_doc[page_num]
+
+    # Extract text with positions
+    for text in page.get_text("blocks"):  # "blocks" returns text as (x0, y0, x1, y1, text, ...)
+        x0, y0, x1, y1, content = text[:5]
+        elements.append(("text", content.strip(), (x0, y0, x1 - x0, y1 - y0)))
+
+    # Extract images with positions and prepare queries
+    for img in page.get_images(full=True):
+        xref, width, height = img[0], img[2], img[3]
+        if width < MIN_IMAGE_PIXELS or height < MIN_IMAGE_PIXELS:
+            continue
+        rects = page.get_image_rects(xref)
+        if not rects:
+            continue  # listed as a page resource, but not drawn
+        x0, y0, x1, y1 = rects[0]  # Get bounding box (x0, y0, x1, y1)
+        if x1 - x0 < MIN_IMAGE_POINTS or y1 - y0 < MIN_IMAGE_POINTS:
+            continue
+
+        if xref not in images:
+            base_image = pdf_doc.extract_image(xref)
+            images[xref] = dict(image_query(base_image["image"], base_image["ext"]), xref=xref)
+        image_queries.append(dict(images[xref], position=(x0, y0, x1 - x0, y1 - y0)))
+    return elements, image_queries
 
-    for page_num in range(len(pdf_doc)):
-        page = pdf_doc[page_num]
 
-        # Extract text with positions
-        for text in page.get_text("blocks"):  # "blocks" returns text as (x0, y0, x1, y1, text, ...)
-            x0, y0, x1, y1, content = text[:5]
-            elements.append(("text", content.strip(), (x0, y0, x1 - x0, y1 - y0)))
+_extract_pool = None
+_extract_pool_lock = threading.Lock()
 
-        # Extract images with positions and prepare queries
-        for img_index, img in enumerate(page.get_images(full=True)):
-            xref = img[0]
-            base_image = pdf_doc.extract_image(xref)
-            image_bytes = base_image["image"]
-            img_ext = base_image["ext"]
-            bbox = page.get_image_rects(xref)[0]  # Get bounding box (x0, y0, x1, y1)
-            x0, y0, x1, y1 = bbox
 
-            # Convert image bytes to base64 for Claude
-            image_b64 = base64.b64encode(image_bytes).decode('utf-8')
+def _get_extract_pool(workers):
+    global _extract_pool
+    # Spawned rather than forked: the server has threads, and a fork could copy held locks
+    with _extract_pool_lock:
+        if _extract_pool is None:
+            _extract_pool = ProcessPoolExecutor(workers, multiprocessing.get_context("spawn"))
+        return _extract_pool
 
-            # Store query info for both models
-            image_queries.append({
-                'claude_payload': [
-                    {
-                        "type": "image",
-                        "source": {
-                            "type": "base64",
-                            "media_type": f"image/{img_ext}",
-                            "data": image_b64,
-                        },
-                    },
-                    {
-                        "type": "text",
-                        "text": "Please describe this image in less than 3 sentences."
-                    }
-                ],
-                'groq_payload': {
-                    "messages": [
-                        {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "type": "image_url",
-                                    "image_url": {
-                                        "url": f"data:image/{img_ext};base64,{image_b64}"
-                                    }
-                                },
-                                {
-                                    "type": "text",
-                                    "text": "Briefly describe this image in less than 3 sentences."
-                                }
-                            ]
-                        }
-                    ]
-                },
-                'position': (x0, y0, x1 - x0, y1 - y0)
-            })
 
-    # Send all image queries in parallel to both models
-    if 'claude' in model:
-        responses = claude_client.messages.create(
-            model=model,
-            max_tokens=1000,
-            messages=[{"role": "user", "content": query['claude_payload']} for query in image_queries]
-        )
-        # Add image descriptions to elements list
-        for response, query in zip(responses, image_queries):
-            for response in response:
-                elements.append(("image", response, query['position']))
-    else:
-        responses = [
-            groq_client.chat.completions.create(
-                model=groq_model,
-                messages=query['groq_payload']["messages"],
-                max_tokens=1000
-            ) for query in image_queries
-        ]
-        # Add image descriptions to elements list
-        for response, query in zip(responses, image_queries):
-            elements.append(("image", response.choices[0].message.content, query['position']))
-    return sorted(elements, key=lambda e: e[2][1])  # Sort by y-coordinate for top-down order
+def _reset_extract_pool():
+    """Drop a broken pool, e.g. after a worker ran out of memory, so the next document starts a new one"""
+    global _extract_pool
+    with _extract_pool_lock:
+        _extract_pool = None
+
+
+@lru_cache(maxsize=4)
+def _worker_document(path, token):
+    """A worker's own copy of the document, and the images it has already sent for this run"""
+    return open_pdf(path, "path"), {}
+
+
+def _extract_pages(path, token, page_nums):
+    """Runs in a worker: elements and image queries of some pages"""
+    pdf_doc, images = _worker_document(path, token)
+    pages = []
+    for page_num in page_nums:
+        pages.append(extract_page_elements(pdf_doc, page_num, images))
+        # Later placements only need the xref, the reader keeps the payload from here
+        for xref in images:
+            images[xref] = {'xref': xref}
+    return pages
+
+
+def sort_page_elements(elements):
+    """Top-down order within a page. Ties keep their order, so text stays ahead of images."""
+    return sorted(elements, key=lambda e: e[2][1])
+
+
+def iter_page_elements(pdf_doc, workers=EXTRACT_WORKERS):
+    """
+    Yield (elements, image queries) for every page, in page order. Long
+    documents are extracted by `workers` processes, each opening the document
+    itself. At most TASKS_PER_WORKER tasks per worker are in flight, so
+    memory holds a few pages rather than the whole book. Image queries of
+    the same xref share one payload.
+    """
+    num_pages = len(pdf_doc)
+    if workers <= 1 or num_pages < PARALLEL_MIN_PAGES:
+        images = {}
+        for page_num in range(num_pages):
+            yield extract_page_elements(pdf_doc, page_num, images)
+        return
+
+    # Workers open the document by path, so documents from bytes go to a temporary file
+    path, temporary = pdf_doc.name, None
+    if not path or not os.path.isfile(path):
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+            f.write(pdf_doc.tobytes())
+        path = temporary = f.name
+    token = (os.getpid(), threading.get_ident(), time.monotonic_ns())
+
+    pool = _get_extract_pool(workers)
+    tasks = iter(range(0, num_pages, PAGES_PER_TASK))
+    in_flight = deque()
+    images = {}
+    try:
+        while True:
+            while len(in_flight) < workers * TASKS_PER_WORKER:
+                start = next(tasks, None)
+                if start is None:
+                    break
+                page_nums = range(start, min(start + PAGES_PER_TASK, num_pages))
+                in_flight.append(pool.submit(_extract_pages, path, token, page_nums))
+            if not in_flight:
+                return
+            try:
+                pages = in_flight.popleft().result()
+            except BrokenProcessPool:
+                _reset_extract_pool()
+                raise
+            for elements, image_queries in pages:
+                resolved = []
+                for query in image_queries:
+                    base = images.setdefault(query['xref'], query)
+                    resolved.append(dict(base, position=query['position']))
+                yield elements, resolved
+    finally:
+        for future in in_flight:
+            future.cancel()
+        if temporary:
+            os.remove(temporary)
+
+
+def extract_elements_with_positions(pdf_doc, model=groq_model, describer=None, max_workers=IMAGE_CONCURRENCY,
+                                    cache=None, workers=EXTRACT_WORKERS):
+    """
+    Extracts text and images from a PDF while preserving their order and positions.
+    Uses either a Claude or a Groq model for image analysis. Each distinct
+    image is described once per document, and not at all if the pipeline
+    cache already has its description.
+
+    :param pdf_doc: Opened PyMuPDF document.
+    :param model: Model used to describe images, unless a describer is given.
+    :param describer: Callable (query, timeout) -> description, e.g. StubImageDescriber.
+    :param max_workers: Number of image descriptions requested at once.
+    :param cache: PipelineCache for image descriptions, or None to ask the model every time.
+    :param workers: Processes extracting pages, see iter_page_elements.
+    :return: List of elements in order with positions [(type, content, (x, y, width, height))],
+        page by page and top-down within a page.
+    """
+    pages = []
+    image_queries = []
+
+    for page_elements, page_image_queries in iter_page_elements(pdf_doc, workers):
+        pages.append(page_elements)
+        image_queries.extend((len(pages) - 1, query) for query in page_image_queries)
+
+    # Send all image queries in parallel
+    describer = describer or get_image_describer(model)
+    descriptions = describe_unique_images([query for _, query in image_queries], describer, cache,
+                                          max_workers=max_workers)
+    # Add image descriptions to the elements of their page
+    for description, (page_index, query) in zip(descriptions, image_queries):
+        pages[page_index].append(("image", description, query['position']))
+    return [element for page_elements in pages for element in sort_page_elements(page_elements)]
 
 
 def test_model(model):
@@ -288,6 +700,16 @@ def test_model(model):
     print(f"Time taken: {end - start} seconds")
 
 
+def benchmark_image_descriptions(num_images=32, latency=0.5, max_workers=IMAGE_CONCURRENCY):
+    """Time describe_images against a stub with simulated model latency"""
+    queries = [{'position': (0, i, 0, 0)} for i in range(num_images)]
+    start = time.time()
+    describe_images(queries, StubImageDescriber(latency), max_workers)
+    end = time.time()
+    print(f"{num_images} images, {max_workers} workers, {latency}s latency: {end - start:.2f} seconds "
+          f"(sequential would take {num_images * latency:.2f})")
+
+
 def test_groq_image():
     # Read and encode the test image
     with open("test.png", "rb") as img_file:
@@ -316,7 +738,7 @@ def test_groq_image():
     }
 
     # Send request to Groq
-    response = groq_client.chat.completions.create(
+    response = get_client("groq").chat.completions.create(
         model=groq_model,
         messages=payload["messages"],
         max_tokens=1000
@@ -330,5 +752,3 @@ def test_groq_image():
 # test_model(groq_model)
 # test_groq_image()
 
-print(extract_text_from_zoom("https://us04web.zoom.us/rec/play/oXI-CSzD0NWzsxNATlCxBYPEZouXI9kWJ1jjMMHWN49yVAdvhZ9jUtECtVnaRy6qOTSKEH7RkN32gRx8.3tz9oNZiRYWODs8A?accessLevel=meeting&canPlayFromShare=true&from=share_recording_detail&continueMode=true&componentName=rec-play&originRequestUrl=https%3A%2F%2Fus04web.zoom.us%2Frec%2Fshare%2FIFMNlVsAA2LQaRPLZDnRzoBsx48kqko3pcfZRmY3g31Vur5a4Iwy4oOdPWsHih6w.mKp3UDiKLnOClM7y%3FfromShareWithMe%3Dtrue")
-)
\ No newline at end of file
@@ -0,0 +1,262 @@
+import zlib
+from dataclasses import dataclass
+from typing import Iterable, List, Optional, Union
+
+import numpy as np
+
+from utils.braille_to_gcode import DIST_DIAM_DOT, GHOST_GREY, INTERPOINT, MM_PER_UNIT, DotPosition, ghost_position
+from utils.fast_layout import DotArrays
+from utils.layout_profile import DEFAULT_PROFILE, LayoutProfile
+
+# PDF points per mm
+PT_PER_MM = 72 / 25.4
+DOT_DIAMETER = DIST_DIAM_DOT * MM_PER_UNIT  # mm
+# Outline width of hollow dots, fpdf's default of 0.2 mm
+LINE_WIDTH = 0.2
+# How far a dot may be off the cell grid and still snap to it (mm)
+SNAP_TOLERANCE = 1e-6
+# Bezier control point distance for a quarter circle
+KAPPA = 0.5522847498
+
+
+@dataclass
+class CellStamps:
+    """Dots grouped into cells: which of the six dots each cell has and punches"""
+    page: np.ndarray
+    x: np.ndarray  # mm, character top left
+    y: np.ndarray
+    punched: np.ndarray  # 6 bit masks, bit k is dot k+1
+    present: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.page)
+
+
+def page_size_pt(profile: LayoutProfile = DEFAULT_PROFILE):
+    """Width and height of the profile's paper in PDF points"""
+    return (profile.paper_width * profile.mm_per_unit * PT_PER_MM,
+            profile.paper_height * profile.mm_per_unit * PT_PER_MM)
+
+
+def dots_to_cells(dots: DotArrays, profile: LayoutProfile = DEFAULT_PROFILE):
+    """
+    Group dots into the cells of the profile's layout. Returns the cells and
+    the dots that are not on the cell grid, which are drawn one by one.
+    """
+    x, y = dots.x, dots.y
+    column_x, row_y = profile.column_x, profile.row_y
+    pitch = profile.dot_offsets[3][0] * profile.mm_per_unit
+    col = np.clip(np.searchsorted(column_x, x + SNAP_TOLERANCE, side="right") - 1, 0, len(column_x) - 1)
+    row = np.clip(np.searchsorted(row_y, y + SNAP_TOLERANCE, side="right") - 1, 0, len(row_y) - 1)
+    dot_col = np.rint((x - column_x[col]) / pitch)
+    dot_row = np.rint((y - row_y[row]) / pitch)
+    on_grid = ((dot_col >= 0) & (dot_col <= 1) & (dot_row >= 0) & (dot_row <= 2)
+               & (np.abs(x - column_x[col] - dot_col * pitch) < SNAP_TOLERANCE)
+               & (np.abs(y - row_y[row] - dot_row * pitch) < SNAP_TOLERANCE))
+
+    # Cell key in reading order, so cells come out sorted by page
+    key = ((dots.page[on_grid] * len(row_y) + row[on_grid]) * len(column_x) + col[on_grid])
+    bit = (1 << (dot_col[on_grid] * 3 + dot_row[on_grid]).astype(np.int64))
+    keys, cell = np.unique(key, return_inverse=True)
+    punched = np.zeros(len(keys), dtype=np.int64)
+    present = np.zeros(len(keys), dtype=np.int64)
+    np.bitwise_or.at(present, cell, bit)
+    np.bitwise_or.at(punched, cell, np.where(dots.punch[on_grid], bit, 0))
+
+    cells_per_page = len(row_y) * len(column_x)
+    cells = CellStamps(
+        page=keys // cells_per_page,
+        x=column_x[keys % len(column_x)],
+        y=row_y[(keys // len(column_x)) % len(row_y)],
+        punched=punched,
+        present=present,
+    )
+    off_grid = np.flatnonzero(~on_grid)
+    loose = DotArrays(x[off_grid], y[off_grid], dots.page[off_grid], dots.punch[off_grid], dots.num_pages)
+    return cells, loose
+
+
+def _circle(cx: float, cy: float, r: float) -> str:
+    """Path of a circle in PDF points, as four Bezier curves"""
+    k = KAPPA * r
+    return (f"{cx + r:.2f} {cy:.2f} m "
+            f"{cx + r:.2f} {cy + k:.2f} {cx + k:.2f} {cy + r:.2f} {cx:.2f} {cy + r:.2f} c "
+            f"{cx - k:.2f} {cy + r:.2f} {cx - r:.2f} {cy + k:.2f} {cx - r:.2f} {cy:.2f} c "
+            f"{cx - r:.2f} {cy - k:.2f} {cx - k:.2f} {cy - r:.2f} {cx:.2f} {cy - r:.2f} c "
+            f"{cx + k:.2f} {cy - r:.2f} {cx + r:.2f} {cy - k:.2f} {cx + r:.2f} {cy:.2f} c")
+
+
+def _dot(x: float, y: float, punch: bool, diameter: float = DOT_DIAMETER) -> str:
+    """A dot with its bounding box at (x, y) mm from the origin, y down, like fpdf's ellipse"""
+    r = diameter / 2 * PT_PER_MM
+    path = _circle((x + diameter / 2) * PT_PER_MM, -(y + diameter / 2) * PT_PER_MM, r)
+    return path + (" f" if punch else " S")
+
+
+def _cell_form(punched: int, present: int, profile: LayoutProfile = DEFAULT_PROFILE) -> bytes:
+    """Drawing of one cell pattern, origin at the character's top left"""
+    ops = [f"{LINE_WIDTH * PT_PER_MM:.2f} w"]
+    diameter = profile.dist_diam_dot * profile.mm_per_unit
+    for k, (dx, dy) in enumerate(profile.dot_offsets * profile.mm_per_unit):
+        if present >> k & 1:
+            ops.append(_dot(dx, dy, bool(punched >> k & 1), diameter))
+    return "\n".join(ops).encode()
+
+
+def parse_page_range(text: Optional[str], num_pages: Optional[int] = None) -> Optional[List[int]]:
+    """
+    '2', '0-3' or '0-2,5' to page numbers (0-based, like DotPosition.page).
+    None means all. Ranges are clamped to `num_pages`. Raises ValueError for
+    anything that is not a range, reversed ranges and ranges that leave no
+    page of the document.
+    """
+    if not text:
+        return None
+    pages = []
+    for part in text.split(","):
+        start, dash, end = part.strip().partition("-")
+        if not start.isdigit() or (dash and not end.isdigit()):
+            raise ValueError(f"Page range {part.strip()!r} should look like 0-2,5")
+        start, end = int(start), int(end or start)
+        if end < start:
+            raise ValueError(f"Page range {start}-{end} is reversed")
+        if num_pages is not None:
+            end = min(end, num_pages - 1)
+        pages.extend(range(start, end + 1))
+    if num_pages is not None and not pages:
+        raise ValueError(f"No pages in {text!r}, the document has {num_pages} (numbered from 0)")
+    return pages
+
+
+class _PdfWriter:
+    def __init__(self):
+        self.objects = []
+
+    def reserve(self) -> int:
+        self.objects.append(None)
+        return len(self.objects)
+
+    def set(self, number: int, body: bytes):
+        self.objects[number - 1] = body
+
+    def add(self, body: bytes) -> int:
+        self.objects.append(body)
+        return len(self.objects)
+
+    def add_stream(self, dictionary: str, data: bytes) -> int:
+        data = zlib.compress(data)
+        return self.add(f"<< {dictionary} /Filter /FlateDecode /Length {len(data)} >>\nstream\n".encode()
+                        + data + b"\nendstream")
+
+    def output(self, root: int) -> bytes:
+        parts = [b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"]
+        offsets = []
+        size = len(parts[0])
+        for number, body in enumerate(self.objects, 1):
+            offsets.append(size)
+            chunk = f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+            parts.append(chunk)
+            size += len(chunk)
+        xref = [f"xref\n0 {len(self.objects) + 1}\n0000000000 65535 f \n"]
+        xref += [f"{offset:010d} 00000 n \n" for offset in offsets]
+        xref.append(f"trailer\n<< /Size {len(self.objects) + 1} /Root {root} 0 R >>\n"
+                    f"startxref\n{size}\n%%EOF\n")
+        parts.append("".join(xref).encode())
+        return b"".join(parts)
+
+
+def render_preview(dots: Union[DotArrays, List[DotPosition]], pages: Optional[Iterable[int]] = None,
+                   interpoint: bool = INTERPOINT, profile: LayoutProfile = DEFAULT_PROFILE) -> bytes:
+    """
+    Render dots as a PDF that looks like dot_pos_to_pdf's, but with every
+    cell pattern drawn once as a Form XObject and placed per cell, so the
+    file holds one short instruction per cell instead of six ellipses.
+    `pages` limits the output to those page numbers. With interpoint, the
+    punches of the other side of each sheet are drawn in grey. The profile
+    gives the page size and the cell grid the dots are snapped to.
+    """
+    if not isinstance(dots, DotArrays):
+        dots = DotArrays.from_dot_positions(dots)
+    ghosts = None
+    if interpoint:
+        punched = dots.punched()
+        x, y = ghost_position(punched.x, punched.y, punched.page, profile)
+        ghosts = DotArrays(x, y, punched.page ^ 1, punched.punch, dots.num_pages)
+    if pages is not None:
+        dots = dots.select_pages(pages)
+    cells, loose = dots_to_cells(dots, profile)
+    page_width_pt, page_height_pt = page_size_pt(profile)
+    diameter = profile.dist_diam_dot * profile.mm_per_unit
+
+    writer = _PdfWriter()
+    catalog = writer.reserve()
+    page_tree = writer.reserve()
+
+    forms = {}
+    for punched, present in sorted(set(zip(cells.punched.tolist(), cells.present.tolist()))):
+        size = profile.dot_offsets.max(axis=0) * profile.mm_per_unit + diameter + LINE_WIDTH
+        bbox = f"[{-LINE_WIDTH * PT_PER_MM:.2f} {-size[1] * PT_PER_MM:.2f} {size[0] * PT_PER_MM:.2f} {LINE_WIDTH * PT_PER_MM:.2f}]"
+        forms[punched, present] = writer.add_stream(f"/Type /XObject /Subtype /Form /BBox {bbox}",
+                                                    _cell_form(punched, present, profile))
+    names = {key: f"C{key[0]}_{key[1]}" for key in forms}
+    resources = "<< /XObject << " + " ".join(f"/{names[key]} {number} 0 R" for key, number in forms.items()) + " >> >>"
+
+    # Pages that have any dots, in order, as dot_pos_to_pdf adds them
+    page_ids = np.union1d(cells.page, loose.page).astype(np.int64).tolist()
+    cell_bounds = np.searchsorted(cells.page, page_ids + [page_ids[-1] + 1] if page_ids else [])
+    loose_order = np.argsort(loose.page, kind="stable")
+    loose_pages = loose.page[loose_order]
+    if ghosts is not None:
+        ghost_order = np.argsort(ghosts.page, kind="stable")
+        ghost_pages = ghosts.page[ghost_order]
+
+    kids = []
+    for i, page in enumerate(page_ids):
+        start, end = cell_bounds[i], cell_bounds[i + 1]
+        xs = (cells.x[start:end] * PT_PER_MM).tolist()
+        ys = (page_height_pt - cells.y[start:end] * PT_PER_MM).tolist()
+        stamps = [names[key] for key in zip(cells.punched[start:end].tolist(), cells.present[start:end].tolist())]
+        ops = []
+        if ghosts is not None:
+            lo, hi = np.searchsorted(ghost_pages, [page, page + 1])
+            if hi > lo:
+                ops.append(f"q {GHOST_GREY / 255:.3f} G 1 0 0 1 0 {page_height_pt:.2f} cm "
+                           f"{LINE_WIDTH * PT_PER_MM:.2f} w")
+                ops += [_dot(float(ghosts.x[j]), float(ghosts.y[j]), False, diameter) for j in ghost_order[lo:hi].tolist()]
+                ops.append("Q")
+        ops += [f"q 1 0 0 1 {x:.2f} {y:.2f} cm /{name} Do Q" for x, y, name in zip(xs, ys, stamps)]
+
+        lo, hi = np.searchsorted(loose_pages, [page, page + 1])
+        if hi > lo:
+            ops.append(f"q 1 0 0 1 0 {page_height_pt:.2f} cm {LINE_WIDTH * PT_PER_MM:.2f} w")
+            for j in loose_order[lo:hi].tolist():
+                ops.append(_dot(float(loose.x[j]), float(loose.y[j]), bool(loose.punch[j]), diameter))
+            ops.append("Q")
+
+        content = writer.add_stream("", "\n".join(ops).encode())
+        kids.append(writer.add(f"<< /Type /Page /Parent {page_tree} 0 R /Resources {resources} "
+                               f"/Contents {content} 0 R >>".encode()))
+
+    if not kids:
+        # Like fpdf, an empty document still gets a blank page
+        content = writer.add_stream("", b"")
+        kids.append(writer.add(f"<< /Type /Page /Parent {page_tree} 0 R /Contents {content} 0 R >>".encode()))
+
+    writer.set(page_tree, (f"<< /Type /Pages /Kids [{' '.join(f'{kid} 0 R' for kid in kids)}] /Count {len(kids)} "
+                           f"/MediaBox [0 0 {page_width_pt:.2f} {page_height_pt:.2f}] >>").encode())
+    writer.set(catalog, f"<< /Type /Catalog /Pages {page_tree} 0 R >>".encode())
+    return writer.output(catalog)
+
+
+def test_parse_page_range():
+    """Test function to verify page ranges are parsed, clamped to the document and rejected when malformed"""
+    assert parse_page_range(None) is None
+    assert parse_page_range("0-2,5") == [0, 1, 2, 5]
+    assert parse_page_range("1-100", num_pages=3) == [1, 2]
+    assert parse_page_range("0,7", num_pages=3) == [0]
+    for text in ("3-1", "-1", "1--2", "a", "1-", "0-2,", "5-9"):
+        try:
+            parse_page_range(text, num_pages=3)
+        except ValueError:
+            continue
+        raise AssertionError(f"{text!r} should be rejected")
@@ -0,0 +1,237 @@
+import hashlib
+import logging
+import os
+import pickle
+import sys
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Any, Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.getenv("BRAILLE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "braille-printer"))
+# Bytes of entries kept in memory, across all stages, measured by their pickled size
+MEMORY_BYTES = 128 * 1024 * 1024
+# Size the on-disk store is trimmed back to
+DISK_BYTES = 512 * 1024 * 1024
+
+_MISSING = object()
+
+
+def content_key(*parts) -> str:
+    """SHA-256 over the given bytes/str parts, for keying cache entries by content"""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        # Length prefix so ("ab", "c") and ("a", "bc") differ
+        digest.update(len(part).to_bytes(8, "little"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class PipelineCache:
+    """
+    Content-addressed cache for pipeline stage outputs (transcript, braille,
+    layout, G-code). An in-memory LRU of at most max_memory_bytes sits in
+    front of an on-disk store that evicts the least recently used files once
+    it grows past max_disk_bytes. The store is only scanned for its size when
+    it is first written to, so creating a cache does no I/O.
+    """
+
+    def __init__(self, directory: str = CACHE_DIR, max_memory_bytes: int = MEMORY_BYTES,
+                 max_disk_bytes: int = DISK_BYTES):
+        self.directory = directory
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()  # (stage, key) -> (value, size)
+        self.memory_bytes = 0
+        self._lock = threading.Lock()
+        self._scan_lock = threading.Lock()
+        self.hits = defaultdict(int)
+        self.disk_hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self._disk_bytes: Optional[int] = None if directory else 0
+
+    @property
+    def disk_bytes(self) -> int:
+        """Size of the on-disk store, scanned the first time it is needed"""
+        with self._scan_lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._scan_disk()
+            return self._disk_bytes
+
+    def _path(self, key: str, stage: str) -> str:
+        return os.path.join(self.directory, stage, key[:2], key + ".pkl")
+
+    def _scan_disk(self) -> int:
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except FileNotFoundError:
+                    pass  # removed by another process while walking
+        return total
+
+    def get(self, key: str, stage: str, default: Any = None) -> Any:
+        with self._lock:
+            if (stage, key) in self._memory:
+                self._memory.move_to_end((stage, key))
+                self.hits[stage] += 1
+                return self._memory[(stage, key)][0]
+
+        value, size = self._read_disk(key, stage)
+        with self._lock:
+            if value is _MISSING:
+                self.misses[stage] += 1
+                return default
+            self.hits[stage] += 1
+            self.disk_hits[stage] += 1
+            self._remember(key, stage, value, size)
+        return value
+
+    def put(self, key: str, stage: str, value: Any):
+        try:
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            logger.warning("Cache entry %s/%s cannot be stored on disk: %s", stage, key, e)
+            with self._lock:
+                self._remember(key, stage, value, sys.getsizeof(value))
+            return
+        with self._lock:
+            self._remember(key, stage, value, len(data))
+        self._write_disk(key, stage, data)
+
+    def get_or_compute(self, key: str, stage: str, compute: Callable[[], Any]) -> Any:
+        value = self.get(key, stage, _MISSING)
+        if value is _MISSING:
+            value = compute()
+            self.put(key, stage, value)
+        return value
+
+    def _remember(self, key: str, stage: str, value: Any, size: int):
+        """Keep a value in memory, dropping the least recently used ones beyond max_memory_bytes"""
+        old = self._memory.pop((stage, key), None)
+        if old is not None:
+            self.memory_bytes -= old[1]
+        if size > self.max_memory_bytes:
+            return  # would push out everything else, it stays on disk only
+        self._memory[(stage, key)] = (value, size)
+        self.memory_bytes += size
+        while self.memory_bytes > self.max_memory_bytes:
+            _, (_, dropped) = self._memory.popitem(last=False)
+            self.memory_bytes -= dropped
+
+    def _read_disk(self, key: str, stage: str) -> Tuple[Any, int]:
+        """The stored value and its size on disk, _MISSING if there is none"""
+        if not self.directory:
+            return _MISSING, 0
+        path = self._path(key, stage)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            value = pickle.loads(data)
+            os.utime(path)  # mtime doubles as last use for eviction
+            return value, len(data)
+        except FileNotFoundError:
+            return _MISSING, 0
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            logger.warning("Ignoring unreadable cache entry %s: %s", path, e)
+            return _MISSING, 0
+
+    def _write_disk(self, key: str, stage: str, data: bytes):
+        if not self.directory:
+            return
+        path = self._path(key, stage)
+        self.disk_bytes  # scan before the first write, so the total includes what was there
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            with self._scan_lock:
+                self._disk_bytes += os.path.getsize(path) - old_size
+                over = self._disk_bytes > self.max_disk_bytes
+        except OSError as e:
+            logger.warning("Could not write cache entry %s: %s", path, e)
+            return
+        if over:
+            self._evict_disk()
+
+    def _evict_disk(self):
+        """Delete least recently used files until the store is back under its limit"""
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        with self._scan_lock:
+            self._disk_bytes = total
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self.memory_bytes = 0
+
+    def stats(self) -> dict:
+        disk_bytes = self.disk_bytes
+        with self._lock:
+            stages = set(self.hits) | set(self.misses)
+            return {
+                "stages": {stage: {"hits": self.hits[stage], "disk_hits": self.disk_hits[stage],
+                                   "misses": self.misses[stage]} for stage in sorted(stages)},
+                "memory_items": len(self._memory),
+                "memory_bytes": self.memory_bytes,
+                "disk_bytes": disk_bytes,
+            }
+
+    def render(self, name: str = "braille_cache") -> List[str]:
+        """Stats in the Prometheus text format"""
+        stats = self.stats()
+        lines = [f"# TYPE {name}_hits_total counter", f"# TYPE {name}_disk_hits_total counter",
+                 f"# TYPE {name}_misses_total counter"]
+        for stage, counts in stats["stages"].items():
+            lines.append(f'{name}_hits_total{{stage="{stage}"}} {counts["hits"]}')
+            lines.append(f'{name}_disk_hits_total{{stage="{stage}"}} {counts["disk_hits"]}')
+            lines.append(f'{name}_misses_total{{stage="{stage}"}} {counts["misses"]}')
+        lines.append(f"{name}_memory_items {stats['memory_items']}")
+        lines.append(f"{name}_memory_bytes {stats['memory_bytes']}")
+        lines.append(f"{name}_disk_bytes {stats['disk_bytes']}")
+        return lines
+
+
+def test_pipeline_cache_memory_bound():
+    """Test function to verify the memory tier is bounded by size and the disk is scanned lazily"""
+    import tempfile
+
+    directory = tempfile.mkdtemp()
+    with open(os.path.join(directory, "stale.pkl"), "wb") as f:
+        f.write(b"x" * 100)
+    cache = PipelineCache(directory, max_memory_bytes=10_000)
+    assert cache._disk_bytes is None, "Creating the cache should not scan the disk"
+    for i in range(10):
+        cache.put(content_key(str(i)), "layout", b"y" * 3000)
+    assert cache.memory_bytes <= 10_000
+    assert len(cache._memory) < 10
+    assert cache.get(content_key("0"), "layout") == b"y" * 3000  # evicted from memory, read back from disk
+    assert cache.disk_bytes > 10 * 3000
+    cache.put(content_key("big"), "layout", b"z" * 20_000)  # larger than the memory tier
+    assert ("layout", content_key("big")) not in cache._memory
+    assert cache.get(content_key("big"), "layout") == b"z" * 20_000
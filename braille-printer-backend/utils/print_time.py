@@ -0,0 +1,330 @@
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+from utils.braille_to_gcode import PUNCH_AMOUNT, PUNCH_ORDER, SPEED_LATERAL, SPEED_PUNCH, DotPosition, GcodeAction
+from utils.layout_profile import DEFAULT_PROFILE, LayoutProfile
+from utils.path_planning import plan_punch_order
+from utils.printer import CLEANUP_GCODE, INITIALIZE_GCODE
+
+# Firmware motion limits, Marlin's defaults from Configuration.h (mm/s, mm/s^2)
+MAX_FEEDRATE = {"X": 300.0, "Y": 300.0, "Z": 5.0, "E": 25.0}
+MAX_ACCELERATION = {"X": 3000.0, "Y": 3000.0, "Z": 100.0, "E": 10000.0}
+# DEFAULT_ACCELERATION for moves, DEFAULT_RETRACT_ACCELERATION for E-only moves
+ACCELERATION = 3000.0
+RETRACT_ACCELERATION = 3000.0
+# Classic jerk: the speed an axis can start or stop at without accelerating
+JERK = {"X": 10.0, "Y": 10.0, "Z": 0.3, "E": 5.0}
+HOMING_FEEDRATE = {"X": 50.0, "Y": 50.0, "Z": 4.0}
+# Seconds per homed axis on top of the travel, for bumping the endstop twice
+HOMING_OVERHEAD = 1.0
+# Marlin's feedrate (mm/min) until the first F word
+DEFAULT_FEEDRATE = 3000.0
+# Seconds the operator needs to swap the sheet between pages
+PAPER_CHANGE_SECONDS = 30.0
+# Estimated seconds of progress the live ETA needs before it trusts the observed rate
+ETA_MIN_SAMPLE = 5.0
+
+
+@dataclass
+class Kinematics:
+    """Motion settings of the printer. Dicts are per axis."""
+    max_feedrate: Dict[str, float] = field(default_factory=lambda: dict(MAX_FEEDRATE))
+    max_acceleration: Dict[str, float] = field(default_factory=lambda: dict(MAX_ACCELERATION))
+    acceleration: float = ACCELERATION
+    retract_acceleration: float = RETRACT_ACCELERATION
+    jerk: Dict[str, float] = field(default_factory=lambda: dict(JERK))
+    homing_feedrate: Dict[str, float] = field(default_factory=lambda: dict(HOMING_FEEDRATE))
+    homing_overhead: float = HOMING_OVERHEAD
+
+
+def trapezoid_seconds(distance, speed, acceleration, start_speed):
+    """
+    Time for a move that starts and ends at `start_speed`, accelerating to
+    `speed` and back, or turning at its peak if it is too short to get there.
+    Takes numbers or numpy arrays.
+    """
+    distance = np.asarray(distance, dtype=np.float64)
+    start_speed = np.minimum(start_speed, speed)
+    ramp = (speed ** 2 - start_speed ** 2) / (2 * acceleration)
+    peak = np.sqrt(acceleration * distance + start_speed ** 2)
+    cruising = 2 * (speed - start_speed) / acceleration + (distance - 2 * ramp) / speed
+    short = 2 * (peak - start_speed) / acceleration
+    return np.where(distance <= 0, 0.0, np.where(2 * ramp <= distance, cruising, short))
+
+
+def move_seconds(deltas: Dict[str, object], feedrate: float, kinematics: Kinematics):
+    """
+    Time for a G1 move by `deltas` (mm per axis, numbers or arrays) at
+    `feedrate` mm/min. Like Marlin, the length is the XYZ distance (or E for
+    E-only moves), and every axis limits speed, acceleration and jerk to its
+    share of the move.
+    """
+    linear = [deltas[axis] for axis in "XYZ" if axis in deltas]
+    if linear:
+        length = np.sqrt(sum(np.square(delta) for delta in linear))
+        acceleration = kinematics.acceleration
+    else:
+        length = np.abs(deltas["E"])
+        acceleration = kinematics.retract_acceleration
+    speed = feedrate / 60
+    start_speed = np.inf
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for axis, delta in deltas.items():
+            share = np.where(delta == 0, np.inf, length / np.abs(delta))
+            speed = np.minimum(speed, kinematics.max_feedrate[axis] * share)
+            acceleration = np.minimum(acceleration, kinematics.max_acceleration[axis] * share)
+            start_speed = np.minimum(start_speed, kinematics.jerk[axis] * share)
+        return trapezoid_seconds(length, speed, acceleration, start_speed)
+
+
+class GcodeTimer:
+    """Follows G-code through the machine's modes and position, adding up how long it takes"""
+
+    def __init__(self, kinematics: Optional[Kinematics] = None):
+        self.kinematics = kinematics or Kinematics()
+        self.position = dict.fromkeys("XYZE", 0.0)
+        self.absolute = True
+        self.relative_e = False
+        self.feedrate = DEFAULT_FEEDRATE
+        self.seconds = 0.0
+
+    def run(self, command: str) -> float:
+        """Seconds `command` takes"""
+        words = command.split(";")[0].split()
+        if not words:
+            return 0.0
+        code = words[0].upper()
+        params = {}
+        for word in words[1:]:
+            try:
+                params[word[0].upper()] = float(word[1:])
+            except ValueError:
+                continue
+
+        seconds = 0.0
+        if code in ("G0", "G1"):
+            self.feedrate = params.get("F", self.feedrate)
+            deltas = {}
+            for axis in "XYZE":
+                if axis not in params:
+                    continue
+                relative = not self.absolute or (axis == "E" and self.relative_e)
+                target = self.position[axis] + params[axis] if relative else params[axis]
+                if target != self.position[axis]:
+                    deltas[axis] = target - self.position[axis]
+                self.position[axis] = target
+            if deltas:
+                seconds = float(move_seconds(deltas, self.feedrate, self.kinematics))
+        elif code == "G28":
+            for axis in [axis for axis in "XYZ" if axis in params] or list("XYZ"):
+                seconds += (abs(self.position[axis]) / self.kinematics.homing_feedrate[axis]
+                            + self.kinematics.homing_overhead)
+                self.position[axis] = 0.0
+        elif code in ("G90", "G91"):
+            self.absolute = code == "G90"
+        elif code in ("M82", "M83"):
+            self.relative_e = code == "M83"
+        elif code == "G92":
+            self.position.update(params)
+        self.seconds += seconds
+        return seconds
+
+
+@dataclass
+class PageEstimate:
+    """Predicted time of one page: initialize(), the punches, cleanup()"""
+    page: int
+    punches: int
+    initialize_seconds: float
+    punch_seconds: float
+    cleanup_seconds: float
+    punch_times: np.ndarray = field(repr=False)  # seconds into the punching at which each punch is done
+
+    @property
+    def seconds(self) -> float:
+        return self.initialize_seconds + self.punch_seconds + self.cleanup_seconds
+
+    def punch_time(self, punches_done: int) -> float:
+        """Seconds of punching behind the first `punches_done` punches"""
+        if punches_done <= 0 or not len(self.punch_times):
+            return 0.0
+        return float(self.punch_times[min(punches_done, len(self.punch_times)) - 1])
+
+    def to_dict(self) -> dict:
+        return {"page": self.page, "punches": self.punches, "seconds": self.seconds}
+
+
+@dataclass
+class JobEstimate:
+    pages: List[PageEstimate] = field(default_factory=list)
+    paper_change_seconds: float = PAPER_CHANGE_SECONDS
+
+    @property
+    def printing_seconds(self) -> float:
+        return sum(page.seconds for page in self.pages)
+
+    @property
+    def seconds(self) -> float:
+        """Printing plus swapping the sheet between pages"""
+        return self.printing_seconds + self.paper_change_seconds * max(0, len(self.pages) - 1)
+
+    def remaining_seconds(self, pages_done: Iterable[int] = (), punches_done: Optional[Dict[int, int]] = None) -> float:
+        """Printing seconds left, by page index, given finished pages and punches done on the others"""
+        pages_done = set(pages_done)
+        punches_done = punches_done or {}
+        return sum(page.seconds - page.punch_time(punches_done.get(i, 0))
+                   for i, page in enumerate(self.pages) if i not in pages_done)
+
+    def to_dict(self) -> dict:
+        return {
+            "seconds": self.seconds,
+            "printingSeconds": self.printing_seconds,
+            "paperChanges": max(0, len(self.pages) - 1),
+            "pages": [page.to_dict() for page in self.pages],
+        }
+
+
+def _setup_seconds(kinematics: Kinematics, last_x: float, last_y: float):
+    """Seconds of initialize() from a cleaned up printer, and of cleanup() from (last_x, last_y)"""
+    timer = GcodeTimer(kinematics)
+    for command in CLEANUP_GCODE:
+        timer.run(command)
+    initialize = sum(timer.run(command) for command in INITIALIZE_GCODE)
+    timer.position["X"], timer.position["Y"] = last_x, last_y
+    cleanup = sum(timer.run(command) for command in CLEANUP_GCODE)
+    return initialize, cleanup
+
+
+def estimate_actions(actions: List[GcodeAction], page: int = 0,
+                     kinematics: Optional[Kinematics] = None) -> PageEstimate:
+    """Estimate the output of dot_pos_to_gcode, as sent between initialize() and cleanup()"""
+    kinematics = kinematics or Kinematics()
+    timer = GcodeTimer(kinematics)
+    # Start where the previous page's cleanup() left the head
+    for command in CLEANUP_GCODE:
+        timer.run(command)
+    timer.seconds = 0.0
+    for command in INITIALIZE_GCODE:
+        timer.run(command)
+    initialize = timer.seconds
+    punch_times = []
+    for action in actions:
+        timer.run(action.command)
+        if action.dot:
+            punch_times.append(timer.seconds - initialize)
+    punch_seconds = timer.seconds - initialize
+    _, cleanup = _setup_seconds(kinematics, timer.position["X"], timer.position["Y"])
+    return PageEstimate(page, len(punch_times), initialize, punch_seconds, cleanup, np.array(punch_times))
+
+
+def estimate_page(dots: List[DotPosition], page: Optional[int] = None, punch_order: str = PUNCH_ORDER,
+                  kinematics: Optional[Kinematics] = None, profile: LayoutProfile = DEFAULT_PROFILE) -> PageEstimate:
+    """
+    Estimate a page from get_dots_pos_and_page. Same result as estimating its
+    G-code, but the moves are timed as arrays instead of parsed line by line.
+    """
+    left, top = profile.left_offset, profile.top_offset
+    kinematics = kinematics or Kinematics()
+    if page is None:
+        page = dots[0].page if dots else 0
+    punched, _ = plan_punch_order([dot for dot in dots if dot.punch], punch_order,
+                                  start=(-left, -top))
+    # Machine coordinates, from home
+    x = np.array([0.0] + [dot.x + left for dot in punched])
+    y = np.array([0.0] + [dot.y + top for dot in punched])
+    moves = move_seconds({"X": np.diff(x), "Y": np.diff(y)}, SPEED_LATERAL, kinematics)
+    punch = float(move_seconds({"E": PUNCH_AMOUNT}, SPEED_PUNCH, kinematics))
+    punch_times = np.cumsum(moves + punch)
+    initialize, cleanup = _setup_seconds(kinematics, x[-1], y[-1])
+    return PageEstimate(page, len(punched), initialize, float(punch_times[-1]) if len(punched) else 0.0,
+                        cleanup, punch_times)
+
+
+def estimate_pages(pages: Iterable[List[DotPosition]], punch_order: str = PUNCH_ORDER,
+                   kinematics: Optional[Kinematics] = None,
+                   paper_change_seconds: float = PAPER_CHANGE_SECONDS,
+                   profile: LayoutProfile = DEFAULT_PROFILE) -> JobEstimate:
+    """Estimate a whole document, one page per sheet"""
+    return JobEstimate([estimate_page(page, i, punch_order, kinematics, profile) for i, page in enumerate(pages)],
+                       paper_change_seconds)
+
+
+class LiveEta:
+    """
+    Time left in a running print. The estimate for what is still to come is
+    scaled by how long the punches acknowledged so far really took against
+    their estimate, so a slow link or printer shows up after a few seconds.
+    Feed it progress with update(), as often as it is known.
+    """
+
+    def __init__(self, estimate: JobEstimate, kinematics: Optional[Kinematics] = None,
+                 profile: LayoutProfile = DEFAULT_PROFILE):
+        self.estimate = estimate
+        self.kinematics = kinematics
+        self.profile = profile  # of the pages passed to track()
+        self.page = 0  # index into estimate.pages
+        self.punches = 0  # acknowledged on the current page
+        self._observed = 0.0  # seconds spent punching on earlier pages
+        self._expected = 0.0  # estimated seconds for the same punches
+        self._first = None  # (time, punches) of the first update on the current page
+        self._last = None
+
+    def track(self, pages: Iterable[List[DotPosition]]) -> Iterator[List[DotPosition]]:
+        """Estimate pages as they go by, for prints that start before conversion has finished"""
+        for page in pages:
+            self.estimate.pages.append(estimate_page(page, len(self.estimate.pages), kinematics=self.kinematics,
+                                                    profile=self.profile))
+            yield page
+
+    def update(self, page: int, punches: int, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        if page != self.page:
+            observed, expected = self._page_rate()
+            self._observed += observed
+            self._expected += expected
+            self.page = page
+            self._first = None
+        self.punches = punches
+        if self._first is None:
+            self._first = (now, punches)
+        self._last = (now, punches)
+
+    def _page_rate(self):
+        """(observed, estimated) seconds between the first and last update on the current page"""
+        if self._first is None or self.page >= len(self.estimate.pages):
+            return 0.0, 0.0
+        page = self.estimate.pages[self.page]
+        (start, start_punches), (end, end_punches) = self._first, self._last
+        return end - start, page.punch_time(end_punches) - page.punch_time(start_punches)
+
+    @property
+    def factor(self) -> float:
+        """Observed over estimated punching time, 1 until there is enough to go on"""
+        observed, expected = self._page_rate()
+        observed += self._observed
+        expected += self._expected
+        return observed / expected if expected >= ETA_MIN_SAMPLE else 1.0
+
+    def remaining_seconds(self) -> float:
+        pages = self.estimate.pages
+        if self.page >= len(pages):
+            return 0.0
+        factor = self.factor
+        current = pages[self.page]
+        left = factor * (current.punch_seconds - current.punch_time(self.punches)) + current.cleanup_seconds
+        for page in pages[self.page + 1:]:
+            left += page.initialize_seconds + factor * page.punch_seconds + page.cleanup_seconds
+        return left + self.estimate.paper_change_seconds * (len(pages) - 1 - self.page)
+
+    def to_dict(self) -> dict:
+        return {
+            "etaSeconds": self.remaining_seconds(),
+            "estimatedSeconds": self.estimate.seconds,
+            "rateFactor": self.factor,
+            "page": self.page,
+            "punchesDone": self.punches,
+            "numPages": len(self.estimate.pages),
+        }
@@ -1,10 +1,21 @@
-from typing import List
+from bisect import bisect_right
+from collections import deque
+from itertools import accumulate
+from dataclasses import dataclass
+from typing import Iterable, List, Optional
+import logging
+import queue
+import re
 import serial
 import time
 import threading
 from enum import Enum
 
-from utils.braille_to_gcode import DotPosition, GcodeAction, dot_pos_to_gcode
+from utils.braille_to_gcode import INTERPOINT, DotPosition, GcodeAction, dot_pos_to_gcode, is_back
+from utils.layout_profile import DEFAULT_PROFILE, LayoutProfile
+from utils.metrics import SerialMetrics
+
+logger = logging.getLogger(__name__)
 
 # Replace with your printer's correct port
 port = "/dev/tty.usbserial-0001"
@@ -12,6 +23,46 @@ baud_rate = 250000  # Adjust this to match your printer's baud rate
 
 DEBUG = False
 
+# Stream G-code with several lines in flight instead of waiting for every "ok"
+STREAMING = True
+# Lines kept in flight while streaming. Marlin's command buffer (BUFSIZE) holds 4
+STREAM_WINDOW = 4
+# Bytes kept in flight while streaming. Marlin's RX_BUFFER_SIZE defaults to 128
+RX_BUFFER_SIZE = 127
+# Seconds without any reply before an outstanding "ok" is assumed lost
+OK_TIMEOUT = 10
+# Pages converted ahead of the one being printed in print_pages
+PAGE_QUEUE_SIZE = 2
+# Upload G-code to the printer's SD card and print it from there, instead of streaming it
+SD_CARD = False
+# File the G-code is uploaded to. Marlin wants 8.3 names
+SD_FILENAME = "BRAILLE.GCO"
+# Seconds between M27 progress reports while printing from the SD card
+SD_POLL_INTERVAL = 0.5
+
+# Sent before every page: home, then calibrate the punch
+INITIALIZE_GCODE = [
+    "G91",          # Set relative positioning
+    "G1 Z10 F800",
+    "G90",          # Set absolute positioning
+    "M83",          # Set relative extrusion
+    "M302 S0",      # Allow cold extrusion at any temperature
+    "G28",          # Zero all axes
+    # Calibrate extrusion
+    "G1 E2.2 F200",
+    "G1 E-2.2 F200",
+    "G1 E2.2 F200",
+    "G1 E-2.2 F200",
+    "G1 E1.5 F200",
+    "G1 Z3 F800",
+]
+# Sent after every page
+CLEANUP_GCODE = [
+    "G1 Z10 F800",  # Move z axis up
+    "G28 X0 Y0",    # Zero X and Y
+    "G1 Z10 F800",  # Move z axis up so can easily remove page
+]
+
 class PrintStatus(Enum):
     IDLE = "idle"
     PRINTING = "printing" 
@@ -27,10 +78,61 @@ def calculate_checksum(command):
         checksum ^= ord(c)
     return checksum & 0xFF  # Ensure 8-bit result
 
+def format_command(command, line_number):
+    """Prefix a G-code command with its line number and append the checksum."""
+    if command.startswith('N'):
+        formatted_command = command
+    else:
+        formatted_command = f"N{line_number} {command}"
+
+    # Add checksum if not already present
+    if '*' not in formatted_command:
+        checksum = calculate_checksum(formatted_command)
+        formatted_command = f"{formatted_command}*{checksum}"
+    return formatted_command
+
+@dataclass
+class Reply:
+    """One line received from the printer"""
+    kind: str  # ok, resend, error, busy, echo, start or other
+    text: str
+    line_number: Optional[int] = None  # line to resend, or N of an ADVANCED_OK reply
+    free_planner: Optional[int] = None  # ADVANCED_OK P value
+    free_buffer: Optional[int] = None  # ADVANCED_OK B value
+
+_ADVANCED_OK = re.compile(r"ok(?:\s+N(\d+))?\s+P(\d+)\s+B(\d+)", re.IGNORECASE)
+_SD_PROGRESS = re.compile(r"SD printing byte (\d+)/(\d+)", re.IGNORECASE)
+_SD_FAILURES = ("open failed", "no sd card", "no media", "sd init fail")
+
+def parse_reply(text):
+    """Classify a line sent by Marlin."""
+    lower = text.lower()
+    if lower.startswith("ok"):
+        match = _ADVANCED_OK.match(text)
+        if match:
+            line_number = int(match.group(1)) if match.group(1) else None
+            return Reply("ok", text, line_number, int(match.group(2)), int(match.group(3)))
+        return Reply("ok", text)
+    if "resend:" in lower:
+        try:
+            return Reply("resend", text, int(lower.split("resend:")[1].strip()))
+        except ValueError:
+            return Reply("resend", text)
+    if lower.startswith("error"):
+        return Reply("error", text)
+    if "busy:" in lower:
+        return Reply("busy", text)
+    if lower.startswith("echo:"):
+        return Reply("echo", text)
+    if "start" in lower:
+        return Reply("start", text)
+    return Reply("other", text)
+
 class PrinterConnection:
-    def __init__(self, port, baud_rate):
+    def __init__(self, port, baud_rate, profile: Optional[LayoutProfile] = None):
         self.port = port
         self.baud_rate = baud_rate
+        self.profile = profile or DEFAULT_PROFILE  # paper and page offset of this embosser
         self.ser = None
         self.line_number = 0
         self.E_steps_per_unit = 400.0
@@ -39,17 +141,27 @@ class PrinterConnection:
         self.print_thread = None
         self._stop_event = threading.Event()
         self._pause_event = threading.Event()
+        self.window = STREAM_WINDOW
+        self.rx_buffer_size = RX_BUFFER_SIZE
+        self._replies = queue.Queue()
+        self._reader_thread = None
+        self._reader_stop = threading.Event()
+        self.metrics = SerialMetrics()
+        self.pause_reason = None  # "paper" while waiting for the next sheet, "flip" for the back of this one
+        self.current_page = None
+        self.pages_converted = 0
+        self.sd_card = SD_CARD
 
     def connect(self):
         """Establish connection and perform initial handshake."""
-        print("Connecting to printer...")
+        logger.info("Connecting to printer on %s...", self.port)
         self.ser = serial.Serial(self.port, self.baud_rate, timeout=1)
         self.ser.reset_input_buffer()
         
         if not self.wait_for_start():
             raise Exception("Printer did not send 'start' within timeout.")
         
-        print("Printer is ready! Performing handshake...")
+        logger.info("Printer is ready! Performing handshake...")
         
         # Start fresh with line numbers
         self.line_number = 0
@@ -64,29 +176,18 @@ class PrinterConnection:
         
         # Now that we're synchronized, enable debug output
         self.send_command("M111 S6")
-        print("Handshake complete!")
+        logger.info("Handshake complete!")
 
     def initialize(self):
-        self.send_command("G91")     # Set relative positioning
-        self.send_command("G1 Z10 F800")
-        self.send_command("G90")     # Set absolute positioning
-        self.send_command("M83")     # Set relative extrusion
-        self.send_command("M302 S0") # Allow cold extrusion at any temperature
-        self.send_command("G28")     # Zero all axes
-        # Calibrate extrusion
-        for _ in range(2):
-            self.send_command("G1 E2.2 F200")
-            self.send_command("G1 E-2.2 F200")
-        self.send_command("G1 E1.5 F200")
-        self.send_command("G1 Z3 F800")
+        for command in INITIALIZE_GCODE:
+            self.send_command(command)
         # self.send_command("G1 Z10 F800")
         # input("Press Enter to continue...")
 
     def cleanup(self):
         if self.ser and self.ser.is_open:
-            self.send_command("G1 Z10 F800") # Move z axis up
-            self.send_command("G28 X0 Y0")   # Zero X and Y
-            self.send_command("G1 Z10 F800") # Move z axis up so can easily remove page
+            for command in CLEANUP_GCODE:
+                self.send_command(command)
 
     def wait_for_start(self, timeout=10):
         """Wait for the printer to send 'start' after connecting."""
@@ -94,74 +195,67 @@ class PrinterConnection:
         while time.time() - start_time < timeout:
             if self.ser.in_waiting:
                 response = self.ser.readline().decode().strip()
-                print(f"Printer: {response}")
+                logger.debug("Printer: %s", response)
                 if "start" in response.lower():
                     return True
         return False
 
-    def send_command(self, command, wait_for_ok=True):
-        """Send a G-code command with line number and checksum."""
+    def send_command(self, command, wait_for_ok=True, replies=None):
+        """
+        Send a G-code command with line number and checksum. Lines the printer
+        sends before the "ok", other than resend requests, go into `replies`.
+        """
         if not self.ser or not self.ser.is_open:
             raise serial.PortNotOpenError()
             
         while True:  # Keep trying until command is accepted
-            if command.startswith('N'):
-                formatted_command = command
-            else:
-                formatted_command = f"N{self.line_number} {command}"
-            
-            # Add checksum if not already present
-            if '*' not in formatted_command:
-                # Calculate checksum only for the part before any existing *
-                checksum_part = formatted_command.split('*')[0]
-                checksum = calculate_checksum(checksum_part)
-                formatted_command = f"{checksum_part}*{checksum}"  # Removed extra space before *
-                print(f"Debug - Command: '{checksum_part}', Checksum: {checksum}")  # Debug line
+            formatted_command = format_command(command, self.line_number)
 
-            self.ser.write((formatted_command + "\n").encode())
-            print(f"Sent: {formatted_command}")
+            data = (formatted_command + "\n").encode()
+            sent_at = time.monotonic()
+            self.ser.write(data)
+            self.metrics.record_sent(len(data))
+            logger.debug("Sent: %s", formatted_command)
 
             if not wait_for_ok:
                 break
 
-            # Wait for response
+            # Wait for response. A rejected line gets an error, "Resend: N" and
+            # then an "ok", which has to be read before the line is sent again
+            resend = False
             while True:
-                response = self.ser.readline().decode().strip()
+                response = self._read_line()
                 if not response:
                     continue
                 
-                print(f"Printer: {response}")
+                logger.debug("Printer: %s", response)
                 
                 # Check for resend requests
                 if "resend:" in response.lower():
-                    self.line_number = int(response.lower().split("resend:")[1].strip())
-                    break
-                elif "error:checksum mismatch" in response.lower():
+                    try:
+                        self.line_number = int(response.lower().split("resend:")[1].strip())
+                    except ValueError:
+                        pass
+                    resend = True
+                    continue
+                elif "error:checksum mismatch" in response.lower() or "error:line number is not" in response.lower():
                     # Extract last line number and set our counter to next line
                     try:
                         last_line = int(response.lower().split("last line:")[1].strip())
                         self.line_number = last_line + 1
                     except (ValueError, IndexError):
                         self.line_number = 1  # Reset to 1 if we can't parse the line number
-                    break
-                elif "error:line number is not" in response.lower():
-                    # Similar handling as checksum mismatch
-                    try:
-                        last_line = int(response.lower().split("last line:")[1].strip())
-                        self.line_number = last_line + 1
-                    except (ValueError, IndexError):
-                        self.line_number = 1
-                    break
+                    resend = True
+                    continue
                 elif "echo:  m92 " in response.lower():
-                    gcode = response.replace("echo:  m92 ", "").strip()
-                    parts = gcode.split(" ")
-                    for part in parts:
-                        if part.startswith("E"):
-                            self.E_steps_per_unit = float(part.replace("E", ""))
-                            print(f"E_steps_per_unit: {self.E_steps_per_unit}")
-                            break
+                    self._handle_echo(response)
                 
+                if replies is not None and not response.lower().startswith("ok"):
+                    replies.append(response)
                 if "ok" in response.lower():
+                    if resend:
+                        break
+                    self.metrics.record_ack(time.monotonic() - sent_at)
                     self.line_number += 1  # Only increment after confirmed OK
                     return True
                 
@@ -171,18 +265,270 @@ class PrinterConnection:
             # If we broke out of the inner while loop, it means we need to resend
             continue
 
+    def _handle_echo(self, response):
+        if "echo:  m92 " in response.lower():
+            gcode = response.replace("echo:  m92 ", "").strip()
+            parts = gcode.split(" ")
+            for part in parts:
+                if part.startswith("E"):
+                    self.E_steps_per_unit = float(part.replace("E", ""))
+                    logger.info("E_steps_per_unit: %s", self.E_steps_per_unit)
+                    break
+
+    def _read_line(self):
+        """Read one reply, from the reader thread if it is running."""
+        if self.reader_running():
+            try:
+                return self._replies.get(timeout=1).text
+            except queue.Empty:
+                return ""
+        response = self.ser.readline().decode().strip()
+        if response:
+            self.metrics.record_reply(response)
+        return response
+
+    def reader_running(self):
+        return self._reader_thread is not None and self._reader_thread.is_alive()
+
+    def start_reader(self):
+        """Start a thread that parses everything the printer sends into a queue."""
+        if self.reader_running():
+            return
+        self._reader_stop.clear()
+        self._replies = queue.Queue()
+        self._reader_thread = threading.Thread(target=self._reader_loop, daemon=True)
+        self._reader_thread.start()
+
+    def stop_reader(self):
+        if self.reader_running():
+            self._reader_stop.set()
+            if hasattr(self.ser, "cancel_read"):
+                self.ser.cancel_read()  # don't wait out the read timeout
+            self._reader_thread.join()
+        self._reader_thread = None
+
+    def _reader_loop(self):
+        while not self._reader_stop.is_set():
+            try:
+                raw = self.ser.readline()
+            except (serial.SerialException, TypeError, OSError) as e:
+                # Port closed underneath us
+                self._replies.put(Reply("error", f"Error:serial {e}"))
+                break
+            response = raw.decode(errors="replace").strip()
+            if not response:
+                continue
+            reply = parse_reply(response)
+            self.metrics.record_reply(response)
+            logger.debug("Printer: %s", response)
+            if reply.kind == "echo":
+                self._handle_echo(response)
+            self._replies.put(reply)
+
+    def stream_actions(self, actions, window=None, rx_buffer_size=None):
+        """
+        Send G-code actions keeping up to `window` lines and `rx_buffer_size`
+        bytes in flight, instead of waiting for each "ok". Each action's
+        callback runs once the printer acknowledges its line.
+
+        Marlin answers every line it receives with exactly one "ok". Accepted
+        lines are acknowledged in order once executed. A rejected line gets
+        "Resend: N" followed straight away by its "ok", which can overtake the
+        oks of earlier lines still in Marlin's buffer. Every line sent after
+        the rejected one is rejected too. Sent lines are kept in a history
+        until acknowledged, so a resend replays from N.
+        """
+        if not self.ser or not self.ser.is_open:
+            raise serial.PortNotOpenError()
+        window = window or self.window
+        rx_buffer_size = rx_buffer_size or self.rx_buffer_size
+
+        history = {}  # line number -> (formatted command, action)
+        inflight = deque()  # (line number, bytes, time sent) in the order sent, not yet rejected
+        bytes_inflight = 0
+        next_line = self.line_number  # below self.line_number means replaying history
+        next_action = 0
+        doomed = deque()  # sizes of lines sent after a rejected one, each still to be rejected
+        resend_oks = 0  # oks that follow a "Resend: N" and acknowledge nothing
+        advanced_free = None  # free command buffer slots, if the firmware reports them
+        last_reply = time.monotonic()
+
+        self.start_reader()
+        try:
+            while True:
+                sending = not self._stop_event.is_set() and not self._pause_event.is_set()
+                limit = window if advanced_free is None else max(1, min(window, advanced_free))
+
+                # Fill the window
+                while sending and len(inflight) < limit:
+                    if next_line < self.line_number:
+                        formatted_command = history[next_line][0]
+                    elif next_action < len(actions):
+                        formatted_command = format_command(actions[next_action].command, self.line_number)
+                    else:
+                        break
+                    data = (formatted_command + "\n").encode()
+                    if inflight and bytes_inflight + len(data) > rx_buffer_size:
+                        break
+                    if next_line == self.line_number:
+                        history[self.line_number] = (formatted_command, actions[next_action])
+                        next_action += 1
+                        self.line_number += 1
+                    self.ser.write(data)
+                    self.metrics.record_sent(len(data))
+                    logger.debug("Sent: %s", formatted_command)
+                    inflight.append((next_line, len(data), time.monotonic()))
+                    bytes_inflight += len(data)
+                    next_line += 1
+
+                if not inflight and not doomed:
+                    if not sending and self._stop_event.is_set():
+                        break
+                    if next_line >= self.line_number and next_action >= len(actions):
+                        break
+
+                try:
+                    reply = self._replies.get(timeout=0.1)
+                except queue.Empty:
+                    if (inflight or doomed) and time.monotonic() - last_reply > OK_TIMEOUT:
+                        logger.warning("No reply for %ss, assuming ok was lost", OK_TIMEOUT)
+                        reply = Reply("ok", "ok")
+                    else:
+                        continue
+                last_reply = time.monotonic()
+
+                if reply.kind == "resend":
+                    resend_oks += 1
+                    if doomed:
+                        # A line sent after the rejected one, already queued to go again
+                        bytes_inflight -= doomed.popleft()
+                    elif reply.line_number is not None:
+                        if reply.line_number not in history and reply.line_number != self.line_number:
+                            raise Exception(f"Printer requested line {reply.line_number}, which is no longer in history")
+                        # This line and every line after it will be rejected, replay from here
+                        rejected = [entry for entry in inflight if entry[0] >= reply.line_number]
+                        inflight = deque(entry for entry in inflight if entry[0] < reply.line_number)
+                        if rejected:
+                            bytes_inflight -= rejected[0][1]
+                            doomed.extend(size for _, size, _ in rejected[1:])
+                        next_line = reply.line_number
+                elif reply.kind == "ok":
+                    advanced_free = reply.free_buffer
+                    if resend_oks:
+                        resend_oks -= 1
+                        continue
+                    if not inflight:
+                        continue
+                    line, size, sent_at = inflight.popleft()
+                    bytes_inflight -= size
+                    if line in history:
+                        self.metrics.record_ack(time.monotonic() - sent_at)
+                        _, action = history.pop(line)
+                        action.callback()
+                        if action.dot:
+                            self.metrics.record_punch()
+                elif reply.kind == "error" and "serial" in reply.text.lower():
+                    raise serial.SerialException(reply.text)
+        finally:
+            self.stop_reader()
+        return next_action
+
+    def _sd_command(self, command, replies=None):
+        """Send an SD card command, raising if the printer reports a card or file problem"""
+        replies = [] if replies is None else replies
+        self.send_command(command, replies=replies)
+        for text in replies:
+            if any(failure in text.lower() for failure in _SD_FAILURES):
+                raise Exception(f"SD card: {text}")
+        return replies
+
+    def upload_file(self, name, commands):
+        """
+        Write G-code lines to a file on the SD card with M28/M29. Marlin checks
+        every line like a command and acknowledges it once written, so the
+        upload is streamed.
+        """
+        self._sd_command(f"M28 {name}")
+        try:
+            self.stream_actions([GcodeAction(command) for command in commands])
+        finally:
+            self._sd_command("M29")
+
+    def sd_print_actions(self, actions, name=SD_FILENAME, poll_interval=SD_POLL_INTERVAL):
+        """
+        Upload the actions to the SD card and print them from there (M23/M24),
+        so the planner runs at full speed whatever the host does. Progress comes
+        from M27's byte position and runs the callbacks of the actions read so
+        far, less the `window` commands Marlin may hold unexecuted in its
+        buffer. Pausing sends M25 and M24, stopping aborts with M524. Returns
+        the number of actions whose callbacks ran.
+        """
+        commands = [action.command for action in actions]
+        # Where each command ends in the file. Marlin may store lines with other
+        # endings, so positions are scaled by the file size it reports.
+        ends = list(accumulate(len(command) + 1 for command in commands))
+        self.upload_file(name, commands)
+        if self._stop_event.is_set() or not commands:
+            return 0
+
+        self._sd_command(f"M23 {name}")
+        self._sd_command("M24")
+        done = 0
+        paused = False
+        finished = False
+        while True:
+            replies = []
+            stopping = self._stop_event.is_set()
+            if not stopping and self._pause_event.is_set() != paused:
+                paused = not paused
+                self.send_command("M25" if paused else "M24", replies=replies)
+            self.send_command("M27", replies=replies)
+
+            read = None
+            for text in replies:
+                match = _SD_PROGRESS.search(text)
+                if match and int(match.group(2)):
+                    read = bisect_right(ends, int(match.group(1)) * ends[-1] / int(match.group(2)))
+                elif "done printing file" in text.lower() or ("not sd printing" in text.lower() and not paused):
+                    finished = True
+            if finished:
+                # Reading is over, wait for the last commands to run
+                self.send_command("M400")
+                read = len(actions) + self.window
+            if read is not None:
+                while done < min(read - self.window, len(actions)):
+                    actions[done].callback()
+                    if actions[done].dot:
+                        self.metrics.record_punch()
+                    done += 1
+            if finished:
+                break
+            if stopping:
+                # Progress was read just before, so the abort loses as little as possible
+                self.send_command("M524")
+                break
+            time.sleep(poll_interval)
+        return done
+
     def close(self):
         """Close the printer connection."""
+        self.stop_reader()
         if self.ser and self.ser.is_open:
             self.ser.close()
-            print("Connection closed.")
+            logger.info("Connection closed.")
 
     def stop(self):
-        """Stop the current print job."""
-        self._stop_event.set()
-        if self.print_thread:
-            self.print_thread.join()
-        self._stop_event.clear()
+        """
+        Stop the current print job started by print_gcode or print_pages. A
+        pool job is not stopped here but with PrinterPool.cancel, as the
+        pool's worker owns the port while it prints.
+        """
+        thread = self.print_thread
+        if thread is not None and thread.is_alive():
+            self._stop_event.set()
+            thread.join()
+            # Only once the thread writing to the port is gone, so it cannot miss the stop
+            self._stop_event.clear()
         self.status = PrintStatus.IDLE
         try:
             self.cleanup()
@@ -206,43 +552,154 @@ class PrinterConnection:
         return self.status
 
 
-def print_gcode(gcode_actions: List[GcodeAction], printer: PrinterConnection):
+def send_actions(gcode_actions: List[GcodeAction], printer: PrinterConnection, streaming: bool = STREAMING):
+    """Send G-code actions, honouring pause and stop, and run their callbacks once acknowledged"""
+    if printer.sd_card:
+        printer.sd_print_actions(gcode_actions)
+        return
+    if streaming:
+        printer.stream_actions(gcode_actions)
+        return
+
+    for action in gcode_actions:
+        if printer._stop_event.is_set():
+            break
+
+        while printer._pause_event.is_set():
+            time.sleep(0.1)
+            if printer._stop_event.is_set():
+                break
+
+        printer.send_command(action.command)
+        action.callback()
+        if action.dot:
+            printer.metrics.record_punch()
+
+def wait_for_paper(printer: PrinterConnection, reason: str = "paper"):
+    """Pause until the operator loads the next sheet (or flips this one) and resumes"""
+    printer.pause_reason = reason
+    printer._pause_event.set()
+    printer.status = PrintStatus.PAUSED
+    while printer._pause_event.is_set() and not printer._stop_event.is_set():
+        time.sleep(0.1)
+    printer.pause_reason = None
+
+def print_gcode(gcode_actions: List[GcodeAction], printer: PrinterConnection, streaming: bool = STREAMING):
     def print_thread():
         try:
             printer.initialize()
             printer.status = PrintStatus.PRINTING
-            
-            for action in gcode_actions:
-                if printer._stop_event.is_set():
-                    break
-                    
-                while printer._pause_event.is_set():
-                    time.sleep(0.1)
-                    if printer._stop_event.is_set():
-                        break
-                        
-                printer.send_command(action.command)
-                action.callback()
-                
+
+            send_actions(gcode_actions, printer, streaming)
+
             if not printer._stop_event.is_set():
                 printer.cleanup()
                 printer.status = PrintStatus.COMPLETED
                 
         except serial.SerialException as e:
-            print(f"Serial error: {e}")
+            logger.error("Serial error: %s", e)
             printer.status = PrintStatus.ERROR
         except Exception as e:
-            print(f"Error: {e}")
+            logger.exception("Error: %s", e)
             printer.status = PrintStatus.ERROR
 
     if DEBUG:
         print("DEBUG: starting print thread")
+    # Not the page or the finished status of an earlier job, for /eta until the thread gets going
+    printer.current_page = None
+    printer.status = PrintStatus.PRINTING
     printer.print_thread = threading.Thread(target=print_thread)
     printer.print_thread.start()
     if DEBUG:
         print("DEBUG: print thread started")
     return printer  # Return printer object so caller can control/monitor the print
 
+def print_pages(pages: Iterable[List[DotPosition]], printer: PrinterConnection,
+                streaming: bool = STREAMING, queue_size: int = PAGE_QUEUE_SIZE,
+                interpoint: bool = INTERPOINT, profile: Optional[LayoutProfile] = None):
+    """
+    Print pages while they are still being produced. `pages` is consumed on a
+    converter thread (e.g. a generator over extraction, translation and
+    layout) that runs at most `queue_size` pages ahead of the printer. The
+    printer pauses for a new sheet between pages. With interpoint, odd pages
+    go on the back: the printer pauses for the sheet to be flipped instead,
+    and punches them mirrored. The pages are placed with `profile`, the
+    printer's own if None.
+    """
+    profile = profile or printer.profile
+    page_queue = queue.Queue(maxsize=queue_size)
+    done = object()
+    finished = threading.Event()  # set once the print thread stops taking pages
+    printer.pages_converted = 0
+    printer.current_page = None
+
+    def put(item):
+        # Blocks while the printer is behind, unless the job is over
+        while not finished.is_set() and not printer._stop_event.is_set():
+            try:
+                page_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def convert_thread():
+        try:
+            for page in pages:
+                if not put(page):
+                    return
+                if finished.is_set():
+                    return
+                printer.pages_converted += 1
+        except Exception as e:
+            logger.exception("Conversion failed: %s", e)
+            put(e)
+        put(done)
+
+    def print_thread():
+        try:
+            converter.start()
+            page_num = 0
+            while not printer._stop_event.is_set():
+                try:
+                    page = page_queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if page is done:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                if page_num > 0:
+                    wait_for_paper(printer, "flip" if interpoint and is_back(page_num) else "paper")
+                    if printer._stop_event.is_set():
+                        break
+
+                printer.current_page = page_num
+                printer.initialize()
+                printer.status = PrintStatus.PRINTING
+                send_actions(dot_pos_to_gcode(page, interpoint=interpoint, profile=profile), printer, streaming)
+                if printer._stop_event.is_set():
+                    break
+                printer.cleanup()
+                page_num += 1
+
+            if not printer._stop_event.is_set():
+                printer.status = PrintStatus.COMPLETED
+
+        except serial.SerialException as e:
+            logger.error("Serial error: %s", e)
+            printer.status = PrintStatus.ERROR
+        except Exception as e:
+            logger.exception("Error: %s", e)
+            printer.status = PrintStatus.ERROR
+        finally:
+            finished.set()
+
+    converter = threading.Thread(target=convert_thread, daemon=True)
+    printer.print_thread = threading.Thread(target=print_thread)
+    printer.print_thread.start()
+    return printer
+
 def stop_print(printer: PrinterConnection):
     if DEBUG:
         print("DEBUG: stopping print")
@@ -265,7 +722,7 @@ def resume_print(printer: PrinterConnection):
         print("DEBUG: print resumed")
 
 def print_dots(dots: List[DotPosition], printer: PrinterConnection):
-    gcode_actions = dot_pos_to_gcode(dots)
+    gcode_actions = dot_pos_to_gcode(dots, profile=printer.profile)
     return print_gcode(gcode_actions, printer)
 
 def main():
@@ -300,5 +757,71 @@ def main():
     finally:
         printer.close()
 
+
+def _stream_to_virtual_printer(actions, **printer_kwargs):
+    """Stream actions to a virtual printer, returning the printer and the G1 lines it executed"""
+    from utils.virtual_printer import VirtualPrinter
+    with VirtualPrinter(move_time=0, punch_time=0, latency=0, seed=0, keep_log=True, **printer_kwargs) as virtual:
+        printer = PrinterConnection(virtual.port, virtual.baud_rate)
+        printer.connect()
+        try:
+            printer.stream_actions(actions)
+            printer.send_command("M400")
+        finally:
+            printer.close()
+        return printer, [command for command in virtual.log if command.startswith("G1 ")]
+
+
+def test_parse_reply():
+    """Test function to verify Marlin replies are classified"""
+    assert parse_reply("ok").kind == "ok"
+    assert parse_reply("Resend: 12").line_number == 12
+    advanced = parse_reply("ok N5 P15 B3")
+    assert (advanced.kind, advanced.line_number, advanced.free_planner, advanced.free_buffer) == ("ok", 5, 15, 3)
+    assert parse_reply("Error:checksum mismatch, Last Line: 4").kind == "error"
+    assert parse_reply("echo:busy: processing").kind == "busy"
+
+
+def test_stream_actions_resends():
+    """Test function to verify streaming survives corrupted lines, in order and exactly once"""
+    acked = []
+    actions = [GcodeAction(f"G1 X{i} Y{i % 7} F4000") for i in range(150)]
+    for action in actions:
+        action.callback = lambda action=action: acked.append(action)
+    printer, executed = _stream_to_virtual_printer(actions, error_rate=0.05)
+    assert executed == [action.command for action in actions]
+    assert acked == actions
+    assert printer.metrics.resends > 0
+
+
+def test_stream_actions_advanced_ok():
+    """Test function to verify the window follows ADVANCED_OK's free buffer count"""
+    actions = [GcodeAction(f"G1 X{i} Y0 F4000") for i in range(60)]
+    _, executed = _stream_to_virtual_printer(actions, advanced_ok=True, buffer_size=2)
+    assert executed == [action.command for action in actions]
+
+
+
+def test_sd_upload_and_print():
+    """Test function to verify an SD upload is written exactly once through resends, then printed from the card"""
+    from utils.virtual_printer import VirtualPrinter
+    actions = [GcodeAction(f"G1 X{i} Y{i % 5} F4000") for i in range(80)]
+    acked = []
+    for action in actions:
+        action.callback = lambda action=action: acked.append(action)
+    commands = [action.command for action in actions]
+    with VirtualPrinter(move_time=0, punch_time=0, latency=0, error_rate=0.05, seed=1, keep_log=True) as virtual:
+        printer = PrinterConnection(virtual.port, virtual.baud_rate)
+        printer.connect()
+        try:
+            printer.upload_file("UPLOAD.GCO", commands)
+            assert virtual.files["UPLOAD.GCO"] == "".join(command + "\r\n" for command in commands)
+            assert printer.metrics.resends > 0
+            assert printer.sd_print_actions(actions, poll_interval=0.01) == len(actions)
+        finally:
+            printer.close()
+        assert [command for command in virtual.log if command.startswith("G1 ")] == commands
+    assert acked == actions
+
 if __name__ == "__main__":
     main()
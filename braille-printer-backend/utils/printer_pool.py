@@ -0,0 +1,638 @@
+from collections import deque
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Dict, List, Optional
+import itertools
+import logging
+import pickle
+import threading
+import time
+
+from utils.braille_to_gcode import INTERPOINT, PUNCH_ORDER, DotPosition, PrintedDots, dot_pos_to_gcode, is_back
+from utils.job_journal import JOURNAL_DIR, JobJournal, JournalSink, list_journals, load_journal, skip_punches
+from utils.layout_profile import DEFAULT_PROFILE, LayoutProfile
+from utils.print_time import JobEstimate, estimate_pages
+from utils.printer import STREAMING, PrinterConnection, PrintStatus, send_actions
+
+logger = logging.getLogger(__name__)
+
+DEBUG = False
+
+# Times a page is handed to another printer after a printer fails on it
+MAX_ATTEMPTS = 2
+
+
+class JobStatus(Enum):
+    QUEUED = "queued"
+    PRINTING = "printing"
+    COMPLETED = "completed"
+    CANCELLED = "cancelled"
+    FAILED = "failed"
+    INTERRUPTED = "interrupted"  # recovered from the journal after a restart, see resume()
+
+
+class SlotState(Enum):
+    READY = "ready"  # sheet loaded, can take the next page
+    AWAITING_PAPER = "awaiting_paper"  # finished a page, waiting for a new sheet
+    AWAITING_FLIP = "awaiting_flip"  # finished the front of an interpoint sheet, waiting for it to be turned over
+    PRINTING = "printing"
+    ERROR = "error"
+
+
+@dataclass
+class PrintJob:
+    """A document queued on the pool. Progress is kept per job, not per server."""
+    id: int
+    pages: List[List[DotPosition]]
+    split_pages: bool  # pages may go to different printers instead of one printer in order
+    status: JobStatus = JobStatus.QUEUED
+    printed_dots: PrintedDots = field(default_factory=PrintedDots)
+    pages_done: List[int] = field(default_factory=list)
+    punches_done: Dict[int, int] = field(default_factory=dict)  # acknowledged punches of unfinished pages
+    printers: List[str] = field(default_factory=list)
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    journal: Optional[JobJournal] = None
+    estimate: Optional[JobEstimate] = None
+    profile: LayoutProfile = DEFAULT_PROFILE  # the pages were laid out for it, only printers with it take them
+    punch_order: str = PUNCH_ORDER  # kept with the job, so resumed pages skip the same punches they were planned with
+    interpoint: bool = INTERPOINT  # odd pages go mirrored on the back of the sheet before them
+
+    @property
+    def num_pages(self) -> int:
+        return len(self.pages)
+
+    def remaining_seconds(self) -> Optional[float]:
+        """Printer time left, not counting paper changes or other printers sharing the job"""
+        if self.estimate is None:
+            return None
+        if self.status in (JobStatus.COMPLETED, JobStatus.CANCELLED):
+            return 0.0
+        return self.estimate.remaining_seconds(self.pages_done, self.punches_done)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "status": self.status.value,
+            "splitPages": self.split_pages,
+            "numPages": self.num_pages,
+            "pagesDone": sorted(self.pages_done),
+            "punchesDone": {str(page): count for page, count in self.punches_done.items()},
+            "dotsPrinted": len(self.printed_dots.dots),
+            "printers": self.printers,
+            "profile": self.profile.name,
+            "interpoint": self.interpoint,
+            "estimatedSeconds": self.estimate.seconds if self.estimate else None,
+            "remainingSeconds": self.remaining_seconds(),
+            "error": self.error,
+            "createdAt": self.created_at,
+            "finishedAt": self.finished_at,
+        }
+
+
+@dataclass
+class PrintTask:
+    """Pages of one job that go to the same printer, in order"""
+    job: PrintJob
+    page_nums: List[int]
+    attempts: int = 0
+    port: Optional[str] = None  # set when the first page is half punched on that printer's sheet
+
+
+class PrinterSlot:
+    """A printer in the pool and the worker thread that feeds it"""
+
+    def __init__(self, printer: PrinterConnection, paper_loaded: bool = True):
+        self.printer = printer
+        self.state = SlotState.READY if paper_loaded else SlotState.AWAITING_PAPER
+        self.job: Optional[PrintJob] = None
+        self.page: Optional[int] = None
+        self.pages_printed = 0
+        self.error: Optional[str] = None
+        self.thread: Optional[threading.Thread] = None
+        self.removed = False
+
+    @property
+    def port(self) -> str:
+        return self.printer.port
+
+    def to_dict(self) -> dict:
+        return {
+            "port": self.port,
+            "state": self.state.value,
+            "status": self.printer.get_status().value,
+            "job": self.job.id if self.job else None,
+            "page": self.page,
+            "sdCard": self.printer.sd_card,
+            "profile": self.printer.profile.name,
+            "pagesPrinted": self.pages_printed,
+            "error": self.error,
+        }
+
+
+class PrinterPool:
+    """
+    Several printers registered by port, fed from one job queue.
+
+    A job either goes to a single printer that prints every page in order, or
+    is split so that each page goes to whichever printer is free first. A
+    printer takes work only while it is READY, i.e. has a sheet loaded. After
+    each page it waits in AWAITING_PAPER until paper_loaded() is called. A
+    printer only takes jobs laid out for its own layout profile, so printers
+    with different paper can share the pool. With interpoint, a printer waits
+    in AWAITING_FLIP after the front of a sheet and both sides of a sheet
+    always go to the same printer.
+
+    Jobs are journaled in `journal_dir` (None turns this off). Unfinished
+    jobs found there are loaded as INTERRUPTED, the first time the jobs are
+    used rather than when the pool is created, and can be resumed from their
+    last acknowledged punch.
+    """
+
+    def __init__(self, streaming: bool = STREAMING, journal_dir: Optional[str] = JOURNAL_DIR):
+        self.streaming = streaming
+        self.journal_dir = journal_dir
+        self.slots: Dict[str, PrinterSlot] = {}
+        self._jobs: Dict[int, PrintJob] = {}
+        self._tasks = deque()
+        self._cond = threading.Condition()
+        self._ids = itertools.count(1)
+        self._recover_lock = threading.Lock()
+        self._recovered = not journal_dir
+
+    @property
+    def jobs(self) -> Dict[int, PrintJob]:
+        """Every job by id, including the ones recovered from the journals"""
+        self._recover_journals()
+        return self._jobs
+
+    # Printers
+
+    def add_printer(self, printer: PrinterConnection, paper_loaded: bool = True) -> PrinterSlot:
+        with self._cond:
+            if printer.port in self.slots:
+                raise ValueError(f"Printer {printer.port} is already in the pool")
+            slot = PrinterSlot(printer, paper_loaded)
+            self.slots[printer.port] = slot
+            slot.thread = threading.Thread(target=self._worker, args=(slot,), daemon=True)
+            slot.thread.start()
+            self._cond.notify_all()
+        return slot
+
+    def remove_printer(self, port: str) -> PrinterConnection:
+        """Take a printer out of the pool, stopping the page it is on"""
+        with self._cond:
+            slot = self.slots.pop(port)
+            slot.removed = True
+            self._cond.notify_all()
+        if slot.state == SlotState.PRINTING:
+            slot.printer._stop_event.set()
+        if slot.thread is not None:
+            slot.thread.join()
+        slot.printer._stop_event.clear()
+        return slot.printer
+
+    def get_printer(self, port: str) -> Optional[PrinterConnection]:
+        slot = self.slots.get(port)
+        return slot.printer if slot else None
+
+    def paper_loaded(self, port: str):
+        """The operator put a new sheet in, turned the sheet over, or cleared an error"""
+        with self._cond:
+            slot = self.slots[port]
+            if slot.state in (SlotState.AWAITING_PAPER, SlotState.AWAITING_FLIP, SlotState.ERROR):
+                slot.state = SlotState.READY
+                slot.error = None
+                self._cond.notify_all()
+
+    # Jobs
+
+    def submit(self, pages: List[List[DotPosition]], split_pages: bool = False,
+               profile: LayoutProfile = DEFAULT_PROFILE, punch_order: str = PUNCH_ORDER,
+               interpoint: bool = INTERPOINT) -> PrintJob:
+        """Queue pages laid out with `profile`"""
+        self._recover_journals()  # new ids follow the journaled ones
+        estimate = estimate_pages(pages, punch_order, profile=profile)
+        with self._cond:
+            job = PrintJob(next(self._ids), pages, split_pages, estimate=estimate, profile=profile,
+                           punch_order=punch_order, interpoint=interpoint)
+            if self.journal_dir:
+                job.journal = JobJournal(job.id, self.journal_dir)
+                job.journal.start(pages, job.punch_order, split_pages, job.created_at, profile, interpoint)
+            self.jobs[job.id] = job
+            page_nums = list(range(len(pages)))
+            if not page_nums:
+                self._finish(job, JobStatus.COMPLETED)
+            elif split_pages:
+                self._tasks.extend(PrintTask(job, sheet) for sheet in self._sheets(job, page_nums))
+            else:
+                self._tasks.append(PrintTask(job, page_nums))
+            self._cond.notify_all()
+        return job
+
+    def cancel(self, job_id: int) -> PrintJob:
+        with self._cond:
+            job = self.jobs[job_id]
+            if job.status not in (JobStatus.QUEUED, JobStatus.PRINTING):
+                return job
+            self._tasks = deque(task for task in self._tasks if task.job is not job)
+            self._finish(job, JobStatus.CANCELLED)
+            for slot in self.slots.values():
+                if slot.job is job and slot.state == SlotState.PRINTING:
+                    slot.printer._stop_event.set()
+            self._cond.notify_all()
+        return job
+
+    def cancel_on(self, port: str) -> Optional[PrintJob]:
+        """Cancel the job a printer is working on, None if it has none"""
+        with self._cond:
+            slot = self.slots.get(port)
+            if slot is None or slot.job is None:
+                return None
+            return self.cancel(slot.job.id)
+
+    def resume(self, job_id: int, port: Optional[str] = None) -> PrintJob:
+        """
+        Queue the rest of an interrupted or failed job. A half punched page
+        continues from its last acknowledged punch after re-homing, on `port`
+        if given (the printer holding that sheet), otherwise on any printer.
+        """
+        with self._cond:
+            job = self.jobs[job_id]
+            if job.status not in (JobStatus.INTERRUPTED, JobStatus.FAILED):
+                raise ValueError(f"Job {job_id} is {job.status.value}, only interrupted or failed jobs resume")
+            remaining = [page for page in range(job.num_pages) if page not in job.pages_done]
+            if job.journal is not None:
+                job.journal.start(job.pages, job.punch_order, job.split_pages, job.created_at, job.profile,
+                                  job.interpoint)
+            job.status = JobStatus.QUEUED
+            job.error = None
+            job.finished_at = None
+            if job.split_pages:
+                self._tasks.extend(PrintTask(job, sheet, port=port if self._on_sheet(job, sheet[0]) else None)
+                                   for sheet in self._sheets(job, remaining))
+            elif remaining:
+                self._tasks.append(PrintTask(job, remaining, port=port))
+            self._cond.notify_all()
+        return job
+
+    def _recover_journals(self):
+        """Load the unfinished jobs in journal_dir, once. Each is unpickled and estimated, so not at import."""
+        with self._recover_lock:
+            if self._recovered:
+                return
+            journaled = list_journals(self.journal_dir)
+            if journaled:
+                self._ids = itertools.count(journaled[-1] + 1)
+            for job_id in journaled:
+                self._recover(job_id)
+            self._recovered = True
+
+    def _recover(self, job_id: int):
+        try:
+            state = load_journal(job_id, self.journal_dir)
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            logger.error("Could not read journal of job %s: %s", job_id, e)
+            return
+        job = PrintJob(job_id, state.pages, state.split_pages, JobStatus.INTERRUPTED,
+                       printed_dots=state.printed_dots(), pages_done=state.pages_done,
+                       punches_done={page: count for page, count in state.punches_done.items()
+                                     if page not in state.pages_done},
+                       created_at=state.created_at,
+                       journal=JobJournal(job_id, self.journal_dir),
+                       estimate=estimate_pages(state.pages, state.punch_order, profile=state.profile),
+                       profile=state.profile, punch_order=state.punch_order, interpoint=state.interpoint)
+        self._jobs[job_id] = job
+        logger.info("Recovered job %s: %s of %s pages done", job_id, len(job.pages_done), job.num_pages)
+
+    def _finish(self, job: PrintJob, status: JobStatus, error: str = None):
+        job.status = status
+        job.error = error
+        job.finished_at = time.time()
+        if job.journal is not None:
+            if status == JobStatus.FAILED:
+                job.journal.close()  # kept so the job can be resumed
+            else:
+                job.journal.remove()
+
+    def close(self):
+        """Flush every journal, e.g. on shutdown"""
+        with self._cond:
+            for job in self._jobs.values():
+                if job.journal is not None:
+                    job.journal.close()
+
+    def status(self) -> dict:
+        with self._cond:
+            busy = sum(slot.state == SlotState.PRINTING for slot in self.slots.values())
+            return {
+                "printers": [slot.to_dict() for slot in self.slots.values()],
+                "queuedPages": sum(len(task.page_nums) for task in self._tasks),
+                "queuedTasks": len(self._tasks),
+                "queuedSeconds": sum(task.job.estimate.pages[page].seconds for task in self._tasks
+                                     for page in task.page_nums if task.job.estimate),
+                "busy": busy,
+                "utilization": busy / len(self.slots) if self.slots else 0.0,
+                "jobs": {status.value: sum(job.status == status for job in self.jobs.values())
+                         for status in JobStatus},
+            }
+
+    # Scheduling
+
+    def _idle(self, slot: PrinterSlot) -> bool:
+        # A print started outside the pool (print_gcode, print_pages) keeps the printer busy
+        legacy_thread = slot.printer.print_thread
+        return slot.state == SlotState.READY and not (legacy_thread and legacy_thread.is_alive())
+
+    def _next_task(self, slot: PrinterSlot) -> Optional[PrintTask]:
+        """Block until this printer is ready and there is work, None once removed"""
+        with self._cond:
+            while not slot.removed:
+                task = next((task for task in self._tasks if task.port in (None, slot.port)
+                             and task.job.profile == slot.printer.profile), None)
+                if task is not None and self._idle(slot):
+                    self._tasks.remove(task)
+                    slot.job = task.job
+                    slot.state = SlotState.PRINTING
+                    task.job.status = JobStatus.PRINTING
+                    if slot.port not in task.job.printers:
+                        task.job.printers.append(slot.port)
+                    return task
+                self._cond.wait(timeout=1)
+        return None
+
+    def _wait_ready(self, slot: PrinterSlot, job: PrintJob) -> bool:
+        """Between pages of a task, wait for the next sheet or for this one to be flipped"""
+        with self._cond:
+            while slot.state in (SlotState.AWAITING_PAPER, SlotState.AWAITING_FLIP):
+                if slot.removed or job.status == JobStatus.CANCELLED:
+                    return False
+                self._cond.wait(timeout=1)
+            if slot.state != SlotState.READY:
+                return False
+            slot.state = SlotState.PRINTING
+            return True
+
+    def _worker(self, slot: PrinterSlot):
+        while True:
+            task = self._next_task(slot)
+            if task is None:
+                return
+            self._run_task(slot, task)
+
+    @staticmethod
+    def _sheets(job: PrintJob, page_nums: List[int]) -> List[List[int]]:
+        """Pages of a split job that go to one printer: each page, or with interpoint both sides of a sheet"""
+        sheets = {}
+        for page in page_nums:
+            sheets.setdefault(page // 2 if job.interpoint else page, []).append(page)
+        return list(sheets.values())
+
+    @staticmethod
+    def _on_sheet(job: PrintJob, page: int) -> bool:
+        """Whether the page goes on a sheet that is in a printer: it is part punched, or the back of a printed front"""
+        return bool(job.punches_done.get(page)) or (job.interpoint and is_back(page) and page - 1 in job.pages_done)
+
+    def _sheet_port(self, slot: PrinterSlot, job: PrintJob, remaining: List[int]) -> Optional[str]:
+        """The printer the next page has to continue on, if its sheet is in there"""
+        return slot.port if remaining and self._on_sheet(job, remaining[0]) else None
+
+    def _run_task(self, slot: PrinterSlot, task: PrintTask):
+        job = task.job
+        printer = slot.printer
+        remaining = list(task.page_nums)
+        requeued = False
+        try:
+            while remaining and job.status == JobStatus.PRINTING:
+                if len(remaining) < len(task.page_nums) and not self._wait_ready(slot, job):
+                    break
+                page = remaining[0]
+                slot.page = page
+                if DEBUG:
+                    print(f"DEBUG: {slot.port} printing job {job.id} page {page}")
+                printer.current_page = page
+                sink = JournalSink(job.printed_dots, page, job.journal, job.punches_done.get(page, 0))
+                # initialize() homes the head, so a half punched page carries on after its last acked punch
+                actions = skip_punches(dot_pos_to_gcode(job.pages[page], job.punch_order, sink, job.interpoint,
+                                                        job.profile), sink.punches)
+                printer.initialize()
+                printer.status = PrintStatus.PRINTING
+                try:
+                    send_actions(actions, printer, self.streaming)
+                finally:
+                    job.punches_done[page] = sink.punches
+                if printer._stop_event.is_set():
+                    # Cancelled or removed, lift the head like PrinterConnection.stop
+                    printer._stop_event.clear()
+                    printer.cleanup()
+                    printer.status = PrintStatus.IDLE
+                    break
+                printer.cleanup()
+                printer.status = PrintStatus.COMPLETED
+                remaining.pop(0)
+                if job.journal is not None:
+                    job.journal.page_done(page)
+                with self._cond:
+                    job.punches_done.pop(page, None)
+                    job.pages_done.append(page)
+                    slot.pages_printed += 1
+                    flip = job.interpoint and remaining and remaining[0] == page + 1 and is_back(page + 1)
+                    slot.state = SlotState.AWAITING_FLIP if flip else SlotState.AWAITING_PAPER
+        except Exception as e:
+            logger.exception("Printer %s failed on job %s: %s", slot.port, job.id, e)
+            printer.status = PrintStatus.ERROR
+            with self._cond:
+                slot.state = SlotState.ERROR
+                slot.error = str(e)
+                task.attempts += 1
+                if job.status == JobStatus.PRINTING:
+                    requeued = True
+                    if task.attempts < MAX_ATTEMPTS:
+                        # Let another printer pick the rest up, unless a sheet is half punched
+                        self._tasks.appendleft(PrintTask(job, remaining, task.attempts,
+                                                         self._sheet_port(slot, job, remaining)))
+                    else:
+                        self._tasks = deque(t for t in self._tasks if t.job is not job)
+                        self._finish(job, JobStatus.FAILED, str(e))
+                self._cond.notify_all()
+        finally:
+            printer._stop_event.clear()
+            with self._cond:
+                slot.job = None
+                slot.page = None
+                if slot.state == SlotState.PRINTING:
+                    # Stopped part way through a page, the sheet has to be replaced
+                    slot.state = SlotState.AWAITING_PAPER
+                if job.status == JobStatus.PRINTING:
+                    if len(job.pages_done) == job.num_pages:
+                        self._finish(job, JobStatus.COMPLETED)
+                    elif remaining and not requeued:
+                        # Printer was removed mid-job, another one carries on
+                        self._tasks.appendleft(PrintTask(job, remaining, task.attempts,
+                                                         self._sheet_port(slot, job, remaining)))
+                self._cond.notify_all()
+
+
+def _test_pages(count: int) -> List[List[DotPosition]]:
+    return [[DotPosition(10.0, 20.0, True, page), DotPosition(12.5, 20.0, True, page)] for page in range(count)]
+
+
+def _run_pool(pool: PrinterPool, job: PrintJob, timeout: float = 30) -> int:
+    """Load or flip paper whenever a printer asks for it, until the job is over. Returns the flips."""
+    deadline = time.monotonic() + timeout
+    flips = 0
+    while job.status in (JobStatus.QUEUED, JobStatus.PRINTING):
+        assert time.monotonic() < deadline, f"Job {job.id} is still {job.status.value}"
+        for port, slot in list(pool.slots.items()):
+            if slot.state in (SlotState.AWAITING_PAPER, SlotState.AWAITING_FLIP):
+                flips += slot.state == SlotState.AWAITING_FLIP
+                pool.paper_loaded(port)
+        time.sleep(0.01)
+    return flips
+
+
+def _connect_virtual(virtual) -> PrinterConnection:
+    printer = PrinterConnection(virtual.port, virtual.baud_rate)
+    printer.connect()
+    return printer
+
+
+def test_pool_scheduling():
+    """Test function to verify split jobs spread over printers and whole jobs stay on one, in order"""
+    from utils.layout_profile import get_profile
+    from utils.virtual_printer import VirtualPrinter
+
+    with VirtualPrinter(move_time=0, punch_time=0, latency=0) as first, \
+            VirtualPrinter(move_time=0, punch_time=0, latency=0) as second:
+        pool = PrinterPool(journal_dir=None)
+        for virtual in (first, second):
+            pool.add_printer(_connect_virtual(virtual))
+        try:
+            split = pool.submit(_test_pages(4), split_pages=True)
+            _run_pool(pool, split)
+            assert split.status == JobStatus.COMPLETED
+            assert sorted(split.pages_done) == [0, 1, 2, 3]
+            assert sorted(split.printers) == sorted([first.port, second.port])
+
+            whole = pool.submit(_test_pages(3))
+            _run_pool(pool, whole)
+            assert whole.status == JobStatus.COMPLETED
+            assert whole.pages_done == [0, 1, 2]
+            assert len(whole.printers) == 1
+            assert len(whole.printed_dots.dots) == 6
+
+            # No printer has A4 paper, so the job waits in the queue
+            a4 = pool.submit(_test_pages(1), profile=get_profile("a4"))
+            time.sleep(0.2)
+            assert a4.status == JobStatus.QUEUED and pool.status()["queuedTasks"] == 1
+            pool.cancel(a4.id)
+            assert pool.status()["queuedTasks"] == 0
+        finally:
+            for port in list(pool.slots):
+                pool.remove_printer(port).close()
+
+
+def test_pool_retries():
+    """Test function to verify a failed page moves to another printer, and the job fails after MAX_ATTEMPTS"""
+    from utils.virtual_printer import VirtualPrinter
+
+    def fail():
+        raise IOError("printer unplugged")
+
+    with VirtualPrinter(move_time=0, punch_time=0, latency=0) as broken, \
+            VirtualPrinter(move_time=0, punch_time=0, latency=0) as working:
+        pool = PrinterPool(journal_dir=None)
+        broken_printer = _connect_virtual(broken)
+        broken_printer.initialize = fail
+        pool.add_printer(broken_printer)
+        try:
+            job = pool.submit(_test_pages(1), split_pages=True)
+            deadline = time.monotonic() + 10
+            while pool.slots[broken.port].state != SlotState.ERROR:
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+            assert job.status == JobStatus.PRINTING and pool.status()["queuedTasks"] == 1
+
+            pool.add_printer(_connect_virtual(working))
+            _run_pool(pool, job)
+            assert job.status == JobStatus.COMPLETED
+            assert job.printers == [broken.port, working.port]
+
+            pool.remove_printer(working.port).close()
+            doomed = pool.submit(_test_pages(1), split_pages=True)
+            # Clearing the error lets the broken printer try again, up to MAX_ATTEMPTS
+            deadline = time.monotonic() + 10
+            while doomed.status != JobStatus.FAILED:
+                assert time.monotonic() < deadline, f"Job is still {doomed.status.value}"
+                if pool.slots[broken.port].state == SlotState.ERROR:
+                    pool.paper_loaded(broken.port)
+                time.sleep(0.01)
+            assert doomed.error == "printer unplugged"
+            assert pool.status()["queuedTasks"] == 0
+        finally:
+            for port in list(pool.slots):
+                pool.remove_printer(port).close()
+
+
+def test_pool_resume():
+    """Test function to verify a recovered job carries on after its last journaled punch, in its own punch order"""
+    import tempfile
+    from utils.virtual_printer import VirtualPrinter
+
+    journal_dir = tempfile.mkdtemp()
+    page = [DotPosition(x, y, True, 0) for y in (10.0, 20.0, 30.0) for x in (10.0, 12.5, 15.0)]
+    actions = dot_pos_to_gcode(page, "layout")
+    planned = [(action.dot.x, action.dot.y) for action in actions if action.dot]
+    punch = next(action.command for action in actions if action.dot)
+    assert planned != [(action.dot.x, action.dot.y) for action in dot_pos_to_gcode(page) if action.dot]
+
+    # No printer, so the job only gets as far as the journal says before the "crash"
+    crashed = PrinterPool(journal_dir=journal_dir)
+    job = crashed.submit([page], punch_order="layout")
+    job.journal.record_punch(0, 2)
+    crashed.close()
+
+    pool = PrinterPool(journal_dir=journal_dir)
+    assert not pool._recovered, "Journals should be read on first use, not when the pool is created"
+    job = pool.jobs[job.id]
+    assert job.status == JobStatus.INTERRUPTED
+    assert (job.punch_order, job.punches_done) == ("layout", {0: 2})
+    assert [(dot.x, dot.y) for dot in job.printed_dots.dots] == planned[:2]
+
+    with VirtualPrinter(move_time=0, punch_time=0, latency=0, keep_log=True) as virtual:
+        pool.add_printer(_connect_virtual(virtual))
+        try:
+            pool.resume(job.id, virtual.port)
+            _run_pool(pool, job)
+        finally:
+            pool.remove_printer(virtual.port).close()
+        assert job.status == JobStatus.COMPLETED
+        assert virtual.log.count(punch) == len(planned) - 2
+    assert [(dot.x, dot.y) for dot in job.printed_dots.dots] == planned
+    assert list_journals(journal_dir) == []
+
+
+def test_pool_interpoint():
+    """Test function to verify both sides of an interpoint sheet go to one printer, with a flip in between"""
+    from utils.virtual_printer import VirtualPrinter
+
+    # Page n has n + 1 dots, so the punches each printer made tell which pages it printed
+    pages = [[DotPosition(10.0 + 2.5 * i, 20.0, True, page) for i in range(page + 1)] for page in range(4)]
+    with VirtualPrinter(move_time=0, punch_time=0, latency=0, keep_log=True) as first, \
+            VirtualPrinter(move_time=0, punch_time=0, latency=0, keep_log=True) as second:
+        pool = PrinterPool(journal_dir=None)
+        for virtual in (first, second):
+            pool.add_printer(_connect_virtual(virtual))
+        try:
+            punch = next(action.command for action in dot_pos_to_gcode(pages[0]) if action.dot)
+            job = pool.submit(pages, split_pages=True, interpoint=True)
+            assert PrinterPool._sheets(job, [1, 2, 3]) == [[1], [2, 3]]
+            assert _run_pool(pool, job) == 2
+            assert job.status == JobStatus.COMPLETED
+        finally:
+            for port in list(pool.slots):
+                pool.remove_printer(port).close()
+        punches = [virtual.log.count(punch) for virtual in (first, second)]
+    assert sum(punches) == 10
+    assert all(count in (0, 1 + 2, 3 + 4, 10) for count in punches), punches
@@ -1,9 +1,37 @@
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+
+from utils.grade2_rules import RULES, WORD, BEGIN, MIDDLE, NOT_BEGIN, ANY, LETTER_SIGN, LETTERS_WITHOUT_SIGN
+
 # import pybrl as brl
 
+# North American ASCII braille, in the order of the Unicode braille patterns
+ASCII_BRAILLE_CHARS = " A1B'K2L@CIF/MSP\"E3H9O6R^DJG>NTQ,*5<-U8V.%[$+X!&;:4\\0Z7(_?W]#Y)="
+UNICODE_BRAILLE_CHARS = "⠀⠁⠂⠃⠄⠅⠆⠇⠈⠉⠊⠋⠌⠍⠎⠏⠐⠑⠒⠓⠔⠕⠖⠗⠘⠙⠚⠛⠜⠝⠞⠟⠠⠡⠢⠣⠤⠥⠦⠧⠨⠩⠪⠫⠬⠭⠮⠯⠰⠱⠲⠳⠴⠵⠶⠷⠸⠹⠺⠻⠼⠽⠾⠿"
+BRAILLE_MAP = dict(zip(ASCII_BRAILLE_CHARS, UNICODE_BRAILLE_CHARS))
+BRAILLE_MAP['\n'] = '\n'
+GRADE1_TABLE = str.maketrans(BRAILLE_MAP)
+# A run of digits is written as the number sign and the letters a-j for 1-9
+# and 0. A letter a-j right after it gets the letter sign, or it would read
+# as another digit.
+NUMBER_PATTERN = re.compile(r"([0-9]+)([A-J]?)")
+NUMBER_SIGN = "#"
+DIGIT_LETTERS = str.maketrans("1234567890", "ABCDEFGHIJ")
+
+def _ascii_braille_to_unicode(ascii_braille) -> str:
+    """Cells written in North American ASCII braille, e.g. in utils/grade2_rules.py"""
+    return ascii_braille.upper().translate(GRADE1_TABLE)
+
+def _number_to_ascii_braille(match) -> str:
+    digits, letter = match.groups()
+    return NUMBER_SIGN + digits.translate(DIGIT_LETTERS) + (";" + letter if letter else "")
+
 def text_to_braille_grade1(text) -> str:
     """
     Converts text to braille representation using Unicode braille patterns.
-    Each character is mapped to its corresponding braille pattern.
+    Each character is mapped to its corresponding braille pattern, and
+    numbers are written with the number sign.
     
     Args:
         text (str): Input text to convert to braille
@@ -11,12 +39,11 @@ def text_to_braille_grade1(text) -> str:
     Returns:
         str: Braille representation of the input text
     """
-    chars = " A1B'K2L@CIF/MSP\"E3H9O6R^DJG>NTQ,*5<-U8V.%[$+X!&;:4\\0Z7(_?W]#Y)="
-    brailles = "⠀⠁⠂⠃⠄⠅⠆⠇⠈⠉⠊⠋⠌⠍⠎⠏⠐⠑⠒⠓⠔⠕⠖⠗⠘⠙⠚⠛⠜⠝⠞⠟⠠⠡⠢⠣⠤⠥⠦⠧⠨⠩⠪⠫⠬⠭⠮⠯⠰⠱⠲⠳⠴⠵⠶⠷⠸⠹⠺⠻⠼⠽⠾⠿"
-    braille_map = dict(zip(chars, brailles))
-    braille_map['\n'] = '\n'
-    
-    return ''.join(braille_map.get(char, char) for char in text.upper())
+    text = text.upper()
+    # Grade 2 calls this for every gap between words, most of which hold no digit
+    if NUMBER_PATTERN.search(text):
+        text = NUMBER_PATTERN.sub(_number_to_ascii_braille, text)
+    return text.translate(GRADE1_TABLE)
 
 
 # def text_to_braille_grade2(text) -> str:
@@ -33,24 +60,170 @@ def text_to_braille_grade1(text) -> str:
 #     return brl.toUnicodeSymbols(brl.translate(text), flatten=True)
 
 
+def _compile_rules(rules):
+    """Split the rule table into whole words and a trie of part-word contractions"""
+    words = {}
+    trie = {}
+    for letters, ascii_braille, context in rules:
+        cells = _ascii_braille_to_unicode(ascii_braille)
+        if context == WORD:
+            words.setdefault(letters, cells)
+            continue
+        node = trie
+        for letter in letters:
+            node = node.setdefault(letter, {})
+        node.setdefault("", []).append((cells, context))
+    return words, trie
+
+GRADE2_WORDS, GRADE2_TRIE = _compile_rules(RULES)
+# Letters, with apostrophes inside a word ("can't") kept in the same word
+WORD_PATTERN = re.compile(r"[A-Za-z]+(?:'[A-Za-z]+)*")
+
+def _context_allows(context, start, end, length):
+    if context == ANY:
+        return True
+    if context == BEGIN:
+        return start == 0 and length - end >= 2
+    if context == MIDDLE:
+        return start > 0 and end < length
+    if context == NOT_BEGIN:
+        return start > 0
+    return False
+
+@lru_cache(maxsize=65536)
+def contract_word(word, standing_alone=True) -> str:
+    """
+    Contract one lowercase word. Picks the combination of contractions with
+    the fewest cells, preferring longer contractions on ties. Wordsigns and
+    letter signs are only used for words standing alone, not for the parts
+    of a word joined by an apostrophe or hyphen.
+    """
+    if standing_alone and word in GRADE2_WORDS:
+        return GRADE2_WORDS[word]
+    if len(word) == 1:
+        cell = _ascii_braille_to_unicode(word)
+        if not standing_alone or word in LETTERS_WITHOUT_SIGN:
+            return cell
+        return _ascii_braille_to_unicode(LETTER_SIGN) + cell
+
+    n = len(word)
+    # best[i] is (cell count, braille) for word[i:]
+    best = [None] * n + [(0, "")]
+    for i in range(n - 1, -1, -1):
+        count, rest = best[i + 1]
+        choice = (count + 1, _ascii_braille_to_unicode(word[i]) + rest)
+        node = GRADE2_TRIE
+        j = i
+        while j < n and word[j] in node:
+            node = node[word[j]]
+            j += 1
+            for cells, context in node.get("", ()):
+                if _context_allows(context, i, j, n):
+                    count, rest = best[j]
+                    if count + len(cells) <= choice[0]:
+                        choice = (count + len(cells), cells + rest)
+        best[i] = choice
+    return best[0][1]
+
+def text_to_braille_grade2(text) -> str:
+    """
+    Converts text to contracted (Grade 2) braille using the rules in
+    utils/grade2_rules.py. Anything that is not a letter is transcribed as in
+    Grade 1. Letters joined to a number are not contracted into wordsigns,
+    which would read as digits, and take the letter sign after one.
+    """
+    # Without digits the gaps need no number sign and the words no checks for one
+    numbers = NUMBER_PATTERN.search(text) is not None
+    grade1 = text_to_braille_grade1 if numbers else _ascii_braille_to_unicode
+    parts = []
+    pos = 0
+    for match in WORD_PATTERN.finditer(text):
+        start, end = match.span()
+        parts.append(grade1(text[pos:start]))
+        word = match.group().lower()
+        before, after = text[start - 1:start], text[end:end + 1]
+        if "'" in word or "-" in (before, after) or numbers and (before.isdigit() or after.isdigit()):
+            fragments = word.split("'")
+            if before.isdigit() and word[0] in "abcdefghij":
+                parts.append(_ascii_braille_to_unicode(LETTER_SIGN))
+            parts.append(text_to_braille_grade1("'").join(contract_word(fragment, False) for fragment in fragments))
+        else:
+            parts.append(contract_word(word))
+        pos = end
+    parts.append(grade1(text[pos:]))
+    return ''.join(parts)
+
+
+@dataclass
+class Grade2Result:
+    braille: str
+    cells: int
+    grade1_cells: int
+
+    @property
+    def cells_saved(self) -> int:
+        return self.grade1_cells - self.cells
+
+def count_cells(braille) -> int:
+    return len(braille) - braille.count('\n')
+
+def translate_grade2(text) -> Grade2Result:
+    """Grade 2 translation along with how many cells it saves over Grade 1"""
+    braille = text_to_braille_grade2(text)
+    return Grade2Result(braille, count_cells(braille), count_cells(text_to_braille_grade1(text)))
+
+
 def text_to_braille(text, grade=2) -> str:
     if grade == 1:
         return text_to_braille_grade1(text)
     elif grade == 2:
-        print("WARNING: Grade 2 braille conversion is currently disabled")
-        return text_to_braille_grade1(text)
+        return text_to_braille_grade2(text)
     else:
         raise ValueError(f"Invalid grade for braille conversion: {grade}")
 
 
+def iter_text_to_braille(texts, grade=2):
+    """Convert chunks of text one at a time, each ending its own line"""
+    for text in texts:
+        yield text_to_braille(text, grade) + '\n'
+
+
 def test_braille_conversion():
     """Test function to verify braille conversion"""
     test_cases = [
         ("hello world", "⠓⠑⠇⠇⠕⠀⠺⠕⠗⠇⠙"),
-        ("12345", "⠂⠆⠒⠲⠢"),
-        ("Braille!", "⠃⠗⠁⠊⠇⠇⠑⠮")
+        ("12345", "⠼⠁⠃⠉⠙⠑"),
+        ("Braille!", "⠃⠗⠁⠊⠇⠇⠑⠮"),
+        ("5a 10th", "⠼⠑⠰⠁⠀⠼⠁⠚⠞⠓"),
     ]
     
+    for input_text, expected in test_cases:
+        result = text_to_braille(input_text, grade=1)
+        assert result == expected, f"Failed: {input_text} -> Got {result}, Expected {expected}"
+
+
+def test_grade2_braille_conversion():
+    """Test function to verify contracted braille conversion"""
+    test_cases = [
+        ("hello world", "⠓⠑⠇⠇⠕⠀⠸⠺"),
+        ("12345", "⠼⠁⠃⠉⠙⠑"),
+        ("Braille!", "⠃⠗⠇⠮"),
+        # Numbers are not the groupsigns on the same cells ("ea" is ⠂), and
+        # letters next to them are not wordsigns ("c" alone is "can")
+        ("year 1", "⠽⠂⠗⠀⠼⠁"),
+        ("3c 5 can", "⠼⠉⠰⠉⠀⠼⠑⠀⠉"),
+        ("the child and a b", "⠮⠀⠡⠀⠯⠀⠁⠀⠰⠃"),
+        ("station", "⠌⠁⠰⠝"),
+        # Apostrophes and hyphens join parts that are not words of their own
+        ("can't", "⠉⠁⠝⠄⠞"),
+        ("I'm", "⠊⠄⠍"),
+        ("it's", "⠊⠞⠄⠎"),
+        ("don't", "⠙⠕⠝⠄⠞"),
+        ("e-mail", "⠑⠤⠍⠁⠊⠇"),
+        ("can it", "⠉⠀⠭"),
+    ]
+
     for input_text, expected in test_cases:
         result = text_to_braille(input_text)
         assert result == expected, f"Failed: {input_text} -> Got {result}, Expected {expected}"
+    assert translate_grade2("hello world").cells_saved == 3
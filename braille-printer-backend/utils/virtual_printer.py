@@ -0,0 +1,353 @@
+import os
+import queue
+import random
+import re
+import select
+import threading
+import time
+import tty
+from typing import List, Optional
+
+from utils.printer import calculate_checksum
+
+DEBUG = False
+
+# Marlin's defaults: BUFSIZE command slots and BLOCK_BUFFER_SIZE planner blocks
+BUFFER_SIZE = 4
+PLANNER_SIZE = 16
+# Seconds the virtual machine spends on a lateral move and on a punch (E move)
+MOVE_TIME = 0.002
+PUNCH_TIME = 0.002
+# Seconds "G28" takes once the planner is empty
+HOME_TIME = 0.05
+# Seconds a reply takes to reach the host beyond the baud rate, e.g. a USB
+# serial adapter's latency timer (FTDI defaults to 16 ms, CH340 is about 1 ms)
+LATENCY = 0.001
+# Seconds between "start" messages until the host first writes
+START_INTERVAL = 0.5
+
+_LINE = re.compile(r"N(-?\d+)\s+(.*)")
+
+
+class VirtualPrinter:
+    """
+    A software Marlin attached to a pseudo-terminal, for exercising
+    PrinterConnection without hardware:
+
+        vp = VirtualPrinter(move_time=0.001, error_rate=0.01)
+        vp.start()
+        printer = PrinterConnection(vp.port, vp.baud_rate)
+        printer.connect()
+
+    Lines go through the same checks as Marlin (line number, checksum) and get
+    the same replies ("Error:...", "Resend: N", "ok"). Accepted commands wait
+    in a `buffer_size` slot command queue. A command is acknowledged once it
+    moves into the `planner_size` block planner, which executes one block per
+    `move_time` / `punch_time`. Both directions are throttled to `baud_rate`
+    (10 bits per byte) and replies arrive `latency` seconds late. `error_rate`
+    corrupts that fraction of received lines.
+
+    It also has an SD card: M28/M29 save the lines in between to `files`
+    (with Marlin's CRLF endings), M23/M24 print a file, M25 pauses, M524
+    aborts and M27 reports the byte position.
+    """
+
+    def __init__(self, baud_rate: int = 250000, buffer_size: int = BUFFER_SIZE,
+                 planner_size: int = PLANNER_SIZE, move_time: float = MOVE_TIME,
+                 punch_time: float = PUNCH_TIME, latency: float = LATENCY, error_rate: float = 0.0,
+                 advanced_ok: bool = False, seed: Optional[int] = None, keep_log: bool = False):
+        self.baud_rate = baud_rate
+        self.buffer_size = buffer_size
+        self.planner_size = planner_size
+        self.move_time = move_time
+        self.punch_time = punch_time
+        self.latency = latency
+        self.error_rate = error_rate
+        self.advanced_ok = advanced_ok
+        self.keep_log = keep_log
+        self.port = None
+        self.last_line = 0
+        self.log: List[str] = []  # executed commands, if keep_log
+        self.lines_received = 0
+        self.moves = 0
+        self.punches = 0
+        self.resends = 0
+        self.files = {}  # SD card: name -> file contents
+        self._saving = None  # name of the file M28 is writing
+        self._sd_file = None  # name of the file M23 selected
+        self._sd_position = 0
+        self._sd_printing = threading.Event()
+        self._random = random.Random(seed)
+        self._master = None
+        self._slave = None
+        self._commands = None
+        self._planner = None
+        self._outgoing = queue.Queue()
+        self._wire_clock = {"rx": 0.0, "tx": 0.0}
+        self._stop = threading.Event()
+        self._first_input = threading.Event()
+        self._threads = []
+
+    def start(self) -> str:
+        """Create the pty and start the firmware threads. Returns the port to open."""
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._commands = queue.Queue(maxsize=self.buffer_size)
+        self._planner = queue.Queue(maxsize=self.planner_size)
+        self._stop.clear()
+        self._first_input.clear()
+        for target in (self._announce, self._receive, self._process, self._execute, self._transmit, self._sd_read):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self.port
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout=1)
+        self._threads = []
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _throttle(self, direction: str, num_bytes: int):
+        """
+        Hold back until `num_bytes` more could have crossed the wire. Each
+        direction keeps a clock of when its line goes idle, so sleeps are only
+        taken once they are long enough to be accurate.
+        """
+        if not self.baud_rate:
+            return
+        now = time.monotonic()
+        idle_at = max(now, self._wire_clock[direction]) + num_bytes * 10 / self.baud_rate
+        self._wire_clock[direction] = idle_at
+        if idle_at - now > 0.001:
+            time.sleep(idle_at - now)
+
+    def _send(self, *lines: str):
+        """Queue lines to go out back to back, nothing from another thread goes in between"""
+        data = "".join(line + "\n" for line in lines).encode()
+        self._outgoing.put((time.monotonic() + self.latency, data))
+        if DEBUG:
+            print(f"DEBUG: virtual printer sent {lines}")
+
+    def _transmit(self):
+        while not self._stop.is_set():
+            try:
+                deliver_at, data = self._outgoing.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            delay = deliver_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._throttle("tx", len(data))
+            try:
+                os.write(self._master, data)
+            except OSError:
+                return
+
+    def _announce(self):
+        # The host may open the port after boot and flush its input, so keep
+        # saying "start" until it talks to us
+        while not self._stop.is_set() and not self._first_input.is_set():
+            self._send("start")
+            self._first_input.wait(START_INTERVAL)
+
+    def _receive(self):
+        pending = b""
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self._master], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                data = os.read(self._master, 1024)
+            except OSError:
+                return
+            self._first_input.set()
+            pending += data
+            while b"\n" in pending:
+                raw, pending = pending.split(b"\n", 1)
+                self._throttle("rx", len(raw) + 1)
+                line = raw.decode(errors="replace").strip()
+                if line:
+                    self._receive_line(line)
+
+    def _receive_line(self, line: str):
+        self.lines_received += 1
+        if self.error_rate and self._random.random() < self.error_rate:
+            # Flip one bit of one character, as line noise would
+            i = self._random.randrange(len(line))
+            line = line[:i] + chr(ord(line[i]) ^ 1) + line[i + 1:]
+
+        command = line
+        match = _LINE.match(line)
+        if match:
+            number = int(match.group(1))
+            body, _, checksum = line.rpartition("*")
+            if not body or not checksum.strip().isdigit() or calculate_checksum(body) != int(checksum):
+                self._reject(f"Error:checksum mismatch, Last Line: {self.last_line}")
+                return
+            command = match.group(2).rpartition("*")[0].strip()
+            if command.startswith("M110"):
+                self.last_line = number
+            elif number != self.last_line + 1:
+                self._reject(f"Error:Line Number is not Last Line Number+1, Last Line: {self.last_line}")
+                return
+            else:
+                self.last_line = number
+        elif line.startswith("N") or "*" in line:
+            self._reject(f"Error:No Line Number with checksum, Last Line: {self.last_line}")
+            return
+
+        if self._saving is not None:
+            # Written to the card instead of run, acknowledged straight away
+            if command.upper().startswith("M29"):
+                self._saving = None
+                self._send("Done saving file.", self._ok())
+            else:
+                self.files[self._saving] += command + "\r\n"
+                self._send(self._ok())
+            return
+
+        # Marlin stops reading the port while its command buffer is full
+        while not self._stop.is_set():
+            try:
+                self._commands.put((command, False), timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _reject(self, error: str):
+        self.resends += 1
+        self._send(error, f"Resend: {self.last_line + 1}", self._ok())
+
+    def _ok(self) -> str:
+        if self.advanced_ok:
+            planner_free = self.planner_size - self._planner.qsize()
+            buffer_free = self.buffer_size - self._commands.qsize()
+            return f"ok N{self.last_line} P{planner_free} B{buffer_free}"
+        return "ok"
+
+    def _process(self):
+        while not self._stop.is_set():
+            try:
+                command = self._commands.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            command, from_sd = command
+            if self.keep_log:
+                self.log.append(command)
+            replies = self._run(command)
+            # Commands read from the card get no "ok"
+            if from_sd:
+                if replies:
+                    self._send(*replies)
+            else:
+                self._send(*replies, self._ok())
+
+    def _run(self, command: str) -> List[str]:
+        """Carry out one command, returning the lines to print before its ok"""
+        words = command.split()
+        code = words[0].upper() if words else ""
+        if code in ("G0", "G1"):
+            punch = any(word.upper().startswith("E") for word in words[1:])
+            duration = self.punch_time if punch else self.move_time
+            # Blocks while the planner is full, so the ok is delayed like Marlin's
+            while not self._stop.is_set():
+                try:
+                    self._planner.put(duration, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if punch:
+                self.punches += 1
+            else:
+                self.moves += 1
+            return []
+        if code in ("G28", "M400"):
+            self._planner.join()
+            if code == "G28":
+                time.sleep(HOME_TIME)
+            return []
+        if code == "M115":
+            return ["FIRMWARE_NAME:Marlin (virtual) PROTOCOL_VERSION:1.0 MACHINE_TYPE:braille-printer"]
+        if code == "M92":
+            return ["echo:  M92 X80.00 Y80.00 Z400.00 E400.00"]
+        if code in ("M28", "M23", "M30"):
+            name = command[len(code):].strip()
+            if code == "M28":
+                self.files[name] = ""
+                self._saving = name
+                return [f"Writing to file: {name}"]
+            if name not in self.files:
+                return [f"open failed, File: {name}."]
+            if code == "M30":
+                del self.files[name]
+                return [f"File deleted:{name}"]
+            self._sd_file, self._sd_position = name, 0
+            return [f"File opened: {name} Size: {len(self.files[name])}", "File selected"]
+        if code == "M24" and self._sd_file is not None:
+            self._sd_printing.set()
+        elif code == "M25":
+            self._sd_printing.clear()
+        elif code == "M524":
+            self._sd_printing.clear()
+            self._sd_file = None
+        elif code == "M27":
+            if self._sd_file is None:
+                return ["Not SD printing"]
+            return [f"SD printing byte {self._sd_position}/{len(self.files[self._sd_file])}"]
+        return []
+
+    def _sd_read(self):
+        """Feed the selected file into the command queue while printing, like Marlin's card reader"""
+        while not self._stop.is_set():
+            if not self._sd_printing.wait(0.1):
+                continue
+            name = self._sd_file
+            if name is None:
+                continue
+            data = self.files[name]
+            if self._sd_position >= len(data):
+                self._sd_printing.clear()
+                self._sd_file = None
+                self._send("Done printing file")
+                continue
+            end = data.find("\n", self._sd_position) + 1 or len(data)
+            command = data[self._sd_position:end].strip()
+            while not self._stop.is_set() and self._sd_printing.is_set():
+                try:
+                    self._commands.put((command, True), timeout=0.1)
+                    self._sd_position = end
+                    break
+                except queue.Full:
+                    continue
+
+    def _execute(self):
+        while not self._stop.is_set():
+            try:
+                duration = self._planner.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            time.sleep(duration)
+            self._planner.task_done()
+
+
+if __name__ == "__main__":
+    with VirtualPrinter() as vp:
+        print(f"Virtual printer on {vp.port}, Ctrl-C to stop")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,104 @@
+import struct
+from typing import List
+
+import numpy as np
+
+from utils.braille_to_gcode import DotPosition
+from utils.fast_layout import DotArrays
+
+# Content type of the binary dot encoding, JSON stays the default
+DOTS_MIMETYPE = "application/x-braille-dots"
+
+MAGIC = b"BRDT"
+# Version 1 sent coordinates as float32, which G-code showed as e.g. X60.49999237.
+# It is still read.
+VERSION = 2
+COORDINATE_TYPES = {1: "<f4", 2: "<f8"}
+# magic, version, number of pages
+HEADER = struct.Struct("<4sHH")
+# page number, number of dots
+PAGE_HEADER = struct.Struct("<HI")
+
+
+def encode_dot_arrays(dots: DotArrays) -> bytes:
+    """
+    Pack dot positions page by page:
+
+        header:   "BRDT", uint16 version, uint16 page count
+        per page: uint16 page, uint32 n, float64 x[n], float64 y[n],
+                  punch flags as ceil(n / 8) bytes (little-endian bit order)
+
+    All numbers are little-endian. About 16.1 bytes per dot, against ~60 in
+    JSON. Coordinates keep full precision, so they give the same G-code as JSON.
+    """
+    # Every page of the document, empty ones too
+    page_ids = range(dots.num_pages)
+    parts = [HEADER.pack(MAGIC, VERSION, len(page_ids))]
+    for page in page_ids:
+        page_dots = dots.page_slice(page)
+        parts.append(PAGE_HEADER.pack(page, len(page_dots)))
+        parts.append(page_dots.x.astype("<f8").tobytes())
+        parts.append(page_dots.y.astype("<f8").tobytes())
+        parts.append(np.packbits(page_dots.punch, bitorder="little").tobytes())
+    return b"".join(parts)
+
+
+def decode_dot_arrays(data: bytes) -> DotArrays:
+    """Inverse of encode_dot_arrays"""
+    magic, version, num_records = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a braille dots payload")
+    if version not in COORDINATE_TYPES:
+        raise ValueError(f"Unsupported braille dots version: {version}")
+    coordinate = np.dtype(COORDINATE_TYPES[version])
+
+    offset = HEADER.size
+    xs, ys, pages, punches = [], [], [], []
+    num_pages = 0
+    for _ in range(num_records):
+        page, count = PAGE_HEADER.unpack_from(data, offset)
+        offset += PAGE_HEADER.size
+        xs.append(np.frombuffer(data, coordinate, count, offset))
+        offset += coordinate.itemsize * count
+        ys.append(np.frombuffer(data, coordinate, count, offset))
+        offset += coordinate.itemsize * count
+        flags = np.frombuffer(data, np.uint8, (count + 7) // 8, offset)
+        punches.append(np.unpackbits(flags, count=count, bitorder="little").astype(bool))
+        offset += (count + 7) // 8
+        pages.append(np.full(count, page, dtype=np.int64))
+        num_pages = max(num_pages, page + 1)
+
+    if not num_records:
+        return DotArrays(np.empty(0), np.empty(0), np.empty(0, dtype=np.int64), np.empty(0, dtype=bool), 0)
+    return DotArrays(
+        np.concatenate(xs).astype(np.float64),
+        np.concatenate(ys).astype(np.float64),
+        np.concatenate(pages),
+        np.concatenate(punches),
+        num_pages,
+    )
+
+
+def dot_arrays_to_list(dots: DotArrays) -> List[DotPosition]:
+    """Flat list of DotPosition, for the functions that take a single page"""
+    return [DotPosition(x, y, punch, page) for x, y, punch, page in
+            zip(dots.x.tolist(), dots.y.tolist(), dots.punch.tolist(), dots.page.tolist())]
+
+
+def test_wire_format_round_trip():
+    """Test function to verify dots survive encoding exactly, empty pages included"""
+    from utils.braille_to_gcode import PrintedDots, dot_pos_to_gcode
+    from utils.fast_layout import get_dots_arrays
+    from utils.text_to_braille import text_to_braille
+
+    dots = get_dots_arrays(text_to_braille("hello world " * 200)).select_pages([0, 2])  # page 1 is empty
+    decoded = decode_dot_arrays(encode_dot_arrays(dots))
+    assert decoded.num_pages == dots.num_pages
+    for name in ("x", "y", "page", "punch"):
+        assert np.array_equal(getattr(decoded, name), getattr(dots, name)), name
+    first = dots.page_slice(0).to_dot_positions()[0]
+    assert ([str(action) for action in dot_pos_to_gcode(dot_arrays_to_list(decoded.page_slice(0)), sink=PrintedDots())]
+            == [str(action) for action in dot_pos_to_gcode(first, sink=PrintedDots())])
+
+    empty = DotArrays(np.empty(0), np.empty(0), np.empty(0, dtype=np.int64), np.empty(0, dtype=bool), 0)
+    assert len(decode_dot_arrays(encode_dot_arrays(empty))) == 0